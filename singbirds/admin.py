@@ -1,23 +1,24 @@
-from django.contrib import admin, messages
+from django.contrib import admin
 from django.utils.html import format_html
-from .models import Country, Hotspot, Bird, BirdDetail, AcousticParameters
+from .models import Country, Hotspot, Bird, BirdDetail, AcousticParameters, SyncState, Job
 from import_export import resources 
 from import_export.admin import ImportExportModelAdmin
-from .collectData.collectCountries import fetch_and_save_countries
-from .collectData.collectHotspots import fetch_and_save_hotspots_by_country
-from .collectData.collectBirds import fetch_and_save_birds_by_country
 from .collectData.collectObservations import fetch_birds_for_selected_hotspots
 from .collectData.collectRecordings import fetch_xeno_canto_recordings
 from .collectData.createSpectrogram import generate_spectrograms_action
 from .collectData.collectParameters import sync_extract_acoustic_features
+from .collectData.processRecordings import process_recordings_action
 from .collectData.getNMDS import perform_nmds_action
 from .collectData.getUMAP import perform_umap_action
+from .api_cache import bump_data_version
+from .jobs import JOB_REFRESH_SECONDS, enqueue_admin_job
 
 @admin.action(description='Delete BirdDetails without recording URL')
 def delete_bird_details_without_recording_url(modeladmin, request, queryset):
     # recording_url が存在しないレコードをフィルタリング
     to_delete = queryset.filter(recording_url__isnull=True) | queryset.filter(recording_url__exact='')
     count, _ = to_delete.delete()
+    bump_data_version()
     
     # メッセージを表示
     modeladmin.message_user(request, f'Successfully deleted {count} BirdDetails without recording URL.')
@@ -25,26 +26,35 @@ def delete_bird_details_without_recording_url(modeladmin, request, queryset):
 
 @admin.action(description='Fetch and save countries from eBird API')
 def fetch_countries_action(modeladmin, request, queryset):
-    try:
-        fetch_and_save_countries()
-        messages.success(request, "Countries fetched and saved successfully.")
-    except Exception as e:
-        messages.error(request, f"Error fetching countries: {e}")
+    enqueue_admin_job(modeladmin, request, 'fetch_countries')
 
 @admin.action(description="選択した国に基づいてホットスポットを取得")
 def fetch_hotspots_for_selected_countries(modeladmin, request, queryset):
-    for country in queryset:
-        # Country モデルの countryCode を渡す
-        fetch_and_save_hotspots_by_country(country.countryCode)
-        modeladmin.message_user(request, f"Fetched hotspots for {country.country_name} ({country.countryCode})")
+    # 選択された国をまとめて並行取得するジョブを投入する
+    enqueue_admin_job(modeladmin, request, 'fetch_hotspots', country_codes=list(queryset.values_list('countryCode', flat=True)))
 
 
 @admin.action(description="選択した国の鳥データを取得")
 def fetch_birds_for_selected_countries(modeladmin, request, queryset):
-    for country in queryset:
-        # 選択された国の countryCode を使用
-        fetch_and_save_birds_by_country(country.countryCode)
-        modeladmin.message_user(request, f"Fetched bird data for {country.country_name} ({country.countryCode})")
+    # 選択された国をまとめて並行取得するジョブを投入する
+    enqueue_admin_job(modeladmin, request, 'fetch_birds', country_codes=list(queryset.values_list('countryCode', flat=True)))
+
+
+@admin.action(description="Cancel selected jobs")
+def cancel_jobs(modeladmin, request, queryset):
+    # 実行中のジョブは、次に進捗を書き込む時点で停止する
+    count = queryset.filter(state__in=[Job.QUEUED, Job.RUNNING]).update(state=Job.CANCELLED)
+    modeladmin.message_user(request, f"Cancelled {count} jobs.")
+
+
+@admin.action(description="Retry selected jobs")
+def retry_jobs(modeladmin, request, queryset):
+    jobs = [
+        Job(name=job.name, params=job.params)
+        for job in queryset.filter(state__in=[Job.FAILED, Job.CANCELLED])
+    ]
+    Job.objects.bulk_create(jobs)
+    modeladmin.message_user(request, f"Queued {len(jobs)} jobs again.")
 
 class AcousticParametersResource(resources.ModelResource):
     list_filter = ("bird_id",) 
@@ -60,28 +70,48 @@ class BirdDetailResource(resources.ModelResource):
         fields = ('recording_url', 'bird_id', 'spectrogram')
 
 
-class BirdAdmin(admin.ModelAdmin):
+class DataVersionAdminMixin:
+    # 管理画面での変更・削除時に公開APIのキャッシュを無効化する
+    def save_related(self, request, form, formsets, change):
+        # 多対多の関連も保存し終えてから版数を上げる
+        super().save_related(request, form, formsets, change)
+        bump_data_version()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        bump_data_version()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        bump_data_version()
+
+
+class BirdAdmin(DataVersionAdminMixin, admin.ModelAdmin):
     actions = [fetch_xeno_canto_recordings]
     search_fields = ('comName',)
     list_filter = ("hotspots",)
 
-class HotspotAdmin(admin.ModelAdmin):
+class HotspotAdmin(DataVersionAdminMixin, admin.ModelAdmin):
     actions = [fetch_birds_for_selected_hotspots]
 
-class CountryAdmin(admin.ModelAdmin):
+class CountryAdmin(DataVersionAdminMixin, admin.ModelAdmin):
     list_display = ('countryCode', 'country_name')
     actions = [fetch_countries_action, fetch_hotspots_for_selected_countries, fetch_birds_for_selected_countries] 
 
-class BirdDetailAdmin(ImportExportModelAdmin):
+class BirdDetailAdmin(DataVersionAdminMixin, ImportExportModelAdmin):
     list_filter = ("bird_id", )
     search_fields = ('bird_id__comName',)
     list_display = ['bird_id', 'birddetail_id', 'recording_url', 'spectrogram_image']
-    actions = [generate_spectrograms_action, sync_extract_acoustic_features,delete_bird_details_without_recording_url]
+    actions = [process_recordings_action, generate_spectrograms_action, sync_extract_acoustic_features,delete_bird_details_without_recording_url]
     resource_class = BirdDetailResource 
 
     def spectrogram_image(self, obj):
+        # 一覧ではサムネイルを表示する（派生画像が無ければ元の画像）
         if obj.spectrogram:
-            return format_html('<img src="{}" width="150" height="auto" />', obj.spectrogram.url)
+            return format_html(
+                '<picture><source srcset="{}" type="image/webp"><img src="{}" width="150" height="auto" loading="lazy" /></picture>',
+                obj.spectrogram_url('thumbnail', 'webp'), obj.spectrogram_url('thumbnail', 'png'),
+            )
         return "No Image"
     
     # フィールド名の表示をわかりやすくする
@@ -93,8 +123,60 @@ class AcousticParametersAdmin(admin.ModelAdmin):
     actions = [perform_nmds_action, perform_umap_action]
 
 
+class SyncStateAdmin(admin.ModelAdmin):
+    list_display = ('source', 'scope', 'last_synced_at', 'item_count', 'changed_count')
+    list_filter = ('source',)
+    search_fields = ('scope',)
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'state', 'progress_bar', 'message', 'error_count', 'created_at', 'duration')
+    list_filter = ('state', 'name')
+    actions = [cancel_jobs, retry_jobs]
+    readonly_fields = [field.name for field in Job._meta.fields] + ['progress_bar', 'duration']
+
+    def has_add_permission(self, request):
+        return False
+
+    def progress_bar(self, obj):
+        if obj.progress_total:
+            return format_html(
+                '<progress value="{}" max="{}"></progress> {} / {}',
+                obj.progress_done, obj.progress_total, obj.progress_done, obj.progress_total,
+            )
+        return obj.progress_done
+
+    progress_bar.short_description = "Progress"
+
+    def error_count(self, obj):
+        return len(obj.errors)
+
+    error_count.short_description = "Errors"
+
+    def duration(self, obj):
+        if obj.started_at is None:
+            return "-"
+        end = obj.finished_at or obj.heartbeat_at or obj.started_at
+        return str(end - obj.started_at).split('.')[0]
+
+    # 未完了のジョブがある間は、一定間隔でページを再読み込みして進捗を更新する
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        if Job.objects.filter(state__in=[Job.QUEUED, Job.RUNNING]).exists():
+            response['Refresh'] = str(JOB_REFRESH_SECONDS)
+        return response
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        response = super().change_view(request, object_id, form_url, extra_context)
+        if Job.objects.filter(pk=object_id, state__in=[Job.QUEUED, Job.RUNNING]).exists():
+            response['Refresh'] = str(JOB_REFRESH_SECONDS)
+        return response
+
+
 admin.site.register(Country, CountryAdmin)
 admin.site.register(Hotspot, HotspotAdmin)
 admin.site.register(Bird, BirdAdmin)
 admin.site.register(BirdDetail, BirdDetailAdmin)
 admin.site.register(AcousticParameters, AcousticParametersAdmin)
+admin.site.register(SyncState, SyncStateAdmin)
+admin.site.register(Job, JobAdmin)
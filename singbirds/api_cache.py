@@ -0,0 +1,125 @@
+import hashlib
+import time
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db.models import F
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from .models import DataVersion
+
+API_DATA_VERSION = 'api'
+
+# キャッシュするレンダラーの format（ブラウザブルAPIなどは毎回描画する）
+CACHEABLE_FORMATS = {'json', 'columns', 'msgpack'}
+
+
+def _create_data_version():
+    # DBを作り直した場合に、共有キャッシュに残った古い版数と衝突しないよう時刻から始める
+    data_version, _ = DataVersion.objects.get_or_create(
+        name=API_DATA_VERSION, defaults={'version': int(time.time())}
+    )
+    return data_version.version
+
+
+def get_data_version():
+    version = DataVersion.objects.filter(name=API_DATA_VERSION).values_list('version', flat=True).first()
+    if version is None:
+        version = _create_data_version()
+    return version
+
+
+def bump_data_version():
+    # データが変わったことを記録し、古いキャッシュを参照されなくする
+    if not DataVersion.objects.filter(name=API_DATA_VERSION).update(version=F('version') + 1):
+        _create_data_version()
+        DataVersion.objects.filter(name=API_DATA_VERSION).update(version=F('version') + 1)
+
+
+def _cache_key(query_params, key, version, fmt):
+    query = '&'.join(f'{name}={value}' for name, value in sorted(query_params.lists()))
+    query_hash = hashlib.sha1(query.encode('utf-8')).hexdigest()
+    return f'api:{key}:v{version}:{fmt}:{query_hash}'
+
+
+def _matches_etag(request, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
+
+
+def _finalize(response, etag):
+    response['ETag'] = etag
+    patch_cache_control(response, no_cache=True)
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def _make_entry(body, renderer):
+    if renderer.charset:
+        content_type = f'{renderer.media_type}; charset={renderer.charset}'
+    else:
+        content_type = renderer.media_type
+    etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+    return etag, body, content_type
+
+
+def _respond(request, entry):
+    etag, body, content_type = entry
+    if _matches_etag(request, etag):
+        return _finalize(HttpResponse(status=304), etag)
+
+    return _finalize(HttpResponse(body, content_type=content_type), etag)
+
+
+def cached_response(request, key, build):
+    # データ版数ごとにシリアライズ済みのレスポンス本文をキャッシュし、ETag / 304 に対応する
+    # build() はレスポンスデータを返す。Response を返した場合（エラーなど）はキャッシュしない
+    renderer = request.accepted_renderer
+    if renderer.format not in CACHEABLE_FORMATS:
+        data = build()
+        return data if isinstance(data, Response) else Response(data)
+
+    cache = caches['api']
+    cache_key = _cache_key(request.query_params, key, get_data_version(), renderer.format)
+    entry = cache.get(cache_key)
+
+    if entry is None:
+        data = build()
+        if isinstance(data, Response):
+            return data
+
+        body = renderer.render(data, request.accepted_media_type, {'request': request})
+        entry = _make_entry(body, renderer)
+        cache.set(cache_key, entry)
+
+    return _respond(request, entry)
+
+
+async def aget_data_version():
+    version = await DataVersion.objects.filter(name=API_DATA_VERSION).values_list('version', flat=True).afirst()
+    if version is None:
+        version = await sync_to_async(_create_data_version)()
+    return version
+
+
+async def acached_json_response(request, key, build):
+    # 非同期ビュー用の cached_response。常に JSON で返し、同じキーの同期ビューとキャッシュを共有する
+    # build は await できる関数で、データを返す。HttpResponse を返した場合（エラーなど）はキャッシュしない
+    renderer = JSONRenderer()
+    cache = caches['api']
+    cache_key = _cache_key(request.GET, key, await aget_data_version(), renderer.format)
+    entry = await cache.aget(cache_key)
+
+    if entry is None:
+        data = await build()
+        if isinstance(data, HttpResponse):
+            return data
+
+        entry = _make_entry(renderer.render(data), renderer)
+        await cache.aset(cache_key, entry)
+
+    return _respond(request, entry)
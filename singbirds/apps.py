@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class SingbirdsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'singbirds'
+
+    def ready(self):
+        # 集計テーブルを維持するシグナルを登録
+        from . import signals  # noqa: F401
+        # 管理アクションから投入するジョブを登録
+        from . import tasks  # noqa: F401
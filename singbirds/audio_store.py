@@ -0,0 +1,278 @@
+import errno
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+import librosa
+import requests
+import soundfile
+
+# 録音ファイルのローカルキャッシュ。内容のハッシュで保存し、URL からはハッシュを引く
+#   <root>/objects/ab/abcdef...   音声ファイル本体（内容の sha256）
+#   <root>/urls/12/1234...        URL の sha256 -> 本体のハッシュ
+# 書き込みは一時ファイルからの置き換えで行うので、読み込み中のプロセスが途中の状態を見ることはない
+# 削除された本体も開いているファイルからは読み続けられるため、読み込みは open_audio で開いて行う
+
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+# 上限を超えたときは、この割合まで古いものから削除する
+EVICT_TARGET_RATIO = 0.9
+
+# 最終アクセス時刻の更新間隔（秒）。読み込みのたびにメタデータを書かないようにする
+TOUCH_INTERVAL = 3600
+
+# 合計サイズはプロセス内で加算して見積もり、この回数のダウンロードごとにディレクトリを走査し直す
+RESCAN_INTERVAL = 100
+
+# ダウンロードの既定値。サイズの上限を超える録音は保存せずにエラーにする
+DEFAULT_MAX_DOWNLOAD_BYTES = 50 * 1024 ** 2
+DEFAULT_DOWNLOAD_TIMEOUT = 60
+CHUNK_SIZE = 256 * 1024
+
+
+class AudioTooLarge(requests.RequestException):
+    pass
+
+
+def _settings_value(name, default):
+    # Django の設定があれば使う（HPC 用のスクリプトなど Django の外からも使えるようにする）
+    try:
+        from django.conf import settings
+        if settings.configured:
+            return getattr(settings, name, default)
+    except ImportError:
+        pass
+    return default
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _sharded(directory, digest):
+    return os.path.join(directory, digest[:2], digest)
+
+
+def _write_atomic(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            result = write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return result
+
+
+class AudioStore:
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES, max_download_bytes=DEFAULT_MAX_DOWNLOAD_BYTES,
+                 download_timeout=DEFAULT_DOWNLOAD_TIMEOUT):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_download_bytes = max_download_bytes
+        self.download_timeout = download_timeout
+        self.objects_dir = os.path.join(root, 'objects')
+        self.urls_dir = os.path.join(root, 'urls')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        self.estimated_bytes = None
+        self.writes_since_scan = 0
+
+    def _object_path(self, content_hash):
+        return _sharded(self.objects_dir, content_hash)
+
+    def _url_path(self, url):
+        return _sharded(self.urls_dir, _sha256(url))
+
+    def content_hash(self, url):
+        try:
+            with open(self._url_path(url)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _touch(self, path, interval=TOUCH_INTERVAL):
+        # LRU のため最終アクセス時刻として mtime を更新する
+        try:
+            if time.time() - os.stat(path).st_mtime > interval:
+                os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _open_cached(self, url):
+        content_hash = self.content_hash(url)
+        if content_hash is None:
+            return None
+        path = self._object_path(content_hash)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None  # 本体が削除済み
+        self._touch(path)
+        return f
+
+    def contains(self, url):
+        content_hash = self.content_hash(url)
+        return content_hash is not None and os.path.exists(self._object_path(content_hash))
+
+    def fetch(self, url, session=None):
+        # URL の内容をキャッシュに保存し、内容のハッシュを返す（キャッシュ済みならダウンロードしない）
+        content_hash = self.content_hash(url)
+        if content_hash is not None and os.path.exists(self._object_path(content_hash)):
+            return content_hash
+
+        # 録音全体をメモリに載せないよう、少しずつ一時ファイルに書き込む
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with (session or requests).get(url, stream=True, timeout=self.download_timeout) as response:
+                    response.raise_for_status()
+                    self._check_size(url, response.headers.get('Content-Length'))
+                    received = 0
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        received += len(chunk)
+                        self._check_size(url, received)
+                        digest.update(chunk)
+                        f.write(chunk)
+
+            content_hash = digest.hexdigest()
+            object_path = self._object_path(content_hash)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, object_path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        _write_atomic(self._url_path(url), lambda f: f.write(content_hash.encode('ascii')))
+
+        # 見積もりが上限を超えたときと、定期的にだけ実際のサイズを確認する
+        self.writes_since_scan += 1
+        if self.estimated_bytes is not None:
+            self.estimated_bytes += size
+        if (self.estimated_bytes is None or self.estimated_bytes > self.max_bytes
+                or self.writes_since_scan >= RESCAN_INTERVAL):
+            self.evict()
+        return content_hash
+
+    def _check_size(self, url, size):
+        if size is not None and self.max_download_bytes and int(size) > self.max_download_bytes:
+            raise AudioTooLarge(f"{url} is larger than {self.max_download_bytes} bytes")
+
+    def open(self, url, session=None):
+        # キャッシュから録音を開く。無ければダウンロードしてから開く
+        f = self._open_cached(url)
+        if f is not None:
+            return f
+        self.fetch(url, session=session)
+        f = self._open_cached(url)
+        if f is None:
+            # ダウンロード直後に他のプロセスが削除した場合
+            raise FileNotFoundError(errno.ENOENT, "Audio was evicted while opening", url)
+        return f
+
+    def path(self, url, session=None):
+        # キャッシュ上のファイルのパスを返す（無ければダウンロードする）。別プロセスでデコードする場合に使う
+        # パスは開くまでの間に削除されうるため、最も新しいものとして mtime を更新しておく（削除された場合は呼び出し側で取得し直す）
+        path = self._object_path(self.fetch(url, session=session))
+        self._touch(path, interval=0)
+        return path
+
+    def _objects(self):
+        for dirpath, _, filenames in os.walk(self.objects_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def total_bytes(self):
+        return sum(size for _, size, _ in self._objects())
+
+    def evict(self):
+        # 合計サイズが上限を超えていれば、最終アクセスの古いものから削除する。削除したバイト数を返す
+        # URL の対応ファイルは残すが、本体が無ければ未キャッシュとして扱われる
+        if not self.max_bytes:
+            return 0
+
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, '.evict.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0  # 他のプロセスが削除中
+
+            objects = list(self._objects())
+            total = sum(size for _, size, _ in objects)
+            self.estimated_bytes = total
+            self.writes_since_scan = 0
+            if total <= self.max_bytes:
+                return 0
+
+            target = self.max_bytes * EVICT_TARGET_RATIO
+            removed = 0
+            for path, size, _ in sorted(objects, key=lambda item: item[2]):
+                if total - removed <= target:
+                    break
+                try:
+                    os.remove(path)
+                    removed += size
+                except FileNotFoundError:
+                    pass
+            self.estimated_bytes = total - removed
+            return removed
+
+
+_stores = {}
+
+
+def get_audio_store():
+    root = _settings_value('AUDIO_STORE_PATH', os.getenv('AUDIO_STORE_PATH', os.path.join(os.getcwd(), 'audio_cache')))
+    max_bytes = int(_settings_value('AUDIO_STORE_MAX_BYTES', os.getenv('AUDIO_STORE_MAX_BYTES', DEFAULT_MAX_BYTES)))
+    max_download_bytes = int(_settings_value(
+        'AUDIO_DOWNLOAD_MAX_BYTES', os.getenv('AUDIO_DOWNLOAD_MAX_BYTES', DEFAULT_MAX_DOWNLOAD_BYTES)
+    ))
+    download_timeout = float(_settings_value(
+        'AUDIO_DOWNLOAD_TIMEOUT', os.getenv('AUDIO_DOWNLOAD_TIMEOUT', DEFAULT_DOWNLOAD_TIMEOUT)
+    ))
+    key = (root, max_bytes, max_download_bytes, download_timeout)
+    if key not in _stores:
+        _stores[key] = AudioStore(root, max_bytes, max_download_bytes, download_timeout)
+    return _stores[key]
+
+
+def open_audio(url, session=None):
+    # 音声を扱う処理はダウンロードせずにここから読み込む
+    #   with open_audio(url) as f:
+    #       y, sr = librosa.load(f, sr=None)
+    return get_audio_store().open(url, session=session)
+
+
+def decode_audio(source, sr=None):
+    # source はファイルのパスまたは開いたファイル。ダウンロードした内容をメモリ上に複製せずにデコードする
+    # 戻り値は (波形, サンプリングレート, デコード時の使用メモリの見積もり（バイト）)
+    # 見積もりは元のサンプリングレート・チャンネル数の float32 の配列と、返す波形の合計
+    try:
+        info = soundfile.info(source)
+        native_bytes = info.frames * info.channels * 4
+    except RuntimeError:
+        native_bytes = 0  # libsndfile で読めない形式は librosa 側の読み込みに任せる
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    y, sr = librosa.load(source, sr=sr)
+    return y, sr, native_bytes + y.nbytes
+
+
+def load_audio(url, sr=None, session=None):
+    # キャッシュのファイルから直接デコードする。戻り値は decode_audio と同じ
+    with open_audio(url, session=session) as audio_file:
+        return decode_audio(audio_file, sr=sr)
@@ -0,0 +1,135 @@
+import threading
+import time
+from django.core.cache.backends.redis import RedisCache, RedisCacheClient, RedisSerializer
+from django.utils.module_loading import import_string
+
+# Redis サーバーの無い開発環境やテストで API_CACHE_BACKEND=redis-stub として使うキャッシュ
+# Django の RedisCache と同じクライアントの処理（シリアライズ・タイムアウトの扱い）を、Redis のコマンドを模したメモリ上のストアで動かす
+# 同じ LOCATION のキャッシュはプロセス内で1つのストアを共有する（プロセス間では共有されない）
+
+
+class StubRedis:
+    # RedisCacheClient が使うコマンドだけを実装した Redis の代わり
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.RLock()
+
+    def _expire_if_needed(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+
+    def _exists(self, key):
+        self._expire_if_needed(key)
+        return key in self._data
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key) if self._exists(key) else None
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx and self._exists(key):
+                return None
+            self._data[key] = value
+            self._expires.pop(key, None)
+            if ex is not None:
+                self._expires[key] = time.monotonic() + ex
+            return True
+
+    def mget(self, keys):
+        with self._lock:
+            return [self._data.get(key) if self._exists(key) else None for key in keys]
+
+    def mset(self, mapping):
+        with self._lock:
+            for key, value in mapping.items():
+                self.set(key, value)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            deleted = 0
+            for key in keys:
+                if self._exists(key):
+                    del self._data[key]
+                    self._expires.pop(key, None)
+                    deleted += 1
+            return deleted
+
+    def exists(self, *keys):
+        with self._lock:
+            return sum(self._exists(key) for key in keys)
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if not self._exists(key):
+                return False
+            self._expires[key] = time.monotonic() + seconds
+            return True
+
+    def persist(self, key):
+        with self._lock:
+            return self._exists(key) and self._expires.pop(key, None) is not None
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            value = int(self._data.get(key, 0) if self._exists(key) else 0) + amount
+            self._data[key] = value
+            return value
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            return True
+
+    def pipeline(self):
+        return StubPipeline(self)
+
+
+class StubPipeline:
+    # コマンドを溜めておき、execute でまとめて実行する
+    def __init__(self, client):
+        self._client = client
+        self._commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self._client, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self._client._lock:
+            results = [command(*args, **kwargs) for command, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+
+class StubRedisCacheClient(RedisCacheClient):
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, servers, serializer=None, **options):
+        # redis-py を読み込まず、接続の代わりに LOCATION ごとのストアを使う
+        self._servers = servers
+        if isinstance(serializer, str):
+            serializer = import_string(serializer)
+        if callable(serializer):
+            serializer = serializer()
+        self._serializer = serializer or RedisSerializer()
+
+    def get_client(self, key=None, *, write=False):
+        with self._stores_lock:
+            return self._stores.setdefault(self._servers[0], StubRedis())
+
+
+class StubRedisCache(RedisCache):
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        self._class = StubRedisCacheClient
@@ -0,0 +1,184 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+import aiohttp
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger("app")
+
+EBIRD_API_URL = "https://api.ebird.org/v2/"
+XENO_CANTO_API_URL = "https://www.xeno-canto.org/api/2/"
+
+# リトライ対象のステータスコード
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class TokenBucket:
+    # rate 件/秒、最大 burst 件までまとめて取得できるトークンバケット
+    # イベントループに依存しないので、同じプロセス内の複数の asyncio.run から共有できる
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        # トークンを1つ予約し、使えるようになるまでの待ち時間を返す
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    async def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class AsyncApiClient:
+    # 接続を使い回す aiohttp のセッションに、同時接続数の上限・レート制限・リトライを付けたクライアント
+    #   async with AsyncApiClient(base_url) as client:
+    #       data = await client.get_json('path', params)
+    def __init__(self, base_url, headers=None, concurrency=8, rate_limiter=None,
+                 timeout=30, max_retries=4, backoff=1.0):
+        self.base_url = base_url
+        self.headers = headers or {}
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = None
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            timeout=self.timeout,
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    def _retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff * (2 ** attempt) * (0.5 + random.random())
+
+    def _url(self, path):
+        if path.startswith(('http://', 'https://')):
+            return path
+        return self.base_url.rstrip('/') + '/' + path.lstrip('/')
+
+    async def get_json(self, path, params=None):
+        url = self._url(path)
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            async with self.semaphore:
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire()
+                try:
+                    async with self.session.get(url, params=params) as response:
+                        if response.status == 200:
+                            # 本文が JSON でなければ、その1件だけ失敗として扱う（get_many の他の結果は返す）
+                            try:
+                                return await response.json(content_type=None)
+                            except (aiohttp.ContentTypeError, json.JSONDecodeError, UnicodeDecodeError) as e:
+                                raise ApiError(response.status, f"Invalid JSON: {e}") from e
+
+                        message = await response.text()
+                        if response.status not in RETRY_STATUSES or last_attempt:
+                            raise ApiError(response.status, message[:200])
+                        delay = self._retry_delay(attempt, response)
+                        logger.warning(f"{path} returned {response.status}, retrying in {delay:.1f}s")
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if last_attempt:
+                        raise ApiError(None, f"{type(e).__name__}: {e}") from e
+                    delay = self._retry_delay(attempt)
+                    logger.warning(f"{path} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+
+            # 待機中は同時接続の枠を空けておく
+            await asyncio.sleep(delay)
+
+    async def get_many(self, requests):
+        # requests は (key, path, params) の列。{key: データまたは ApiError} を返す
+        async def fetch(key, path, params):
+            try:
+                return key, await self.get_json(path, params)
+            except ApiError as e:
+                return key, e
+
+        results = await asyncio.gather(*(fetch(key, path, params) for key, path, params in requests))
+        return dict(results)
+
+
+# eBird API のクォータはAPIトークン単位なので、プロセス内のすべての取得処理で1つのバケットを共有する
+ebird_rate_limiter = TokenBucket(
+    rate=float(os.getenv("EBIRD_RATE_LIMIT", "5")),
+    burst=float(os.getenv("EBIRD_RATE_BURST", "10")),
+)
+
+
+class EBirdClient(AsyncApiClient):
+    def __init__(self, base_url=None, **kwargs):
+        kwargs.setdefault('concurrency', int(os.getenv("EBIRD_CONCURRENCY", "8")))
+        kwargs.setdefault('rate_limiter', ebird_rate_limiter)
+        super().__init__(
+            base_url or os.getenv("EBIRD_API_URL", EBIRD_API_URL),
+            headers={"X-eBirdApiToken": os.getenv("ebirdToken") or ""},
+            **kwargs,
+        )
+
+
+# Xeno-canto は1秒に1リクエスト程度を目安としているので、既定ではそれに合わせる
+xeno_canto_rate_limiter = TokenBucket(
+    rate=float(os.getenv("XENO_CANTO_RATE_LIMIT", "1")),
+    burst=float(os.getenv("XENO_CANTO_RATE_BURST", "2")),
+)
+
+
+class XenoCantoClient(AsyncApiClient):
+    def __init__(self, base_url=None, **kwargs):
+        kwargs.setdefault('concurrency', int(os.getenv("XENO_CANTO_CONCURRENCY", "4")))
+        kwargs.setdefault('rate_limiter', xeno_canto_rate_limiter)
+        super().__init__(base_url or os.getenv("XENO_CANTO_API_URL", XENO_CANTO_API_URL), **kwargs)
+
+
+def ebird_get(path, params=None, **client_options):
+    # 同期コード（管理アクションなど）から1件取得する
+    async def run():
+        async with EBirdClient(**client_options) as client:
+            return await client.get_json(path, params)
+    return asyncio.run(run())
+
+
+def ebird_get_many(requests, **client_options):
+    # 同期コードから複数件を並行して取得する。{key: データまたは ApiError} を返す
+    async def run():
+        async with EBirdClient(**client_options) as client:
+            return await client.get_many(requests)
+    return asyncio.run(run())
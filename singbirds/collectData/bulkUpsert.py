@@ -0,0 +1,73 @@
+from decimal import Decimal
+from django.db import models, transaction
+
+UPSERT_BATCH_SIZE = 500
+
+
+def _normalize(field, value):
+    # DBから読み戻した値と比較できるよう、保存時と同じ型・精度に揃える
+    if value is None:
+        return None
+    if isinstance(field, models.ForeignKey):
+        return field.target_field.to_python(value)
+    value = field.to_python(value)
+    if isinstance(field, models.DecimalField):
+        value = value.quantize(Decimal(1).scaleb(-field.decimal_places))
+    return value
+
+
+def format_counts(counts):
+    return f"{counts['inserted']} inserted, {counts['updated']} updated, {counts['unchanged']} unchanged"
+
+
+def bulk_upsert(objs, key, fields, batch_size=UPSERT_BATCH_SIZE):
+    # 未保存のモデルインスタンスを key（一意なフィールド）で突き合わせ、新規は挿入・変更があれば更新する
+    # 同じ key のインスタンスが複数ある場合は後のものを使う
+    # 戻り値は (件数 {'inserted', 'updated', 'unchanged'}, 変更 [(以前の値の dict または None, インスタンス)])
+    # 以前の値の dict には主キーも含まれる
+    # bulk_create はシグナルを送らないため、集計などの後処理は呼び出し側で変更の一覧から行う
+    objs = list({getattr(obj, key): obj for obj in objs}.values())
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    changes = []
+    if not objs:
+        return counts, changes
+
+    model = type(objs[0])
+    opts = model._meta
+    compare = [opts.get_field(name) for name in fields]
+    attnames = [field.attname for field in compare]
+
+    for obj in objs:
+        for field in compare:
+            setattr(obj, field.attname, _normalize(field, getattr(obj, field.attname)))
+
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        existing = {
+            row[key]: row
+            for row in model.objects.filter(**{f'{key}__in': [getattr(obj, key) for obj in batch]})
+            .values(opts.pk.attname, key, *attnames)
+        }
+
+        to_write = []
+        for obj in batch:
+            old = existing.get(getattr(obj, key))
+            if old is None:
+                counts['inserted'] += 1
+            elif any(_normalize(field, old[field.attname]) != getattr(obj, field.attname) for field in compare):
+                counts['updated'] += 1
+            else:
+                counts['unchanged'] += 1
+                continue
+            to_write.append(obj)
+            changes.append((old, obj))
+
+        if to_write:
+            # 取得後に別の処理が同じ行を挿入していても、一意制約の衝突を更新として扱う
+            with transaction.atomic():
+                model.objects.bulk_create(
+                    to_write, batch_size=batch_size,
+                    update_conflicts=True, unique_fields=[key], update_fields=fields,
+                )
+
+    return counts, changes
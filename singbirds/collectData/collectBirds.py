@@ -1,43 +1,81 @@
-from django.contrib import admin
-from ..models import Country, Bird
-import requests
-from dotenv import load_dotenv
-import os
-
-load_dotenv()
-
-# 関数: 選択された国に基づいて鳥のデータを取得する
-def fetch_and_save_birds_by_country(country_code):
-    url = f"https://api.ebird.org/v2/data/obs/{country_code}/recent"
-    
-    api_token = os.getenv("ebirdToken")
-    
-    headers = {
-        "X-eBirdApiToken": api_token
-    }
-
-    params = {
-        "back": "30"
-    }
-
-    response = requests.get(url, headers=headers, params=params)
-
-    if response.status_code == 200:
-        species_list = response.json()
-        for species in species_list:
-            species_code = species['speciesCode']
-            sci_name = species['sciName']
-            com_name = species['comName']
-
-            # 既に存在しない場合のみ新しい鳥を作成
-            if not Bird.objects.filter(speciesCode=species_code).exists():
-                Bird.objects.create(
-                    speciesCode=species_code,
-                    sciName=sci_name,
-                    comName=com_name
-                )
-                print(f"Added: {com_name} ({sci_name})")
-            else:
-                print(f"Bird {com_name} already exists.")
-    else:
-        print(f"Failed to fetch data for {country_code}: {response.status_code}")
+import logging
+from django.utils import timezone
+from ..models import Bird
+from ..api_cache import bump_data_version
+from ..random_details import invalidate_detail_index
+from ..jobs import Progress
+from ..sync_state import EBIRD_BIRDS, MAX_BACK_DAYS, back_days, is_unchanged, load_sync_states, record_syncs, response_hash
+from .apiClient import ApiError, ebird_get_many
+from .bulkUpsert import bulk_upsert, format_counts
+
+logger = logging.getLogger(__name__)
+
+
+def save_birds(species_list):
+    # 戻り値は {'inserted', 'updated', 'unchanged'} の件数
+    counts, changes = bulk_upsert(
+        (
+            Bird(speciesCode=species['speciesCode'], sciName=species['sciName'], comName=species['comName'])
+            for species in species_list
+        ),
+        key='speciesCode',
+        fields=['sciName', 'comName'],
+    )
+
+    for old, bird in changes:
+        logger.info(f"{'Added' if old is None else 'Updated'} bird: {bird.comName} ({bird.sciName})")
+
+    # 名前が変わった鳥はランダム選択用のキャッシュにも反映する
+    updated_ids = [old['bird_id'] for old, bird in changes if old is not None]
+    if updated_ids:
+        invalidate_detail_index(updated_ids)
+    return counts
+
+
+# 関数: 選択された国に基づいて鳥のデータを取得する（複数の国は並行して取得）
+# 前回の同期以降の観察だけを取得する（未同期か full=True の場合は過去30日分）
+# 戻り値は ({countryCode: 件数}, {countryCode: エラーメッセージ})
+def fetch_and_save_birds_for_countries(country_codes, full=False, progress=None):
+    progress = progress or Progress()
+    progress.set_total(len(country_codes))
+    started_at = timezone.now()
+    states = {} if full else load_sync_states(EBIRD_BIRDS, country_codes)
+
+    results = ebird_get_many([
+        (
+            country_code,
+            f"data/obs/{country_code}/recent",
+            {"back": str(back_days(states.get(country_code), started_at) or MAX_BACK_DAYS)},
+        )
+        for country_code in country_codes
+    ])
+
+    counts, errors, synced = {}, {}, {}
+    for country_code, species_list in results.items():
+        if isinstance(species_list, ApiError):
+            progress.error(f"Failed to fetch data for {country_code}: {species_list.status}")
+            errors[country_code] = str(species_list)
+            progress.advance()
+            continue
+
+        # 前回と同じレスポンスなら保存を省略する
+        data_hash = response_hash(species_list)
+        if is_unchanged(states.get(country_code), data_hash):
+            counts[country_code] = {'inserted': 0, 'updated': 0, 'unchanged': len(species_list)}
+        else:
+            counts[country_code] = save_birds(species_list)
+        changed = counts[country_code]['inserted'] + counts[country_code]['updated']
+        synced[country_code] = (data_hash, len(species_list), changed)
+        progress.info(f"Birds for {country_code}: {format_counts(counts[country_code])}")
+        progress.advance()
+
+    record_syncs(EBIRD_BIRDS, synced, started_at)
+
+    # 公開APIのキャッシュを無効化
+    if any(c['inserted'] or c['updated'] for c in counts.values()):
+        bump_data_version()
+    return counts, errors
+
+
+def fetch_and_save_birds_by_country(country_code, full=False):
+    return fetch_and_save_birds_for_countries([country_code], full=full)
\ No newline at end of file
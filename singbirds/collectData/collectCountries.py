@@ -1,36 +1,47 @@
-import requests
-import os
+import logging
+from django.utils import timezone
 from ..models import Country
-from dotenv import load_dotenv
-
-
-load_dotenv()
-
-
-def fetch_and_save_countries():
-    url = "https://api.ebird.org/v2/ref/region/list"
-    api_token = os.getenv("ebirdToken")
-
-    headers = {
-        "X-eBirdApiToken": api_token
-    }
-
-    response = requests.get(url, headers=headers)
-
-    if response.status_code == 200:
-        countries = response.json()
-
-        for country_data in countries:
-            country_code = country_data['code']
-            country_name = country_data['name']
-
-            if not Country.objects.filter(countryCode=country_code).exists():
-                Country.objects.create(
-                    countryCode=country_code,
-                    country_name=country_name
-                )
-                print(f"Added: {country_name}")
-            else:
-                print(f"Country {country_name} already exists.")
-    else:
-        print(f"Failed to fetch data: {response.status_code}")
\ No newline at end of file
+from ..api_cache import bump_data_version
+from ..jobs import Progress
+from ..sync_state import EBIRD_COUNTRIES, is_unchanged, load_sync_states, record_syncs, response_hash
+from .apiClient import ApiError, ebird_get
+from .bulkUpsert import bulk_upsert, format_counts
+
+logger = logging.getLogger(__name__)
+
+SYNC_SCOPE = 'world'
+
+
+def fetch_and_save_countries(progress=None):
+    # 戻り値は {'inserted', 'updated', 'unchanged'} の件数（取得に失敗した場合は None）
+    progress = progress or Progress()
+    started_at = timezone.now()
+    try:
+        countries = ebird_get("ref/region/list")
+    except ApiError as e:
+        progress.error(f"Failed to fetch data: {e.status}")
+        return None
+
+    # 前回と同じレスポンスなら保存を省略する
+    data_hash = response_hash(countries)
+    if is_unchanged(load_sync_states(EBIRD_COUNTRIES, [SYNC_SCOPE]).get(SYNC_SCOPE), data_hash):
+        record_syncs(EBIRD_COUNTRIES, {SYNC_SCOPE: (data_hash, len(countries), 0)}, started_at)
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': len(countries)}
+        progress.info(f"Countries: {format_counts(counts)}")
+        return counts
+
+    counts, changes = bulk_upsert(
+        (Country(countryCode=country_data['code'], country_name=country_data['name']) for country_data in countries),
+        key='countryCode',
+        fields=['country_name'],
+    )
+    for old, country in changes:
+        logger.info(f"{'Added' if old is None else 'Updated'} country: {country.country_name}")
+    progress.info(f"Countries: {format_counts(counts)}")
+
+    record_syncs(EBIRD_COUNTRIES, {SYNC_SCOPE: (data_hash, len(countries), len(changes))}, started_at)
+
+    # 公開APIのキャッシュを無効化
+    if changes:
+        bump_data_version()
+    return counts
\ No newline at end of file
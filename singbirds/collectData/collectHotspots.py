@@ -1,77 +1,127 @@
-import requests
 from ..models import Hotspot, Country
-from dotenv import load_dotenv
-import os
+from ..hotspot_clusters import update_changed_hotspot_clusters
+from ..hotspot_summary import cluster_point, valid_bird_counts
+from ..api_cache import bump_data_version
+from ..spatial import grid_cell_for
+from .apiClient import ApiError, ebird_get_many
+from .bulkUpsert import bulk_upsert, format_counts
+from django.utils import timezone
+from ..jobs import Progress
+from ..sync_state import EBIRD_HOTSPOTS, back_days, is_unchanged, load_sync_states, record_syncs, response_hash
 import logging 
 
 logger = logging.getLogger(__name__)
-load_dotenv()
-
-def fetch_and_save_hotspots_by_country(country_code):
-    url = f"https://api.ebird.org/v2/ref/hotspot/{country_code}"
-
-    # APIトークンを.envから取得
-    api_token = os.getenv("ebirdToken")
-
-    headers = {
-        "X-eBirdApiToken": api_token
-    }
-
-    logger.debug(f"Using API token: {api_token}")
-    logger.debug(f"Country code: {country_code}")
-    logger.debug(f"Request URL: {url}")
-
-    params = {
-        "fmt": "json",
-    }
-
-    try:
-        response = requests.get(url, headers=headers, params=params)
-        
-        # レスポンスが成功した場合
-        if response.status_code == 200:
-            hotspots = response.json()
-
-            # Country テーブルから国情報を取得または作成
-            country, created = Country.objects.get_or_create(
-                countryCode=country_code,
-                defaults={"country_name": country_code}  # 必要であれば別途カスタムで国名を設定可能
-            )
-
-            for hotspot_data in hotspots:
-                loc_id = hotspot_data['locId']
-                loc_name = hotspot_data['locName']
-                subnational_code = hotspot_data.get('subnationalCode', '') 
-                lat = hotspot_data.get('lat', None)
-                lng = hotspot_data.get('lng', None)
-                latest_obs_date = hotspot_data.get('latestObsDate', None)
-                num_sp_all_time = hotspot_data.get('numSpeciesAllTime', 0)
-
-                if not Hotspot.objects.filter(locId=loc_id).exists():
-                    Hotspot.objects.create(
-                        locId=loc_id,
-                        locName=loc_name,
-                        countrycode=country,
-                        subnationalCode=subnational_code,
-                        lat=lat,
-                        lng=lng,
-                        latestObsDate=latest_obs_date,
-                        numSpAllTime=num_sp_all_time
-                    )
-                    logger.info(f"Added hotspot: {loc_name}")
-                else:
-                    logger.info(f"Hotspot {loc_name} already exists.")
+
+# API から更新するフィールド（valid_bird_count などの集計値は含めない）
+HOTSPOT_FIELDS = [
+    'locName', 'countrycode', 'subnationalCode', 'lat', 'lng',
+    'latestObsDate', 'numSpAllTime', 'grid_cell',
+]
+
+
+def hotspot_request(country_code, back=None):
+    params = {"fmt": "json"}
+    if back:
+        # 指定した日数以内に観察のあったホットスポットだけを取得する
+        params["back"] = back
+    return country_code, f"ref/hotspot/{country_code}", params
+
+
+def _hotspot_from_api(hotspot_data, country):
+    lat = hotspot_data.get('lat', None)
+    lng = hotspot_data.get('lng', None)
+    # eBird は最終観察日時を 'YYYY-MM-DD HH:MM' 形式の latestObsDt で返す
+    latest_obs = hotspot_data.get('latestObsDt') or hotspot_data.get('latestObsDate')
+    return Hotspot(
+        locId=hotspot_data['locId'],
+        locName=hotspot_data['locName'],
+        countrycode=country,
+        subnationalCode=hotspot_data.get('subnationalCode') or hotspot_data.get('subnational1Code', ''),
+        lat=lat,
+        lng=lng,
+        latestObsDate=latest_obs[:10] if latest_obs else None,
+        numSpAllTime=hotspot_data.get('numSpeciesAllTime', 0),
+        # bulk_create では pre_save シグナルが呼ばれないため、ここでセル番号を設定する
+        grid_cell=grid_cell_for(lat, lng),
+    )
+
+
+def save_hotspots(country_code, hotspots):
+    # 戻り値は {'inserted', 'updated', 'unchanged'} の件数
+    # Country テーブルから国情報を取得または作成
+    country, created = Country.objects.get_or_create(
+        countryCode=country_code,
+        defaults={"country_name": country_code}  # 必要であれば別途カスタムで国名を設定可能
+    )
+
+    counts, changes = bulk_upsert(
+        (_hotspot_from_api(hotspot_data, country) for hotspot_data in hotspots),
+        key='locId',
+        fields=HOTSPOT_FIELDS,
+    )
+
+    # クラスタ（タイルピラミッド）の差分。表示対象のホットスポットの位置や種数が変わったら古い値を引いて新しい値を足す
+    # 新しいホットスポットはまだ録音を持つ鳥が紐づいていないので、表示対象になった時点で hotspot_summary が追加する
+    counts_by_id = valid_bird_counts([old['hotspot_id'] for old, _ in changes if old is not None])
+    cluster_changes = []
+    for old, hotspot in changes:
+        if old is None:
+            logger.info(f"Added hotspot: {hotspot.locName}")
+            continue
+
+        valid_count = counts_by_id.get(old['hotspot_id'], 0)
+        cluster_changes.append((
+            cluster_point(old['lat'], old['lng'], old['numSpAllTime'], valid_count),
+            cluster_point(hotspot.lat, hotspot.lng, hotspot.numSpAllTime, valid_count),
+        ))
+        logger.info(f"Updated hotspot: {hotspot.locName}")
+
+    update_changed_hotspot_clusters(cluster_changes)
+
+    return counts
+
+
+def fetch_and_save_hotspots_for_countries(country_codes, full=False, progress=None):
+    # 複数の国のホットスポットを並行して取得し、国ごとに保存する
+    # 前回の同期が30日以内の国は、それ以降に観察のあったホットスポットだけを取得する（full=True で全件）
+    # 戻り値は ({countryCode: 件数}, {countryCode: エラーメッセージ})
+    logger.debug(f"Country codes: {country_codes}")
+    progress = progress or Progress()
+    progress.set_total(len(country_codes))
+    started_at = timezone.now()
+    states = {} if full else load_sync_states(EBIRD_HOTSPOTS, country_codes)
+    results = ebird_get_many([
+        hotspot_request(country_code, back_days(states.get(country_code), started_at))
+        for country_code in country_codes
+    ])
+
+    counts, errors, synced = {}, {}, {}
+    for country_code, hotspots in results.items():
+        if isinstance(hotspots, ApiError):
+            # APIが返した詳細なエラー内容を記録
+            progress.error(f"Failed to fetch data for {country_code}: {hotspots}")
+            errors[country_code] = str(hotspots)
+            progress.advance()
+            continue
+
+        # 前回と同じレスポンスなら保存を省略する
+        data_hash = response_hash(hotspots)
+        if is_unchanged(states.get(country_code), data_hash):
+            counts[country_code] = {'inserted': 0, 'updated': 0, 'unchanged': len(hotspots)}
         else:
-            # エラーメッセージを出力（APIが返した詳細なエラー内容を表示）
-            logger.error(f"Failed to fetch data for {country_code}: {response.status_code}")
-            try:
-                # JSONエラーの詳細を取得
-                error_details = response.json()
-                logger.error("Error details:", error_details)
-            except ValueError:
-                # JSONでない場合はテキストとして表示
-                logger.error("Error details:", response.text)
-
-    except requests.exceptions.RequestException as e:
-        # ネットワークエラーやリクエストエラーの詳細を表示
-        logger.error(f"An error occurred while fetching data for {country_code}: {str(e)}")
\ No newline at end of file
+            counts[country_code] = save_hotspots(country_code, hotspots)
+        changed = counts[country_code]['inserted'] + counts[country_code]['updated']
+        synced[country_code] = (data_hash, len(hotspots), changed)
+        progress.info(f"Hotspots for {country_code}: {format_counts(counts[country_code])}")
+        progress.advance()
+
+    record_syncs(EBIRD_HOTSPOTS, synced, started_at)
+
+    # 公開APIのキャッシュを無効化
+    if any(c['inserted'] or c['updated'] for c in counts.values()):
+        bump_data_version()
+    return counts, errors
+
+
+def fetch_and_save_hotspots_by_country(country_code, full=False):
+    return fetch_and_save_hotspots_for_countries([country_code], full=full)
\ No newline at end of file
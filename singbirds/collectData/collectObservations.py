@@ -1,64 +1,150 @@
-import requests
-from ..models import Bird, Hotspot
-from dotenv import load_dotenv
-import os
+from collections import Counter
+from django.utils import timezone
+from ..models import Bird
+from ..api_cache import bump_data_version
+from ..hotspot_summary import refresh_valid_bird_counts
+from ..jobs import Progress, enqueue_admin_job
+from ..sync_state import EBIRD_OBSERVATIONS, MAX_BACK_DAYS, back_days, is_unchanged, load_sync_states, record_syncs, response_hash, since_date
+from .apiClient import ApiError, ebird_get_many
 from django.contrib import admin
 import logging
 
-# 環境変数をロード
-load_dotenv()
-
 # ロガーの設定
 logger = logging.getLogger("app")
 
+# 一度に並行取得するホットスポット数（取得結果をメモリに溜めすぎないよう分割する）
+FETCH_CHUNK_SIZE = 200
+
+
+# 一度に問い合わせる speciesCode の数（SQLのパラメータ数制限対策）
+LOOKUP_BATCH_SIZE = 500
+
+
+def _bird_ids_by_code(species_codes):
+    bird_ids = {}
+    species_codes = list(species_codes)
+    for start in range(0, len(species_codes), LOOKUP_BATCH_SIZE):
+        bird_ids.update(
+            Bird.objects.filter(speciesCode__in=species_codes[start:start + LOOKUP_BATCH_SIZE])
+            .values_list('speciesCode', 'bird_id')
+        )
+    return bird_ids
+
+
+def save_observations(observations):
+    # observations は {Hotspot: 観察データの配列}
+    # ホットスポット数によらず、まとめて数回のクエリで鳥の作成と紐付けを行う
+    # 戻り値は (新しく作成した鳥の数, {hotspot_id: 新しく追加した紐付けの数})
+    species = {}
+    for bird_data in observations.values():
+        for bird_data_entry in bird_data:
+            species.setdefault(bird_data_entry['speciesCode'], bird_data_entry)
+
+    # 未登録の鳥を一括作成する
+    bird_ids = _bird_ids_by_code(species)
+    missing = [
+        Bird(
+            speciesCode=species_code,
+            comName=entry.get('comName', 'Unknown'),
+            sciName=entry.get('sciName', 'Unknown'),
+        )
+        for species_code, entry in species.items() if species_code not in bird_ids
+    ]
+    if missing:
+        Bird.objects.bulk_create(missing, batch_size=LOOKUP_BATCH_SIZE, ignore_conflicts=True)
+        bird_ids.update(_bird_ids_by_code(bird.speciesCode for bird in missing))
+
+    # 既存の紐付けを除いて、中間テーブルに一括挿入する
+    through = Bird.hotspots.through
+    hotspot_ids = [hotspot.hotspot_id for hotspot in observations]
+    existing = set(
+        through.objects.filter(hotspot_id__in=hotspot_ids).values_list('hotspot_id', 'bird_id')
+    )
+    links = {
+        (hotspot.hotspot_id, bird_ids[bird_data_entry['speciesCode']])
+        for hotspot, bird_data in observations.items()
+        for bird_data_entry in bird_data
+    } - existing
+    through.objects.bulk_create(
+        [through(hotspot_id=hotspot_id, bird_id=bird_id) for hotspot_id, bird_id in links],
+        batch_size=LOOKUP_BATCH_SIZE, ignore_conflicts=True,
+    )
+
+    # bulk_create では m2m_changed が飛ばないため、紐付けが増えたホットスポットの集計を更新する
+    refresh_valid_bird_counts({hotspot_id for hotspot_id, _ in links})
+    return len(missing), Counter(hotspot_id for hotspot_id, _ in links)
+
+
+def _needs_fetch(hotspot, state):
+    # ホットスポットの最終観察日が前回の同期より前なら、新しい観察はないので取得しない
+    # （latestObsDate はホットスポットの同期で更新されるため、先にホットスポットを同期しておく）
+    # latestObsDate は現地の日付で last_synced_at は UTC なので、取得する範囲と同じく1日重ねて比べる
+    if state is None or hotspot.latestObsDate is None:
+        return True
+    return hotspot.latestObsDate >= since_date(state)
+
+
+def fetch_observations_for_hotspots(hotspots, full=False, progress=None):
+    # ホットスポットごとに前回の同期以降の観察を取得し、鳥との紐付けを追加する
+    # 未同期か full=True の場合は過去30日分を取得する
+    # 戻り値は (集計 {'fetched', 'skipped', 'created_birds', 'added_links'}, {locId: エラーメッセージ})
+    progress = progress or Progress()
+    started_at = timezone.now()
+    hotspots = list(hotspots)
+    progress.set_total(len(hotspots))
+    states = {} if full else load_sync_states(EBIRD_OBSERVATIONS, [hotspot.locId for hotspot in hotspots])
+    totals = {'fetched': 0, 'skipped': 0, 'created_birds': 0, 'added_links': 0}
+    errors = {}
+
+    targets = [hotspot for hotspot in hotspots if _needs_fetch(hotspot, states.get(hotspot.locId))]
+    totals['skipped'] = len(hotspots) - len(targets)
+    progress.advance(totals['skipped'])
+
+    for start in range(0, len(targets), FETCH_CHUNK_SIZE):
+        chunk = {hotspot.locId: hotspot for hotspot in targets[start:start + FETCH_CHUNK_SIZE]}
+        results = ebird_get_many([
+            (loc_id, f"data/obs/{loc_id}/recent", {'back': back_days(states.get(loc_id), started_at) or MAX_BACK_DAYS})
+            for loc_id in chunk
+        ])
+
+        # 選択されたホットスポットに対して処理を実行
+        observations, synced = {}, {}
+        for loc_id, bird_data in results.items():
+            hotspot = chunk[loc_id]
+            if isinstance(bird_data, ApiError):
+                progress.error(f"Failed to fetch data for hotspot {hotspot.locName}: {bird_data}")
+                errors[loc_id] = str(bird_data)
+                continue
+
+            totals['fetched'] += 1
+            data_hash = response_hash(bird_data)
+            synced[loc_id] = (data_hash, len(bird_data), 0)
+
+            # データが空か、前回と同じレスポンスの場合は処理をスキップ
+            if not bird_data or is_unchanged(states.get(loc_id), data_hash):
+                logger.info(f"No new bird data for hotspot {hotspot.locId} ({hotspot.locName})")
+                continue
+
+            observations[hotspot] = bird_data
+
+        created_birds, added_links = save_observations(observations)
+        totals['created_birds'] += created_birds
+        totals['added_links'] += sum(added_links.values())
+        progress.info(f"Linked {sum(added_links.values())} birds to {len(observations)} hotspots ({created_birds} new birds)")
+
+        for hotspot in observations:
+            data_hash, item_count, _ = synced[hotspot.locId]
+            synced[hotspot.locId] = (data_hash, item_count, added_links[hotspot.hotspot_id])
+
+        record_syncs(EBIRD_OBSERVATIONS, synced, started_at)
+        progress.advance(len(chunk))
+
+    # 公開APIのキャッシュを無効化
+    if totals['created_birds'] or totals['added_links']:
+        bump_data_version()
+    return totals, errors
+
+
 @admin.action(description="選択したホットスポットの情報を取得し鳥データを更新")
 def fetch_birds_for_selected_hotspots(modeladmin, request, queryset):
-    url_template = "https://api.ebird.org/v2/data/obs/{}/recent"
-    
-    # API トークンを環境変数から取得
-    api_token = os.getenv("ebirdToken")
-    headers = {
-        "X-eBirdApiToken": api_token
-    }
-
-    # 選択されたホットスポットに対して処理を実行
-    for hotspot in queryset:
-        url = url_template.format(hotspot.locId)
-        params = {
-            'back': 30  # 過去30日分のデータを取得
-        }
-
-        response = requests.get(url, headers=headers, params=params)
-        
-        # ステータスコードとレスポンスをロギング
-        logger.info(f"Fetching data from URL: {url}")
-        logger.info(f"Status Code: {response.status_code}")
-        
-        if response.status_code == 200:
-            bird_data = response.json()
-
-            # データが空の場合は処理をスキップ
-            if not bird_data:
-                logger.info(f"No bird data found for hotspot {hotspot.locId} ({hotspot.locName})")
-                continue  # データがない場合は次のホットスポットに進む
-
-            for bird_data_entry in bird_data:
-                species_code = bird_data_entry['speciesCode']
-                com_name = bird_data_entry.get('comName', 'Unknown')
-                sci_name = bird_data_entry.get('sciName', 'Unknown')
-
-                # 鳥の speciesCode を基に Bird モデルを更新
-                bird_obj, created = Bird.objects.get_or_create(
-                    speciesCode=species_code,
-                    defaults={
-                        'comName': com_name,
-                        'sciName': sci_name,
-                    }
-                )
-
-                # ホットスポットと鳥の関係を更新
-                bird_obj.hotspots.add(hotspot)
-                logger.info(f"Added {com_name} to hotspot {hotspot.locName}")
-        else:
-            modeladmin.message_user(request, f"Failed to fetch data for hotspot {hotspot.locName}: {response.status_code}", level='error')
-            logger.error(f"Failed to fetch data for hotspot {hotspot.locName}: {response.status_code}")
\ No newline at end of file
+    enqueue_admin_job(modeladmin, request, 'fetch_observations', hotspot_ids=list(queryset.values_list('pk', flat=True)))
\ No newline at end of file
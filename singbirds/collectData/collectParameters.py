@@ -1,135 +1,153 @@
 from django.contrib import admin
 from django.db import transaction
 from ..models import BirdDetail, AcousticParameters, Bird
-import librosa
-import requests
-from io import BytesIO
+from ..similarity import INDEX_FIELDS, add_to_similarity_index
+from ..jobs import Progress, enqueue_admin_job
+from .createSpectrogram import replace_file
+from .featureEngine import features_from_file
+from .recordingPipeline import compute_workers, run_recording_pipeline
 import json
-import numpy as np
-import concurrent.futures
-
-# 音響特徴量を抽出する関数（無音部分を除去）
-# 音響特徴量を抽出する関数（無音部分を除去してトリム）
-def extract_features(audio_data, sr, silence_threshold=0.01):
-    # 無音部分の除去: librosa.effects.splitで無音区間を除去
-    non_silent_intervals = librosa.effects.split(audio_data, top_db=30)  # Adjust top_db to control silence sensitivity
-
-    # 有音区間を結合して新しい音声データを作成
-    trimmed_audio = np.concatenate([audio_data[start:end] for start, end in non_silent_intervals])
-
-    # MFCC特徴量の抽出
-    mfccs = librosa.feature.mfcc(y=trimmed_audio, sr=sr, n_mfcc=13)
-    mfccs_mean = np.mean(mfccs, axis=1).astype(np.float16).tolist()
-    
-    # Chroma特徴量
-    chroma_stft = librosa.feature.chroma_stft(y=trimmed_audio, sr=sr)
-    chroma_mean = np.mean(chroma_stft, axis=1).astype(np.float16).tolist()
-    
-    # スペクトル帯域幅
-    spectral_bandwidth = np.mean(librosa.feature.spectral_bandwidth(y=trimmed_audio, sr=sr)).item()
-    
-    # スペクトルコントラスト
-    spectral_contrast = librosa.feature.spectral_contrast(y=trimmed_audio, sr=sr)
-    spectral_contrast_mean = np.mean(spectral_contrast, axis=1).astype(np.float16).tolist()
-    
-    # スペクトルフラットネス
-    spectral_flatness = np.mean(librosa.feature.spectral_flatness(y=trimmed_audio)).item()
-    
-    # RMSエネルギー
-    rms_energy = np.mean(librosa.feature.rms(y=trimmed_audio)).item()
-    
-    # ゼロ交差率
-    zero_crossing_rate = np.mean(librosa.feature.zero_crossing_rate(y=trimmed_audio)).item()
-    
-    # スペクトル中心
-    spectral_centroid = np.mean(librosa.feature.spectral_centroid(y=trimmed_audio, sr=sr)).item()
-    
-    # スペクトルロールオフ
-    spectral_rolloff = np.mean(librosa.feature.spectral_rolloff(y=trimmed_audio, sr=sr)).item()
-    
-    # 抽出した特徴量を辞書として返す
-    return {
-        "mfcc_features": mfccs_mean,
-        "chroma_features": chroma_mean,
-        "spectral_bandwidth": spectral_bandwidth,
-        "spectral_contrast": spectral_contrast_mean,
-        "spectral_flatness": spectral_flatness,
-        "rms_energy": rms_energy,
-        "zero_crossing_rate": zero_crossing_rate,
-        "spectral_centroid": spectral_centroid,
-        "spectral_rolloff": spectral_rolloff
-    }
-
-# BirdDetailごとに音声データを処理する関数
-def process_bird_detail(bird_detail):
+
+# フレームごとの特徴量のファイル名（作り直しても同じ名前にする）
+def frame_features_name(detail_id):
+    return f"frame_features_{detail_id}.npy"
+
+# 抽出した特徴量からAcousticParametersのインスタンスを作成する
+# frame_data（フレームごとの特徴量の .npy）は、行を保存できてから save_acoustic_parameters がストレージに書き込む
+def build_acoustic_parameters(detail_id, bird_id, features, frame_data=None):
+    acoustic_parameters = AcousticParameters(
+        bird_id_id=bird_id,
+        birddetail_id_id=detail_id,
+        mfcc_features=json.dumps(features['mfcc_features']),
+        chroma_features=json.dumps(features['chroma_features']),
+        spectral_bandwidth=features['spectral_bandwidth'],
+        spectral_contrast=json.dumps(features['spectral_contrast']),
+        spectral_flatness=features['spectral_flatness'],
+        rms_energy=features['rms_energy'],
+        zero_crossing_rate=features['zero_crossing_rate'],
+        spectral_centroid=features['spectral_centroid'],
+        spectral_rolloff=features['spectral_rolloff']
+    )
+    acoustic_parameters.frame_data = frame_data
+    return acoustic_parameters
+
+# 保存したAcousticParametersのフレームごとの特徴量をストレージに書き込み、frame_features をまとめて更新する
+# 書き込めなかったものは frame_features を空のままにする（平均値などは保存済み）
+def save_frame_features(acoustic_parameters, progress):
+    written = []
+    for parameters in acoustic_parameters:
+        if getattr(parameters, 'frame_data', None) is None:
+            continue
+        try:
+            replace_file(parameters.frame_features, frame_features_name(parameters.birddetail_id_id), parameters.frame_data)
+        except Exception as e:
+            progress.error(f'Failed to save frame features for BirdDetail ID {parameters.birddetail_id_id}: {e}')
+            continue
+        finally:
+            # 書き込み後はバイト列を持ち続けない
+            parameters.frame_data = None
+        written.append(parameters)
+    if written:
+        AcousticParameters.objects.bulk_update(written, ['frame_features'])
+
+# 類似検索の索引に追加するAcousticParametersを読み込み直す件数
+INDEX_QUERY_BATCH_SIZE = 500
+
+# 保存したAcousticParameters（主キーのリスト）を類似検索の索引に追加する（失敗しても保存済みのデータには影響させない）
+# 索引は全体を保存し直すので、ジョブの最後にまとめて呼び出す
+# インスタンスをジョブの最後まで持たないよう、索引に必要なフィールドだけを少しずつ読み込み直す
+def update_similarity_index(parameter_ids, progress):
+    if not parameter_ids:
+        return
+    records = (
+        record
+        for start in range(0, len(parameter_ids), INDEX_QUERY_BATCH_SIZE)
+        for record in AcousticParameters.objects.filter(
+            pk__in=parameter_ids[start:start + INDEX_QUERY_BATCH_SIZE]
+        ).only(*INDEX_FIELDS)
+    )
     try:
-        # recording_urlから音声データをダウンロード
-        response = requests.get(bird_detail.recording_url)
-        response.raise_for_status()
-
-        # librosaで音声データを読み込む
-        audio_data, sr = librosa.load(BytesIO(response.content), sr=16000)  # 16kHz sampling
-
-        # 音響特徴量の抽出（無音部分の除去）
-        features = extract_features(audio_data, sr)
-
-        # AcousticParametersインスタンスを作成
-        acoustic_param = AcousticParameters(
-            bird_id=bird_detail.bird_id,
-            birddetail_id=bird_detail,
-            mfcc_features=json.dumps(features['mfcc_features']),
-            chroma_features=json.dumps(features['chroma_features']),
-            spectral_bandwidth=features['spectral_bandwidth'],
-            spectral_contrast=json.dumps(features['spectral_contrast']),
-            spectral_flatness=features['spectral_flatness'],
-            rms_energy=features['rms_energy'],
-            zero_crossing_rate=features['zero_crossing_rate'],
-            spectral_centroid=features['spectral_centroid'],
-            spectral_rolloff=features['spectral_rolloff']
-        )
-        return acoustic_param, None  # 正常に処理できた場合
+        add_to_similarity_index(records)
+    except Exception as e:
+        progress.error(f'Failed to update similarity index: {e}')
 
+# AcousticParametersをバルクで保存する。保存した件数を返す
+# saved にリストを渡すと、保存できたものの主キーを追加する（update_similarity_index に渡す）
+def save_acoustic_parameters(acoustic_parameters, progress, saved=None):
+    try:
+        AcousticParameters.objects.bulk_create(acoustic_parameters)
     except Exception as e:
-        return None, f'Failed to process BirdDetail ID {bird_detail.birddetail_id}: {e}'  # エラー発生時
+        progress.error(f'Failed to bulk insert: {e}')
+        return 0
+    save_frame_features(acoustic_parameters, progress)
+    progress.info(f'Successfully processed {len(acoustic_parameters)} records')
+    if saved is not None:
+        saved.extend(parameters.pk for parameters in acoustic_parameters)
+    return len(acoustic_parameters)
 
-# 選択されたBirdDetailの録音から特徴量を抽出し、AcousticParametersにバルクで保存するアクション
-@admin.action(description='Extract acoustic features for selected BirdDetails')
-def sync_extract_acoustic_features(modeladmin, request, queryset):
+# BirdDetailのクエリセットの録音から特徴量を抽出し、AcousticParametersにバルクで保存する
+# ダウンロードはスレッド、デコードと特徴量の計算はプロセスプール、保存はこのスレッドでまとめて行う
+# 抽出済みのBirdDetailは処理しない（作り直す場合は AcousticParameters を削除してから実行する）
+# 戻り値は {'saved', 'skipped', 'failed', 'max_recording_mb', 'peak_worker_rss_mb'}
+def extract_acoustic_features(bird_details, progress=None):
+    progress = progress or Progress()
+    total = bird_details.count()
+    progress.set_total(total)
     acoustic_parameters_to_create = []  # バルクインサート用のリスト
-    errors = []  # エラーメッセージを格納するリスト
+    saved_ids = []  # 類似検索の索引に追加するものの主キー
+    counts = {'saved': 0, 'skipped': 0, 'failed': 0}
+
+    targets = bird_details.filter(acousticparameters__isnull=True)
+    counts['skipped'] = total - targets.count()
+    progress.advance(counts['skipped'])
+
     batch_size = 100  # バッチサイズの設定
+    memory = {'count': 0, 'total': 0, 'max': 0, 'peak_rss': 0}  # 録音ごとのデコード時の使用メモリの見積もり
 
-    # 並列処理で音響特徴量を抽出
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_bird_detail, bird_detail) for bird_detail in queryset]
+    def on_result(key, result):
+        nonlocal acoustic_parameters_to_create
+        features, frame_data, memory_bytes, peak_rss = result
+        memory['count'] += 1
+        memory['total'] += memory_bytes
+        memory['max'] = max(memory['max'], memory_bytes)
+        memory['peak_rss'] = max(memory['peak_rss'], peak_rss)
+        acoustic_parameters_to_create.append(build_acoustic_parameters(*key, features, frame_data))
 
-        for future in concurrent.futures.as_completed(futures):
-            result, error = future.result()
-            if result:
-                acoustic_parameters_to_create.append(result)
-                print(f"Appended: {len(acoustic_parameters_to_create)} records")
+        # バッチサイズに達したらデータベースに保存
+        if len(acoustic_parameters_to_create) >= batch_size:
+            counts['saved'] += save_acoustic_parameters(acoustic_parameters_to_create, progress, saved_ids)
+            acoustic_parameters_to_create = []  # 保存後にリストをクリア
+        progress.advance()
 
-                # バッチサイズに達したらデータベースに保存
-                if len(acoustic_parameters_to_create) >= batch_size:
-                    try:
-                        AcousticParameters.objects.bulk_create(acoustic_parameters_to_create)
-                        print(f'Successfully processed {len(acoustic_parameters_to_create)} records')
-                        acoustic_parameters_to_create = []  # 保存後にリストをクリア
-                    except Exception as e:
-                        print(f'Failed to bulk insert: {e}')
+    def on_error(key, error):
+        counts['failed'] += 1
+        progress.error(f'Failed to process BirdDetail ID {key[0]}: {error}')  # エラーメッセージを記録
+        progress.advance()
 
-            if error:
-                errors.append(error)  # エラーメッセージを格納
+    rows = (
+        ((detail_id, bird_id), url)
+        for detail_id, bird_id, url in targets.values_list('birddetail_id', 'bird_id', 'recording_url').iterator(chunk_size=batch_size)
+    )
+    workers = compute_workers()
+    run_recording_pipeline(rows, features_from_file, on_result, on_error, workers=workers)
 
     # 最後に残っているレコードを保存（バッチサイズに満たない分）
     if acoustic_parameters_to_create:
-        try:
-            AcousticParameters.objects.bulk_create(acoustic_parameters_to_create)
-            print(f'Successfully processed {len(acoustic_parameters_to_create)} remaining records')
-        except Exception as e:
-            print(f'Failed to bulk insert: {e}')
+        counts['saved'] += save_acoustic_parameters(acoustic_parameters_to_create, progress, saved_ids)
+    update_similarity_index(saved_ids, progress)  # 類似検索の索引に追加
+
+    # 録音1件あたりの使用メモリと、ワーカーの最大 RSS を報告する
+    counts['max_recording_mb'] = round(memory['max'] / (1024 * 1024), 2)
+    counts['peak_worker_rss_mb'] = round(memory['peak_rss'] / (1024 * 1024), 2)
+    if memory['count']:
+        mean_mb = memory['total'] / memory['count'] / (1024 * 1024)
+        progress.info(
+            f"Decoded audio per recording: max {counts['max_recording_mb']:.2f} MB, mean {mean_mb:.2f} MB "
+            f"({workers} worker processes). Peak worker RSS: {counts['peak_worker_rss_mb']:.2f} MB"
+        )
+    return counts
 
-    # エラーがあれば表示
-    if errors:
-        for error in errors:
-            print(error)
\ No newline at end of file
+# 選択されたBirdDetailの特徴量抽出をジョブとして投入するアクション
+@admin.action(description='Extract acoustic features for selected BirdDetails')
+def sync_extract_acoustic_features(modeladmin, request, queryset):
+    enqueue_admin_job(modeladmin, request, 'extract_acoustic_features', detail_ids=list(queryset.values_list('pk', flat=True)))
\ No newline at end of file
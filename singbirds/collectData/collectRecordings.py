@@ -1,81 +1,153 @@
 from django.contrib import admin
-from ..models import Bird, BirdDetail
-import requests
-import time
+from django.db.models import Count
+from django.utils import timezone
+from ..models import BirdDetail
+from ..api_cache import bump_data_version
+from ..hotspot_summary import refresh_valid_bird_counts_for_birds
+from ..random_details import invalidate_detail_index
+from ..jobs import Progress, enqueue_admin_job
+from ..sync_state import XENO_CANTO_RECORDINGS, load_sync_states, record_syncs, response_hash, since_date
+from .apiClient import ApiError, XenoCantoClient
+import asyncio
 import logging
-import gc
-from django.db import connection
+import psutil
 
 # ロガーの設定
 logger = logging.getLogger("app")
 
-@admin.action(description="選択した鳥に対してXeno-Cantoの録音を取得")
-def fetch_xeno_canto_recordings(modeladmin, request, queryset):
-    base_url = "https://www.xeno-canto.org/api/2/recordings"
-
-    for bird in queryset:
-        query = bird.sciName
-        params = {
-            'query': f"{query} len:0-30 q:A"
-        }
-
-        logger.info(f"Requesting recordings for bird: {bird.comName} (Scientific name: {query})")
-
-        try:
-            response = requests.get(base_url, params=params, timeout=10)
-            response.raise_for_status()
-
-            response_size = len(response.content)
-            logger.info(f"Response size for {bird.comName}: {response_size} bytes")
-
-            process = psutil.Process()
-            mem_info = process.memory_info().rss / (1024 * 1024)
-            logger.info(f"Memory usage after request for {bird.comName}: {mem_info:.2f} MB")
-
-        except requests.RequestException as e:
-            error_message = f"Failed to fetch data for {bird.comName}: {e}"
-            logger.error(error_message)
-            modeladmin.message_user(request, error_message, level='error')
-            continue
+# 1種あたりに保存する録音数の上限
+MAX_RECORDINGS_PER_SPECIES = 10
+# 保存する録音の長さの上限（秒）と品質
+MAX_RECORDING_SECONDS = 30
+RECORDING_QUALITY = 'A'
+
+# 一度に並行して検索する鳥の数。結果は鳥ごとの URL だけを保持し、まとめて保存してから次に進む
+HARVEST_CHUNK_SIZE = 50
+
+
+def _length_seconds(length):
+    # Xeno-canto の長さ表記（'m:ss' または 'h:mm:ss'）を秒に変換する
+    seconds = 0
+    try:
+        for part in str(length).split(':'):
+            seconds = seconds * 60 + int(part)
+    except ValueError:
+        return None
+    return seconds
+
+
+def _is_wanted(recording):
+    # 検索クエリでも絞り込んでいるが、念のため品質・長さ・ファイルの有無を確認する
+    if recording.get('q') != RECORDING_QUALITY or not recording.get('file'):
+        return False
+    seconds = _length_seconds(recording.get('length', ''))
+    return seconds is not None and seconds <= MAX_RECORDING_SECONDS
+
+
+async def _search_recordings(client, bird, since, needed, known_urls):
+    # 1種分の録音をページを辿って検索し、まだ保存していない録音の URL を最大 needed 件返す
+    # 戻り値は (URL のリスト, 検索結果の件数)
+    query = f"{bird.sciName} len:0-{MAX_RECORDING_SECONDS} q:{RECORDING_QUALITY}"
+    if since is not None:
+        query += f" since:{since.isoformat()}"
+
+    urls, item_count = [], 0
+    page, num_pages = 1, 1
+    while page <= num_pages and len(urls) < needed:
+        data = await client.get_json('recordings', {'query': query, 'page': page})
+        num_pages = int(data.get('numPages') or 1)
+        for recording in data.get('recordings', []):
+            item_count += 1
+            url = recording.get('file')
+            if len(urls) < needed and _is_wanted(recording) and url not in known_urls and url not in urls:
+                urls.append(url)
+        page += 1
+    return urls, item_count
+
+
+async def _search_chunk(targets):
+    # targets は (bird, since, needed, known_urls) の列。{speciesCode: 結果または ApiError} を返す
+    async with XenoCantoClient() as client:
+        async def search(bird, since, needed, known_urls):
+            try:
+                return bird.speciesCode, await _search_recordings(client, bird, since, needed, known_urls)
+            except ApiError as e:
+                return bird.speciesCode, e
+
+        return dict(await asyncio.gather(*(search(*target) for target in targets)))
+
+
+def _existing_urls(birds):
+    urls = {bird.bird_id: set() for bird in birds}
+    for bird_id, url in BirdDetail.objects.filter(bird_id__in=list(urls)).values_list('bird_id', 'recording_url'):
+        urls[bird_id].add(url)
+    return urls
+
+
+def harvest_recordings(birds, full=False, per_species=MAX_RECORDINGS_PER_SPECIES, progress=None):
+    # birds は Bird のクエリセット。鳥ごとに Xeno-canto の録音を検索し、1種あたり per_species 件まで BirdDetail を一括作成する
+    # 前回の同期以降にアップロードされた録音だけを検索する（full=True で全期間）
+    # 戻り値は (集計 {'searched', 'skipped', 'added'}, {speciesCode: エラーメッセージ})
+    progress = progress or Progress()
+    birds = list(birds.annotate(recording_count=Count('birddetail')))
+    progress.set_total(len(birds))
+    totals = {'searched': 0, 'skipped': 0, 'added': 0}
+    errors = {}
+    process = psutil.Process()
+
+    # 既に上限まで録音がある鳥は検索しない
+    targets = [bird for bird in birds if bird.recording_count < per_species]
+    totals['skipped'] = len(birds) - len(targets)
+    progress.advance(totals['skipped'])
+
+    for start in range(0, len(targets), HARVEST_CHUNK_SIZE):
+        chunk = targets[start:start + HARVEST_CHUNK_SIZE]
+        started_at = timezone.now()
+        states = {} if full else load_sync_states(XENO_CANTO_RECORDINGS, [bird.speciesCode for bird in chunk])
+        known_urls = _existing_urls(chunk)
+
+        results = asyncio.run(_search_chunk([
+            (bird, since_date(states.get(bird.speciesCode)), per_species - bird.recording_count, known_urls[bird.bird_id])
+            for bird in chunk
+        ]))
+
+        details, synced = [], {}
+        for bird in chunk:
+            result = results[bird.speciesCode]
+            if isinstance(result, ApiError):
+                progress.error(f"Failed to fetch data for {bird.comName}: {result}")
+                errors[bird.speciesCode] = str(result)
+                continue
+
+            urls, item_count = result
+            totals['searched'] += 1
+            details.extend(BirdDetail(bird_id=bird, recording_url=url) for url in urls)
+            synced[bird.speciesCode] = (response_hash(urls), item_count, len(urls))
+            logger.info(f"Found {len(urls)} new recordings for {bird.comName} ({item_count} search results)")
+
+        BirdDetail.objects.bulk_create(details)
+        totals['added'] += len(details)
+
+        # bulk_create ではシグナルが呼ばれないため、集計とランダム選択用のキャッシュを更新する
+        added_bird_ids = {detail.bird_id_id for detail in details}
+        first_detail_ids = [bird.bird_id for bird in chunk if bird.bird_id in added_bird_ids and bird.recording_count == 0]
+        if first_detail_ids:
+            refresh_valid_bird_counts_for_birds(first_detail_ids)
+        if added_bird_ids:
+            invalidate_detail_index(added_bird_ids)
+
+        record_syncs(XENO_CANTO_RECORDINGS, synced, started_at)
+
+        mem_info = process.memory_info().rss / (1024 * 1024)
+        progress.info(f"Saved {len(details)} recordings for {len(chunk)} birds. Memory usage: {mem_info:.2f} MB")
+        progress.advance(len(chunk))
+
+    # 公開APIのキャッシュを無効化
+    if totals['added']:
+        bump_data_version()
+    return totals, errors
 
-        data = response.json()
-        count = 0
 
-        for recording in data.get('recordings', []):
-            if count >= 10:
-                logger.info(f"10 recordings saved for bird: {bird.comName}")
-                break
-
-            if recording.get('q') == 'A':
-                recording_url = recording.get('file')
-                if not recording_url:
-                    logger.warning(f"Recording URL is missing for bird: {bird.comName}")
-                    continue
-
-                try:
-                    bird_detail, created = BirdDetail.objects.get_or_create(
-                        bird_id=bird,
-                        recording_url=recording_url,
-                    )
-
-                    message = f"Recording {'added' if created else 'already exists'} for {bird.comName}: {recording_url}"
-                    logger.info(message)
-                    modeladmin.message_user(request, message)
-
-                    count += 1
-                    mem_info = process.memory_info().rss / (1024 * 1024)
-                    logger.info(f"Memory usage after recording for {bird.comName}: {mem_info:.2f} MB")
-                    time.sleep(1)
-
-                except Exception as db_exception:
-                    db_error_message = f"Database error for {bird.comName}: {db_exception}"
-                    logger.error(db_error_message)
-                    modeladmin.message_user(request, db_error_message, level='error')
-                    break  # エラーが発生した場合、次の鳥の処理に移行
-
-        # 一時的データを削除し、ガベージコレクションを強制実行
-        del data, response
-        gc.collect()  
-        connection.close()  # DB接続を明示的に閉じる
-        time.sleep(5)
-        logger.info(f"Finished processing bird: {bird.comName}\n")
\ No newline at end of file
+@admin.action(description="選択した鳥に対してXeno-Cantoの録音を取得")
+def fetch_xeno_canto_recordings(modeladmin, request, queryset):
+    enqueue_admin_job(modeladmin, request, 'harvest_recordings', bird_ids=list(queryset.values_list('pk', flat=True)))
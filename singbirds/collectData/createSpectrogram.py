@@ -1,58 +1,121 @@
 from django.contrib import admin
-from django.contrib import messages
 from ..models import BirdDetail
+from ..api_cache import bump_data_version
+from ..jobs import Progress, enqueue_admin_job
+from ..audio_store import load_audio
+from .spectrogramData import quantize_spectrogram
+from .spectrogramImage import render_spectrogram_set, spectrogram_db
+import os
+import tempfile
 import requests
-import librosa
-import librosa.display
-import matplotlib
-matplotlib.use('Agg')  # 非GUIバックエンドを使用
-import matplotlib.pyplot as plt
-import numpy as np
-from io import BytesIO
 from django.core.files.base import ContentFile
 
-# カスタムアクションとしてスペクトログラム生成を実装
-@admin.action(description="Generate spectrograms for selected birds")
-def generate_spectrograms_action(modeladmin, request, queryset):
-    # 選択された BirdDetail オブジェクトに対してのみ実行
-    for bird_detail in queryset:
+
+def spectrogram_name(detail_id, size=None, format='png'):
+    # full の PNG は ImageField の upload_to に、それ以外はサイズごとのディレクトリに保存する
+    if format == 'msgpack':
+        return f"spectrogram_{detail_id}.msgpack"
+    if size is None:
+        return f"spectrogram_{detail_id}.png"
+    return f"spectrograms/{size}/spectrogram_{detail_id}.{format}"
+
+
+def write_file(storage, name, data):
+    # name のファイルを data で置き換え、保存した名前を返す
+    # ローカルのストレージでは一時ファイルに書き込んでから置き換えるので、古いファイルが無くなる時間が無い
+    # （BirdDetail をまとめて更新するまでの間や、読み込み中の API からも常にどちらかの内容が見える）
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        if storage.exists(name):
+            storage.delete(name)
+        return storage.save(name, ContentFile(data))
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if storage.file_permissions_mode is not None:
+            os.chmod(tmp_path, storage.file_permissions_mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return name
+
+
+def replace_file(field_file, name, data):
+    # 作り直した場合も同じ名前になるよう、古いファイルは置き換える
+    path = write_file(field_file.storage, field_file.field.generate_filename(field_file.instance, name), data)
+    setattr(field_file.instance, field_file.field.attname, path)
+
+
+def save_spectrogram_images(bird_detail, images, data=None, save=True):
+    # images は {サイズ: {形式: バイト列}}。full の PNG がある場合は spectrogram に保存する
+    # data は quantize_spectrogram のバイト列で、spectrogram_data に保存する
+    # save=False の場合は呼び出し側で spectrogram・spectrogram_derivatives・spectrogram_data をまとめて保存する
+    storage = bird_detail.spectrogram.storage
+    derivatives = {}
+    for size, formats in images.items():
+        for format, image in formats.items():
+            if size == 'full' and format == 'png':
+                replace_file(bird_detail.spectrogram, spectrogram_name(bird_detail.pk), image)
+                continue
+            derivatives.setdefault(size, {})[format] = write_file(storage, spectrogram_name(bird_detail.pk, size, format), image)
+    bird_detail.spectrogram_derivatives = derivatives
+    if data is not None:
+        replace_file(bird_detail.spectrogram_data, spectrogram_name(bird_detail.pk, format='msgpack'), data)
+    if save:
+        bird_detail.save(update_fields=['spectrogram', 'spectrogram_derivatives', 'spectrogram_data'])
+
+
+# 選択された BirdDetail の録音からスペクトログラム画像を生成する
+# 戻り値は {'generated', 'skipped', 'failed'} の件数
+def generate_spectrograms(bird_details, progress=None):
+    progress = progress or Progress()
+    progress.set_total(len(bird_details))
+    counts = {'generated': 0, 'skipped': 0, 'failed': 0}
+
+    for bird_detail in bird_details:
         recording_url = bird_detail.recording_url  # 音声ファイルのURLを取得
 
         if recording_url and not bird_detail.spectrogram:
             try:
-                # 音声ファイルをダウンロード
-                audio_response = requests.get(recording_url)
-                if audio_response.status_code == 200:
-                    audio_data = BytesIO(audio_response.content)  # 音声データをメモリに保存
-
-                    # librosaで音声データを読み込み
-                    y, sr = librosa.load(audio_data, sr=None)
-
-                    # スペクトログラムを生成
-                    plt.figure(figsize=(10, 4))
-                    D = librosa.amplitude_to_db(np.abs(librosa.stft(y)), ref=np.max)
-                    librosa.display.specshow(D, sr=sr, x_axis='time', y_axis='log', cmap="viridis")
-                    plt.colorbar(format='%+2.0f dB')
-                    plt.tight_layout()
-
-                    # スペクトログラムをメモリ内に保存
-                    image_buffer = BytesIO()
-                    plt.savefig(image_buffer, format='png')
-                    plt.close()
-                    image_buffer.seek(0)
-
-                    # BirdDetail の ImageField に画像を保存
-                    image_file = ContentFile(image_buffer.read(), name=f"spectrogram_{bird_detail.birddetail_id}.png")
-                    bird_detail.spectrogram.save(image_file.name, image_file, save=True)
-
-                    print(f"Spectrogram generated and saved for BirdDetail ID: {bird_detail.birddetail_id}")
-                else:
-                    messages.error(request, f"Failed to download audio for BirdDetail ID: {bird_detail.birddetail_id}")
+                # 音声ファイルをキャッシュのファイルから読み込む（無ければダウンロードしてキャッシュする）
+                y, sr, memory_bytes = load_audio(recording_url, sr=None)
+
+                # スペクトログラムを生成し、BirdDetail に各サイズの画像と量子化したデータを保存
+                D = spectrogram_db(y)
+                save_spectrogram_images(bird_detail, render_spectrogram_set(D, sr), quantize_spectrogram(D, sr))
+
+                counts['generated'] += 1
+                progress.info(
+                    f"Spectrogram generated and saved for BirdDetail ID: {bird_detail.birddetail_id} "
+                    f"(decoded audio: {memory_bytes / (1024 * 1024):.2f} MB)"
+                )
+            except requests.RequestException as e:
+                counts['failed'] += 1
+                progress.error(f"Failed to download audio for BirdDetail ID: {bird_detail.birddetail_id}: {e}")
             except Exception as e:
-                messages.error(request, f"Error processing BirdDetail ID: {bird_detail.birddetail_id}: {e}")
+                counts['failed'] += 1
+                progress.error(f"Error processing BirdDetail ID: {bird_detail.birddetail_id}: {e}")
         elif bird_detail.spectrogram:
-            messages.warning(request, f"Spectrogram already exists for BirdDetail ID: {bird_detail.birddetail_id}")
+            counts['skipped'] += 1
+            progress.info(f"Spectrogram already exists for BirdDetail ID: {bird_detail.birddetail_id}")
         else:
-            messages.error(request, f"No recording URL found for BirdDetail ID: {bird_detail.birddetail_id}")
+            counts['failed'] += 1
+            progress.error(f"No recording URL found for BirdDetail ID: {bird_detail.birddetail_id}")
+        progress.advance()
 
-    messages.success(request, "Spectrograms generated for selected birds")
\ No newline at end of file
+    # 公開APIのキャッシュを無効化
+    if counts['generated']:
+        bump_data_version()
+    return counts
+
+
+# カスタムアクションとしてスペクトログラム生成を実装（処理はジョブとしてワーカーで実行する）
+@admin.action(description="Generate spectrograms for selected birds")
+def generate_spectrograms_action(modeladmin, request, queryset):
+    enqueue_admin_job(modeladmin, request, 'generate_spectrograms', detail_ids=list(queryset.values_list('pk', flat=True)))
\ No newline at end of file
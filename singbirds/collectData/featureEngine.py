@@ -0,0 +1,112 @@
+import resource
+import librosa
+import numpy as np
+from ..audio_store import decode_audio
+from .frameFeatureStore import encode_frame_features
+
+# 音響特徴量の抽出。STFT を1回だけ計算し、すべてのスペクトル特徴量をその振幅スペクトログラムから求める
+# パラメータは librosa の各特徴量関数の既定値と同じにしているので、個別に呼び出した場合と同じ値になる
+N_FFT = 2048
+HOP_LENGTH = 512
+N_MFCC = 13
+
+# 特徴量を求める際のサンプリングレート
+FEATURE_SAMPLE_RATE = 16000
+
+# 無音区間の判定に使う閾値（dB）
+SILENCE_TOP_DB = 30
+
+
+def frame_rms(y, frame_length=N_FFT, hop_length=HOP_LENGTH):
+    # librosa.feature.rms(y=y) と同じフレーム（中央揃え・0 埋め）の RMS を、二乗和の累積和から求める
+    # librosa はフレームごとに frame_length 個の値を複製して平均するため、STFT より時間がかかる
+    padded = np.pad(y.astype(np.float64), frame_length // 2)
+    cumulative = np.concatenate(([0.0], np.cumsum(padded ** 2)))
+    starts = np.arange(1 + (len(padded) - frame_length) // hop_length) * hop_length
+    power = np.maximum(cumulative[starts + frame_length] - cumulative[starts], 0.0) / frame_length
+    return np.sqrt(power).astype(y.dtype)[np.newaxis, :]
+
+
+def trim_silence(audio_data, top_db=SILENCE_TOP_DB):
+    # librosa.effects.split と同じ判定で有音区間を求め、結合して新しい音声データを作成
+    db = librosa.amplitude_to_db(frame_rms(audio_data)[0], ref=np.max, top_db=None)
+    non_silent = db > -top_db
+
+    edges = [np.flatnonzero(np.diff(non_silent.astype(int))) + 1]
+    if non_silent[0]:
+        edges.insert(0, np.array([0]))
+    if non_silent[-1]:
+        edges.append(np.array([len(non_silent)]))
+    edges = np.minimum(librosa.frames_to_samples(np.concatenate(edges), hop_length=HOP_LENGTH), len(audio_data))
+    return np.concatenate([audio_data[start:end] for start, end in edges.reshape((-1, 2))])
+
+
+def frame_features(y, sr):
+    # フレームごとの特徴量を返す（各値は (次元, フレーム数) の配列）
+    S = np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH))
+    power = S ** 2
+
+    mel = librosa.feature.melspectrogram(S=power, sr=sr)
+    return {
+        "mfcc": librosa.feature.mfcc(S=librosa.power_to_db(mel), n_mfcc=N_MFCC),
+        "chroma": librosa.feature.chroma_stft(S=power, sr=sr),
+        "spectral_bandwidth": librosa.feature.spectral_bandwidth(S=S, sr=sr),
+        "spectral_contrast": librosa.feature.spectral_contrast(S=S, sr=sr),
+        "spectral_flatness": librosa.feature.spectral_flatness(S=S),
+        # RMS とゼロ交差率は時間領域で求める（スペクトログラムからの RMS は窓関数の分だけ値が変わるため）
+        "rms": frame_rms(y),
+        "zero_crossing_rate": librosa.feature.zero_crossing_rate(y, frame_length=N_FFT, hop_length=HOP_LENGTH),
+        "spectral_centroid": librosa.feature.spectral_centroid(S=S, sr=sr),
+        "spectral_rolloff": librosa.feature.spectral_rolloff(S=S, sr=sr),
+    }
+
+
+def summarize(frames):
+    # フレームごとの特徴量を平均し、AcousticParameters に保存する形式にする
+    return {
+        "mfcc_features": np.mean(frames["mfcc"], axis=1).astype(np.float16).tolist(),
+        "chroma_features": np.mean(frames["chroma"], axis=1).astype(np.float16).tolist(),
+        "spectral_bandwidth": np.mean(frames["spectral_bandwidth"]).item(),
+        "spectral_contrast": np.mean(frames["spectral_contrast"], axis=1).astype(np.float16).tolist(),
+        "spectral_flatness": np.mean(frames["spectral_flatness"]).item(),
+        "rms_energy": np.mean(frames["rms"]).item(),
+        "zero_crossing_rate": np.mean(frames["zero_crossing_rate"]).item(),
+        "spectral_centroid": np.mean(frames["spectral_centroid"]).item(),
+        "spectral_rolloff": np.mean(frames["spectral_rolloff"]).item(),
+    }
+
+
+def extract_features(audio_data, sr):
+    # 無音部分を除去し、平均した特徴量を返す
+    return summarize(frame_features(trim_silence(audio_data), sr))
+
+
+def extract_frame_features(audio_data, sr):
+    # 無音部分を除去し、(平均した特徴量, フレームごとの特徴量を保存する .npy のバイト列) を返す
+    frames = frame_features(trim_silence(audio_data), sr)
+    return summarize(frames), encode_frame_features(frames)
+
+
+def extract_features_reference(audio_data, sr):
+    # 特徴量ごとに librosa を呼び出す以前の実装（STFT を毎回計算し直す）。比較とベンチマーク用
+    non_silent_intervals = librosa.effects.split(audio_data, top_db=SILENCE_TOP_DB)
+    trimmed_audio = np.concatenate([audio_data[start:end] for start, end in non_silent_intervals])
+    return {
+        "mfcc_features": np.mean(librosa.feature.mfcc(y=trimmed_audio, sr=sr, n_mfcc=N_MFCC), axis=1).astype(np.float16).tolist(),
+        "chroma_features": np.mean(librosa.feature.chroma_stft(y=trimmed_audio, sr=sr), axis=1).astype(np.float16).tolist(),
+        "spectral_bandwidth": np.mean(librosa.feature.spectral_bandwidth(y=trimmed_audio, sr=sr)).item(),
+        "spectral_contrast": np.mean(librosa.feature.spectral_contrast(y=trimmed_audio, sr=sr), axis=1).astype(np.float16).tolist(),
+        "spectral_flatness": np.mean(librosa.feature.spectral_flatness(y=trimmed_audio)).item(),
+        "rms_energy": np.mean(librosa.feature.rms(y=trimmed_audio)).item(),
+        "zero_crossing_rate": np.mean(librosa.feature.zero_crossing_rate(y=trimmed_audio)).item(),
+        "spectral_centroid": np.mean(librosa.feature.spectral_centroid(y=trimmed_audio, sr=sr)).item(),
+        "spectral_rolloff": np.mean(librosa.feature.spectral_rolloff(y=trimmed_audio, sr=sr)).item(),
+    }
+
+
+def features_from_file(path, sr=FEATURE_SAMPLE_RATE):
+    # プロセスプールのワーカーで実行する（Django に依存しないこと）
+    # 戻り値は (特徴量, フレームごとの特徴量の .npy, デコード時の使用メモリの見積もり, ワーカーの最大 RSS)。メモリはバイト単位
+    y, sr, memory_bytes = decode_audio(path, sr=sr)
+    features, frame_data = extract_frame_features(y, sr)
+    return features, frame_data, memory_bytes, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,62 @@
+import io
+import numpy as np
+
+# フレームごとの音響特徴量の保存形式（ワーカープロセスからも使うため Django に依存しない）
+# 録音ごとに (FRAME_FEATURE_DIMS, フレーム数) の float16 の行列を1つの .npy に保存する
+# 特徴量ごとの行の範囲は FRAME_FEATURE_OFFSETS で、各特徴量の値はファイル内で連続しているため
+# np.load(mmap_mode='r') で開けば、必要な特徴量の部分だけがディスクから読み込まれる
+# float16 の相対誤差は 0.1% 程度で、平均などの統計量を求め直すには十分
+
+# (特徴量名, 次元数)。featureEngine.frame_features のキーと同じ。並びを変える場合は保存済みのファイルを作り直す
+FRAME_FEATURE_LAYOUT = (
+    ("mfcc", 13),
+    ("chroma", 12),
+    ("spectral_contrast", 7),
+    ("spectral_bandwidth", 1),
+    ("spectral_flatness", 1),
+    ("rms", 1),
+    ("zero_crossing_rate", 1),
+    ("spectral_centroid", 1),
+    ("spectral_rolloff", 1),
+)
+
+# 特徴量名 -> (開始行, 終了行)
+FRAME_FEATURE_OFFSETS = {}
+FRAME_FEATURE_DIMS = 0
+for _name, _dims in FRAME_FEATURE_LAYOUT:
+    FRAME_FEATURE_OFFSETS[_name] = (FRAME_FEATURE_DIMS, FRAME_FEATURE_DIMS + _dims)
+    FRAME_FEATURE_DIMS += _dims
+
+# frame_statistics で既定で求めるパーセンタイル
+DEFAULT_PERCENTILES = (10, 50, 90)
+
+
+def encode_frame_features(frames):
+    # frame_features の戻り値を、保存する .npy のバイト列にする
+    matrix = np.concatenate([frames[name] for name, _ in FRAME_FEATURE_LAYOUT], axis=0)
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(matrix, dtype=np.float16), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def load_frame_features(source):
+    # 保存した .npy（パスまたはファイルオブジェクト）を {特徴量名: (次元, フレーム数) の配列} として返す
+    # パスの場合はメモリマップで開くので、配列の値はアクセスした時点で読み込まれる
+    matrix = np.load(source, mmap_mode='r' if isinstance(source, str) else None, allow_pickle=False)
+    if matrix.ndim != 2 or matrix.shape[0] != FRAME_FEATURE_DIMS:
+        raise ValueError(f"Unexpected frame feature shape {matrix.shape}")
+    return {name: matrix[start:end] for name, (start, end) in FRAME_FEATURE_OFFSETS.items()}
+
+
+def frame_statistics(frames, percentiles=DEFAULT_PERCENTILES):
+    # 特徴量ごとに、次元ごとの平均・標準偏差・パーセンタイルを返す
+    # 戻り値は {特徴量名: {'mean': [...], 'std': [...], 'p10': [...], ...}}
+    statistics = {}
+    for name, values in frames.items():
+        values = np.asarray(values, dtype=np.float32)
+        stats = {'mean': values.mean(axis=1).tolist(), 'std': values.std(axis=1).tolist()}
+        if percentiles:
+            for percentile, value in zip(percentiles, np.percentile(values, percentiles, axis=1)):
+                stats[f"p{percentile:g}"] = value.tolist()
+        statistics[name] = stats
+    return statistics
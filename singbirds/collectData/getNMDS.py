@@ -6,18 +6,22 @@ from sklearn.manifold import MDS
 from django.conf import settings
 from django.contrib import admin
 from ..models import AcousticParameters
+from ..jobs import Progress, enqueue_admin_job
 from sklearn.metrics.pairwise import cosine_distances
 import matplotlib.cm as cm 
 import plotly.express as px
 
-@admin.action(description='PerformNMDS') 
-def perform_nmds_action(modeladmin, request, queryset):
+def perform_nmds(records, progress=None):
+    # 保存したプロットのパスを返す（有効な特徴量がない場合は None）
+    progress = progress or Progress()
+    records = list(records)
+    progress.set_total(len(records) + 1)  # 各レコードの読み込みと、次元削減・プロットの保存
         # 選択されたデータから音響パラメータを取得
     features = []
     bird_ids = []  # bird_id を格納するリスト
     bird_names = []  # 鳥の名前を格納するリスト（表示用）
     
-    for record in queryset:
+    for record in records:
         try:
             # JSON形式から配列に変換し、空の場合はゼロ配列を設定
             # もし文字列ならリストに変換する
@@ -46,16 +50,18 @@ def perform_nmds_action(modeladmin, request, queryset):
                 bird_ids.append(record.bird_id)  # bird_idを保存
                 bird_names.append(record.bird_id.comName)  # 鳥の名前を保存
             else:
-                modeladmin.message_user(request, f"Error: Dimension mismatch for record {record.bird_id}")
+                progress.error(f"Error: Dimension mismatch for record {record.bird_id}")
                 continue  # 次のレコードに進む
 
         except Exception as e:
-            modeladmin.message_user(request, f"Error processing record {record.bird_id}: {e}")
+            progress.error(f"Error processing record {record.bird_id}: {e}")
             continue
 
     if len(features) == 0:
-        modeladmin.message_user(request, "No valid features to process.")
-        return
+        progress.error("No valid features to process.")
+        return None
+
+    progress.advance(len(records))
 
     features = np.array(features)
 
@@ -81,7 +87,10 @@ def perform_nmds_action(modeladmin, request, queryset):
     fig.write_html(media_path)
 
     # 管理者に保存先を通知
-    modeladmin.message_user(request, f'NMDSインタラクティブプロットを {media_path} に保存しました')
+    progress.info(f'NMDSインタラクティブプロットを {media_path} に保存しました')
+    progress.advance()
+    return media_path
+
     #    # 選択されたデータから音響パラメータを取得
     # features = []
     # bird_ids = []  # bird_id を格納するリスト
@@ -156,4 +165,10 @@ def perform_nmds_action(modeladmin, request, queryset):
     # plt.close()
 
     # # 管理者に保存先を通知
-    # modeladmin.message_user(request, f'NMDSプロットを {media_path} に保存しました')
\ No newline at end of file
+    # modeladmin.message_user(request, f'NMDSプロットを {media_path} に保存しました')
+
+
+# 処理はジョブとしてワーカーで実行する
+@admin.action(description='PerformNMDS')
+def perform_nmds_action(modeladmin, request, queryset):
+    enqueue_admin_job(modeladmin, request, 'nmds', parameter_ids=list(queryset.values_list('pk', flat=True)))
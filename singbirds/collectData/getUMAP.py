@@ -6,17 +6,21 @@ from sklearn.preprocessing import StandardScaler
 from django.conf import settings
 from django.contrib import admin
 from ..models import AcousticParameters
+from ..jobs import Progress, enqueue_admin_job
 import ast
 
 # 1. UMAP次元削減とスケーリングのカスタムアクション
-@admin.action(description='Perform UMAP and create interactive plot')
-def perform_umap_action(modeladmin, request, queryset):
+def perform_umap(records, progress=None):
+    # 保存したプロットのパスを返す（有効な特徴量がない場合は None）
+    progress = progress or Progress()
+    records = list(records)
+    progress.set_total(len(records) + 1)  # 各レコードの読み込みと、次元削減・プロットの保存
     # 選択されたデータから音響パラメータを取得
     features = []
     bird_ids = []  # bird_id を格納するリスト
     bird_names = []  # 鳥の名前を格納するリスト（表示用）
 
-    for record in queryset:
+    for record in records:
         try:
             # JSON形式から配列に変換し、空の場合はゼロ配列を設定
             # もし文字列ならリストに変換する
@@ -46,16 +50,18 @@ def perform_umap_action(modeladmin, request, queryset):
                 bird_names.append(record.bird_id.comName)
                 
             else:
-                modeladmin.message_user(request, f"Error: Dimension mismatch for record {record.bird_id}")
+                progress.error(f"Error: Dimension mismatch for record {record.bird_id}")
                 continue  # 次のレコードに進む
 
         except Exception as e:
-            modeladmin.message_user(request, f"Error processing record {record.bird_id}: {e}")
+            progress.error(f"Error processing record {record.bird_id}: {e}")
             continue
 
     if len(features) == 0:
-        modeladmin.message_user(request, "No valid features to process.")
-        return
+        progress.error("No valid features to process.")
+        return None
+
+    progress.advance(len(records))
 
     # 2. データのスケーリング
     scaler = StandardScaler()
@@ -95,4 +101,12 @@ def perform_umap_action(modeladmin, request, queryset):
     fig.write_html(media_path)
 
     # 管理者に保存先を通知
-    modeladmin.message_user(request, f'UMAPインタラクティブプロットを {media_path} に保存しました')
+    progress.info(f'UMAPインタラクティブプロットを {media_path} に保存しました')
+    progress.advance()
+    return media_path
+
+
+# 処理はジョブとしてワーカーで実行する
+@admin.action(description='Perform UMAP and create interactive plot')
+def perform_umap_action(modeladmin, request, queryset):
+    enqueue_admin_job(modeladmin, request, 'umap', parameter_ids=list(queryset.values_list('pk', flat=True)))
@@ -0,0 +1,111 @@
+from django.contrib import admin
+from django.db.models import Exists, OuterRef
+from ..models import AcousticParameters, BirdDetail
+from ..api_cache import bump_data_version
+from ..audio_store import get_audio_store
+from ..jobs import Progress, enqueue_admin_job
+from .collectParameters import build_acoustic_parameters, save_acoustic_parameters, update_similarity_index
+from .createSpectrogram import save_spectrogram_images
+from .recordingAnalysis import analyze_file
+from .recordingPipeline import run_recording_pipeline
+
+# 録音のダウンロード・デコードを1回で済ませ、スペクトログラム画像と AcousticParameters の未作成のものをまとめて作る
+# 個別のアクション（スペクトログラム生成・特徴量抽出）はそれぞれ録音を読み込み直す
+
+# まとめて保存する件数
+SAVE_BATCH_SIZE = 100
+
+
+def process_recording(bird_detail, spectrogram=True, features=True):
+    # 1件の録音をこのプロセスで処理して保存する。作成したものを {'spectrogram', 'features'} で返す
+    path = get_audio_store().path(bird_detail.recording_url)
+    result = analyze_file(path, spectrogram=spectrogram, features=features)
+
+    if result['spectrogram'] is not None:
+        save_spectrogram_images(bird_detail, result['spectrogram'], result['spectrogram_data'])
+        bump_data_version()
+    if result['features'] is not None:
+        parameters = [build_acoustic_parameters(bird_detail.pk, bird_detail.bird_id_id, result['features'], result['frame_features'])]
+        saved_ids = []
+        if save_acoustic_parameters(parameters, Progress(), saved_ids):
+            update_similarity_index(saved_ids, Progress())
+    return {'spectrogram': result['spectrogram'] is not None, 'features': result['features'] is not None}
+
+
+def process_recordings(bird_details, progress=None):
+    # BirdDetail のクエリセットを、ダウンロード・計算・保存のパイプラインで処理する
+    # 戻り値は {'spectrograms', 'features', 'skipped', 'failed', 'max_recording_mb', 'peak_worker_rss_mb'}
+    progress = progress or Progress()
+    progress.set_total(bird_details.count())
+    counts = {'spectrograms': 0, 'features': 0, 'skipped': 0, 'failed': 0}
+    memory = {'max': 0, 'peak_rss': 0}
+    spectrograms, parameters = [], []
+    saved_ids = []  # 類似検索の索引に追加するものの主キー
+
+    def flush():
+        nonlocal spectrograms, parameters
+        if spectrograms:
+            BirdDetail.objects.bulk_update(
+                spectrograms, ['spectrogram', 'spectrogram_derivatives', 'spectrogram_data'], batch_size=SAVE_BATCH_SIZE
+            )
+            counts['spectrograms'] += len(spectrograms)
+            spectrograms = []
+        if parameters:
+            counts['features'] += save_acoustic_parameters(parameters, progress, saved_ids)
+            parameters = []
+
+    def on_result(key, result):
+        detail_id, bird_id = key
+        memory['max'] = max(memory['max'], result['memory_bytes'])
+        memory['peak_rss'] = max(memory['peak_rss'], result['peak_rss'])
+        if result['spectrogram'] is not None:
+            # 画像はストレージに保存し、BirdDetail はまとめて更新する
+            detail = BirdDetail(birddetail_id=detail_id)
+            save_spectrogram_images(detail, result['spectrogram'], result['spectrogram_data'], save=False)
+            spectrograms.append(detail)
+        if result['features'] is not None:
+            parameters.append(build_acoustic_parameters(detail_id, bird_id, result['features'], result['frame_features']))
+        if len(spectrograms) >= SAVE_BATCH_SIZE or len(parameters) >= SAVE_BATCH_SIZE:
+            flush()
+        progress.advance()
+
+    def on_error(key, error):
+        counts['failed'] += 1
+        progress.error(f"Failed to process BirdDetail ID {key[0]}: {error}")
+        progress.advance()
+
+    def rows():
+        details = bird_details.annotate(
+            has_parameters=Exists(AcousticParameters.objects.filter(birddetail_id=OuterRef('pk')))
+        ).values_list('birddetail_id', 'bird_id', 'recording_url', 'spectrogram', 'spectrogram_data', 'has_parameters')
+        for detail_id, bird_id, url, spectrogram, data, has_parameters in details.iterator(chunk_size=SAVE_BATCH_SIZE):
+            # 量子化したスペクトログラムが無い録音は、画像も合わせて作り直す
+            needs_spectrogram = not spectrogram or not data
+            if not url:
+                on_error((detail_id, bird_id), "No recording URL found")
+            elif not needs_spectrogram and has_parameters:
+                counts['skipped'] += 1
+                progress.advance()
+            else:
+                yield (detail_id, bird_id), url, needs_spectrogram, not has_parameters
+
+    run_recording_pipeline(rows(), analyze_file, on_result, on_error)
+    flush()
+    update_similarity_index(saved_ids, progress)
+
+    counts['max_recording_mb'] = round(memory['max'] / (1024 * 1024), 2)
+    counts['peak_worker_rss_mb'] = round(memory['peak_rss'] / (1024 * 1024), 2)
+    progress.info(
+        f"Created {counts['spectrograms']} spectrograms and {counts['features']} acoustic parameters "
+        f"({counts['skipped']} skipped, {counts['failed']} failed)"
+    )
+
+    # 公開APIのキャッシュを無効化
+    if counts['spectrograms']:
+        bump_data_version()
+    return counts
+
+
+@admin.action(description="Process selected recordings (spectrogram and acoustic features)")
+def process_recordings_action(modeladmin, request, queryset):
+    enqueue_admin_job(modeladmin, request, 'process_recordings', detail_ids=list(queryset.values_list('pk', flat=True)))
@@ -0,0 +1,33 @@
+import resource
+import librosa
+from ..audio_store import decode_audio
+from .featureEngine import FEATURE_SAMPLE_RATE, extract_frame_features
+from .spectrogramData import quantize_spectrogram
+from .spectrogramImage import render_spectrogram_set, spectrogram_db
+
+# 1つの録音からスペクトログラム画像と音響特徴量をまとめて求める（ワーカープロセスで実行するため Django に依存しない）
+# 録音は元のサンプリングレートで1回だけデコードし、特徴量用の 16kHz の波形はそこからリサンプリングする
+# librosa.load(sr=16000) も内部で同じリサンプリングを行うので、個別に処理した場合と同じ結果になる
+
+
+def analyze_file(path, spectrogram=True, features=True):
+    # 戻り値は {'spectrogram': {サイズ: {形式: バイト列}} または None, 'spectrogram_data': 量子化したスペクトログラムまたは None,
+    #          'features': 特徴量または None, 'frame_features': フレームごとの特徴量の .npy または None,
+    #          'memory_bytes': デコード時の使用メモリの見積もり, 'peak_rss': ワーカーの最大 RSS}
+    y, sr, memory_bytes = decode_audio(path, sr=None)
+    result = {'spectrogram': None, 'spectrogram_data': None, 'features': None, 'frame_features': None}
+
+    if spectrogram:
+        D = spectrogram_db(y)
+        result['spectrogram'] = render_spectrogram_set(D, sr)
+        result['spectrogram_data'] = quantize_spectrogram(D, sr)
+
+    if features:
+        if sr != FEATURE_SAMPLE_RATE:
+            y = librosa.resample(y, orig_sr=sr, target_sr=FEATURE_SAMPLE_RATE)
+            memory_bytes += y.nbytes
+        result['features'], result['frame_features'] = extract_frame_features(y, FEATURE_SAMPLE_RATE)
+
+    result['memory_bytes'] = memory_bytes
+    result['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return result
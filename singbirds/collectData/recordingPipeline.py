@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import requests
+from django.conf import settings
+from ..audio_store import get_audio_store
+
+# 録音を3段に分けて処理する
+#   1. ダウンロード（スレッド）: 録音を音声キャッシュに保存し、ファイルのパスを待ち行列に入れる
+#   2. 計算（プロセス）: パスから読み込み、デコードと特徴量の計算などを行う
+#   3. 書き込み（呼び出し元のスレッド）: on_result / on_error で結果をまとめて保存する
+# ダウンロード中・待ち行列・計算中の録音の数には上限があり、計算が追いつかなければダウンロードも止まる
+# そのため対象の件数によらず使用メモリは一定になる
+
+# 計算中のプロセスが終わるたびに次の録音を渡せるよう、ワーカー数の何倍まで投入しておくか
+COMPUTE_PREFETCH = 2
+
+# 待ち行列にある間に音声キャッシュから削除された録音を、ダウンロードし直す回数
+EVICTED_RETRIES = 2
+
+
+def available_cores():
+    # コンテナなどで使える CPU が制限されている場合はその数
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def compute_workers():
+    return settings.FEATURE_EXTRACTION_WORKERS or available_cores()
+
+
+_local = threading.local()
+
+
+def _download(url):
+    # スレッドごとに接続を使い回す
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return get_audio_store().path(url, session=_local.session)
+
+
+def run_recording_pipeline(rows, compute, on_result, on_error, workers=None,
+                           download_workers=None, queue_size=None):
+    # rows は (キー, 録音の URL, compute への追加の引数...) の列（クエリセットの iterator などを渡せる）
+    # compute(パス, 追加の引数...) はワーカープロセスで実行するため、Django に依存しないモジュールのトップレベルの関数にする
+    # on_result(キー, compute の戻り値) と on_error(キー, エラーメッセージ) は呼び出し元のスレッドで呼ばれる
+    workers = workers or compute_workers()
+    download_workers = download_workers or settings.AUDIO_DOWNLOAD_WORKERS
+    queue_size = queue_size or settings.FEATURE_PIPELINE_QUEUE_SIZE
+    rows = iter(rows)
+
+    downloading, computing = {}, {}
+    downloaded = deque()
+    exhausted = False
+
+    # ダウンロード用のスレッドを持つプロセスから fork しないよう、ワーカーは forkserver で起動する
+    process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+    try:
+        with ThreadPoolExecutor(max_workers=download_workers) as download_pool:
+            while True:
+                # 待ち行列に空きがある間だけダウンロードを始める
+                while not exhausted and len(downloading) + len(downloaded) < download_workers + queue_size:
+                    try:
+                        key, url, *args = next(rows)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    downloading[download_pool.submit(_download, url)] = (key, url, args, 0)
+
+                while downloaded and len(computing) < workers * COMPUTE_PREFETCH:
+                    key, url, path, args, retries = downloaded.popleft()
+                    computing[process_pool.submit(compute, path, *args)] = (key, url, path, args, retries)
+
+                if not downloading and not computing:
+                    break
+
+                done, _ = wait([*downloading, *computing], return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in downloading:
+                        key, url, args, retries = downloading.pop(future)
+                        try:
+                            downloaded.append((key, url, future.result(), args, retries))
+                        except Exception as e:
+                            on_error(key, f"Failed to download audio: {e}")
+                    else:
+                        key, url, path, args, retries = computing.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            if not os.path.exists(path) and retries < EVICTED_RETRIES:
+                                # 他のプロセスのダウンロードで古いものとして削除された
+                                downloading[download_pool.submit(_download, url)] = (key, url, args, retries + 1)
+                                continue
+                            on_error(key, str(e))
+                        else:
+                            on_result(key, result)
+    finally:
+        # キャンセルされた場合などは、まだ始まっていない計算を破棄する
+        process_pool.shutdown(wait=True, cancel_futures=True)
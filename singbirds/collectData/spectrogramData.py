@@ -0,0 +1,74 @@
+import zlib
+import msgpack
+import numpy as np
+from .spectrogramImage import DB_RANGE, HOP_LENGTH, resample_rows
+
+# クライアント側で描画するための数値のスペクトログラム（ワーカープロセスからも使うため Django に依存しない）
+# 録音によらず同じ時間・対数周波数の格子に揃え、dB を 0..255 に量子化して zlib で圧縮する
+# 保存する msgpack の形式（spectrogram-data の API はこれをそのまま返す）
+#   version          形式の版
+#   frames, bins     行列の大きさ（時間, 周波数）
+#   frame_rate       1秒あたりのフレーム数（フレーム i は i / frame_rate 秒から 1 / frame_rate 秒間）
+#   duration         録音の長さ（秒）
+#   frequency_scale  'log'。frequencies は各周波数ビンの中心（Hz、低い順）
+#   db_min, db_max   値 0 と 255 に対応する dB
+#   sample_rate      元のサンプリングレート（ナイキスト周波数より上のビンは 0）
+#   compression      'zlib'
+#   data             frames x bins の uint8 を時間順（フレームごとに周波数の低い順）に並べて圧縮したもの
+
+SPECTROGRAM_DATA_VERSION = 1
+
+# 周波数の格子（Hz）。鳥の声の帯域を覆う
+DATA_FMIN = 100.0
+DATA_FMAX = 16000.0
+DATA_BINS = 128
+
+# 時間の格子（1秒あたりのフレーム数）。各フレームは区間内の STFT フレームの最大値
+DATA_FRAME_RATE = 50
+
+
+def data_frequency_edges():
+    return np.geomspace(DATA_FMIN, DATA_FMAX, DATA_BINS + 1)
+
+
+def quantize_spectrogram(D, sr, hop_length=HOP_LENGTH):
+    # spectrogram_db の dB を固定の格子に変換し、保存する msgpack のバイト列を返す
+    n_fft = 2 * (D.shape[0] - 1)
+    edges = data_frequency_edges()
+    duration = (D.shape[1] - 1) * hop_length / sr
+    frames = max(1, int(np.ceil(duration * DATA_FRAME_RATE)))
+
+    # STFT のフレーム k の中心は k * hop_length / sr 秒なので、区間に直すときに 0.5 ずらす
+    time_edges = np.arange(frames + 1) / DATA_FRAME_RATE * sr / hop_length + 0.5
+    D = resample_rows(D.T, np.minimum(time_edges, D.shape[1])).T
+
+    # ナイキスト周波数より上のビンは無音（db_min）にする
+    audible = edges[1:] <= sr / 2
+    values = np.full((DATA_BINS, frames), -DB_RANGE, dtype=np.float32)
+    if audible.any():
+        count = int(audible.sum())
+        values[:count] = resample_rows(D, edges[:count + 1] * n_fft / sr + 0.5)
+
+    levels = np.clip(np.round((values + DB_RANGE) * (255 / DB_RANGE)), 0, 255).astype(np.uint8)
+    frequencies = np.sqrt(edges[:-1] * edges[1:])
+    return msgpack.packb({
+        'version': SPECTROGRAM_DATA_VERSION,
+        'frames': frames,
+        'bins': DATA_BINS,
+        'frame_rate': DATA_FRAME_RATE,
+        'duration': duration,
+        'frequency_scale': 'log',
+        'frequencies': [round(float(frequency), 2) for frequency in frequencies],
+        'db_min': -DB_RANGE,
+        'db_max': 0.0,
+        'sample_rate': int(sr),
+        'compression': 'zlib',
+        'data': zlib.compress(np.ascontiguousarray(levels.T).tobytes(), 6),
+    }, use_bin_type=True)
+
+
+def load_spectrogram_data(data):
+    # quantize_spectrogram のバイト列を (メタデータ, frames x bins の uint8 配列) に戻す
+    meta = msgpack.unpackb(data, raw=False)
+    levels = np.frombuffer(zlib.decompress(meta.pop('data')), dtype=np.uint8).reshape(meta['frames'], meta['bins'])
+    return meta, levels
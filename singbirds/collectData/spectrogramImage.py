@@ -0,0 +1,198 @@
+import librosa
+import numpy as np
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFont
+
+# スペクトログラム画像の作成（ワーカープロセスからも使うため Django に依存しない）
+# dB のスペクトログラムを NumPy で viridis の色に変換し、Pillow で直接 PNG / WebP にする
+# matplotlib の図や pyplot のグローバルな状態を使わないので、複数のプロセスやスレッドから同時に呼び出せる
+
+N_FFT = 2048
+HOP_LENGTH = 512
+
+# 既定の画像サイズ（以前の matplotlib の figsize=(10, 4), dpi=100 と同じ）
+DEFAULT_WIDTH = 1000
+DEFAULT_HEIGHT = 400
+
+# 表示する dB の範囲（amplitude_to_db の top_db と同じ）
+DB_RANGE = 80.0
+
+# 対数周波数軸の下限（Hz）
+DEFAULT_FMIN = 100.0
+
+# 保存する画像のサイズ（幅, 高さ, 軸を描くか）と形式
+SPECTROGRAM_SIZES = {
+    'thumbnail': (200, 80, False),
+    'mobile': (500, 200, True),
+    'full': (DEFAULT_WIDTH, DEFAULT_HEIGHT, True),
+}
+SPECTROGRAM_FORMATS = ('png', 'webp')
+
+# 軸を描く場合の余白（ピクセル）
+AXIS_LEFT = 44
+AXIS_BOTTOM = 18
+
+# viridis のカラーマップ（matplotlib と同じ 256 色）
+_VIRIDIS_HEX = (
+    "44015444025645045745055946075a46085c460a5d460b5e470d60470e61471063471164471365481467481668481769"
+    "48186a481a6c481b6d481c6e481d6f481f70482071482173482374482475482576482677482878482979472a7a472c7a"
+    "472d7b472e7c472f7d46307e46327e46337f463480453581453781453882443983443a83443b84433d84433e85423f85"
+    "4240864241864142874144874045884046883f47883f48893e49893e4a893e4c8a3d4d8a3d4e8a3c4f8a3c508b3b518b"
+    "3b528b3a538b3a548c39558c39568c38588c38598c375a8c375b8d365c8d365d8d355e8d355f8d34608d34618d33628d"
+    "33638d32648e32658e31668e31678e31688e30698e306a8e2f6b8e2f6c8e2e6d8e2e6e8e2e6f8e2d708e2d718e2c718e"
+    "2c728e2c738e2b748e2b758e2a768e2a778e2a788e29798e297a8e297b8e287c8e287d8e277e8e277f8e27808e26818e"
+    "26828e26828e25838e25848e25858e24868e24878e23888e23898e238a8d228b8d228c8d228d8d218e8d218f8d21908d"
+    "21918c20928c20928c20938c1f948c1f958b1f968b1f978b1f988b1f998a1f9a8a1e9b8a1e9c891e9d891f9e891f9f88"
+    "1fa0881fa1881fa1871fa28720a38620a48621a58521a68522a78522a88423a98324aa8325ab8225ac8226ad8127ad81"
+    "28ae8029af7f2ab07f2cb17e2db27d2eb37c2fb47c31b57b32b67a34b67935b77937b87838b9773aba763bbb753dbc74"
+    "3fbc7340bd7242be7144bf7046c06f48c16e4ac16d4cc26c4ec36b50c46a52c56954c56856c66758c7655ac8645cc863"
+    "5ec96260ca6063cb5f65cb5e67cc5c69cd5b6ccd5a6ece5870cf5773d05675d05477d1537ad1517cd2507fd34e81d34d"
+    "84d44b86d54989d5488bd6468ed64590d74393d74195d84098d83e9bd93c9dd93ba0da39a2da37a5db36a8db34aadc32"
+    "addc30b0dd2fb2dd2db5de2bb8de29bade28bddf26c0df25c2df23c5e021c8e020cae11fcde11dd0e11cd2e21bd5e21a"
+    "d8e219dae319dde318dfe318e2e418e5e419e7e419eae51aece51befe51cf1e51df4e61ef6e620f8e621fbe723fde725"
+)
+VIRIDIS = np.frombuffer(bytes.fromhex(_VIRIDIS_HEX), dtype=np.uint8).reshape(256, 3)
+
+
+def spectrogram_db(y):
+    # 元のサンプリングレートのまま STFT を計算し、最大値を基準にした dB に変換する
+    return librosa.amplitude_to_db(np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH)), ref=np.max, top_db=DB_RANGE)
+
+
+def _interpolate_rows(values, positions):
+    # values の行を小数の位置 positions で線形補間する
+    positions = np.clip(positions, 0, len(values) - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, len(values) - 1)
+    weight = (positions - lower).reshape((-1,) + (1,) * (values.ndim - 1))
+    return values[lower] * (1 - weight) + values[upper] * weight
+
+
+def resample_rows(values, edges):
+    # 出力の各行を、元の行の区間 [edges[i], edges[i + 1]) から求める（元の行 k は [k, k + 1) を占める）
+    # 区間が1行より広い場合は最大値（縮小しても細い線が消えない）、狭い場合は中心での線形補間
+    result = _interpolate_rows(values, (edges[:-1] + edges[1:]) / 2 - 0.5)
+    wide = np.diff(edges) > 1
+    if wide.any():
+        starts = np.clip(np.floor(edges[:-1]).astype(int), 0, len(values) - 1)
+        end = int(np.clip(np.ceil(edges[-1]), starts[-1] + 1, len(values)))
+        pooled = np.maximum.reduceat(values[:end], starts, axis=0)
+        result[wide] = pooled[wide]
+    return result
+
+
+def frequency_edges(sr, height, log_frequency=True, fmin=DEFAULT_FMIN):
+    # 画像の各行の周波数の境界（Hz、低い順に height + 1 個）
+    if log_frequency:
+        return np.geomspace(fmin, sr / 2, height + 1)
+    return np.linspace(0, sr / 2, height + 1)
+
+
+def resample_spectrogram(D, sr, width, height, log_frequency=True, fmin=DEFAULT_FMIN, n_fft=N_FFT):
+    # (周波数ビン, フレーム) の dB を (height, width) に変換する。上の行ほど高い周波数
+    # 周波数ビン k の中心は k * sr / n_fft なので、行の区間に直すときに 0.5 ずらす
+    rows = resample_rows(D, frequency_edges(sr, height, log_frequency, fmin) * n_fft / sr + 0.5)[::-1]
+    return resample_rows(rows.T, np.linspace(0, D.shape[1], width + 1)).T
+
+
+def colorize(D):
+    # -DB_RANGE..0 dB を 0..255 の段階にし、viridis の色 (height, width, 3) にする
+    levels = np.clip((D + DB_RANGE) * (255 / DB_RANGE), 0, 255).astype(np.uint8)
+    return VIRIDIS[levels]
+
+
+def _format_frequency(frequency):
+    return f"{frequency / 1000:g}k" if frequency >= 1000 else f"{frequency:g}"
+
+
+def _draw_axes(image, plot_box, sr, duration, log_frequency, fmin):
+    # 周波数（左）と時間（下）の目盛りを描く
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    left, top, right, bottom = plot_box
+    color = (0, 0, 0)
+    draw.rectangle((left - 1, top - 1, right, bottom), outline=color)
+
+    if log_frequency:
+        ticks = [f for f in 125 * 2.0 ** np.arange(12) if fmin <= f <= sr / 2]
+        positions = [(np.log(sr / 2) - np.log(f)) / (np.log(sr / 2) - np.log(fmin)) for f in ticks]
+    else:
+        step = 2000 if sr / 2 > 8000 else 1000
+        ticks = list(np.arange(0, sr / 2 + 1, step))
+        positions = [1 - f / (sr / 2) for f in ticks]
+    for frequency, position in zip(ticks, positions):
+        y = top + position * (bottom - top - 1)
+        draw.line((left - 4, y, left - 1, y), fill=color)
+        draw.text((left - 6, y), _format_frequency(frequency), fill=color, font=font, anchor='rm')
+
+    if duration > 0:
+        step = next(s for s in (0.5, 1, 2, 5, 10, 30, 60, 120, 300) if duration / s <= 10)
+        for second in np.arange(0, duration + 1e-9, step):
+            x = left + second / duration * (right - left - 1)
+            draw.line((x, bottom, x, bottom + 3), fill=color)
+            draw.text((x, bottom + 4), f"{second:g}", fill=color, font=font, anchor='mt')
+
+
+def render_spectrogram(D, sr, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, log_frequency=True, fmin=DEFAULT_FMIN,
+                       axes=True, format='png', quality=80, hop_length=HOP_LENGTH):
+    # dB のスペクトログラムを画像のバイト列にする。format は 'png' または 'webp'
+    # axes=True の場合は width x height の中に目盛りの余白を取る
+    if axes:
+        plot_box = (AXIS_LEFT, 0, width, height - AXIS_BOTTOM)
+    else:
+        plot_box = (0, 0, width, height)
+    plot_width, plot_height = plot_box[2] - plot_box[0], plot_box[3] - plot_box[1]
+
+    n_fft = 2 * (D.shape[0] - 1)
+    pixels = colorize(resample_spectrogram(D, sr, plot_width, plot_height, log_frequency, fmin, n_fft))
+    plot = Image.fromarray(pixels, 'RGB')
+
+    if axes:
+        image = Image.new('RGB', (width, height), (255, 255, 255))
+        image.paste(plot, plot_box[:2])
+        duration = (D.shape[1] - 1) * hop_length / sr
+        _draw_axes(image, plot_box, sr, duration, log_frequency, fmin)
+    else:
+        image = plot
+
+    return encode_image(image, format, quality)
+
+
+def encode_image(image, format='png', quality=80):
+    buffer = BytesIO()
+    if format == 'webp':
+        image.save(buffer, format='WEBP', quality=quality, method=4)
+    else:
+        image.save(buffer, format='PNG', optimize=False)
+    return buffer.getvalue()
+
+
+def render_spectrogram_set(D, sr):
+    # SPECTROGRAM_SIZES のサイズごとに描き、{サイズ: {形式: バイト列}} を返す
+    images = {}
+    for size, (width, height, axes) in SPECTROGRAM_SIZES.items():
+        images[size] = {
+            format: render_spectrogram(D, sr, width=width, height=height, axes=axes, format=format)
+            for format in SPECTROGRAM_FORMATS
+        }
+    return images
+
+
+def spectrogram_set(y, sr):
+    return render_spectrogram_set(spectrogram_db(y), sr)
+
+
+def resize_spectrogram_image(source, full_png=True):
+    # 既存のスペクトログラム画像（パスまたはファイル）を縮小して、render_spectrogram_set と同じ形の dict を返す
+    # 録音から描き直さないので、元の画像の軸や凡例もそのまま縮小される
+    # full_png=False の場合は元の画像をそのまま使う前提で、full の PNG を作らない
+    with Image.open(source) as image:
+        image = image.convert('RGB')
+    images = {}
+    for size, (width, height, _) in SPECTROGRAM_SIZES.items():
+        resized = image if image.size == (width, height) else image.resize((width, height), Image.Resampling.LANCZOS)
+        images[size] = {
+            format: encode_image(resized, format)
+            for format in SPECTROGRAM_FORMATS if full_png or (size, format) != ('full', 'png')
+        }
+    return images
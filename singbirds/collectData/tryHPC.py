@@ -1,9 +1,16 @@
 import pandas as pd
 import librosa
-import requests
-from io import BytesIO
 import numpy as np
 import csv
+import os
+import sys
+
+try:
+    from ..audio_store import open_audio
+except ImportError:
+    # スクリプトとして直接実行した場合はリポジトリのルートから読み込む
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    from singbirds.audio_store import open_audio
 
 # 無音部分の除去を含む音響特徴量の抽出関数
 def extract_features(audio_data, sr, silence_threshold=0.01):
@@ -72,12 +79,10 @@ def process_audio_features(input_csv_path, output_csv_path):
         recording_url = row['recording_url']
 
         try:
-            # recording_urlから音声データをダウンロード
-            response = requests.get(recording_url)
-            response.raise_for_status()
-
-            # librosaで音声データを読み込む
-            audio_data, sr = librosa.load(BytesIO(response.content), sr=None)
+            # recording_urlの音声データをキャッシュから読み込む（無ければダウンロードしてキャッシュする）
+            with open_audio(recording_url) as audio_file:
+                # librosaで音声データを読み込む
+                audio_data, sr = librosa.load(audio_file, sr=None)
 
             # 音響特徴量の抽出（無音部分を除去）
             features = extract_features(audio_data, sr)
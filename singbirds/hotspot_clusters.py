@@ -0,0 +1,119 @@
+from collections import defaultdict
+from django.db import transaction
+from .models import HotspotCluster
+from .spatial import tile_for
+
+# HotspotListView に表示されるホットスポット（hotspot_summary.eligible_hotspots）だけを集計する
+# 表示対象かどうかが変わった場合は hotspot_summary が差分を反映する
+
+# 事前集計するズームレベルの範囲。これより拡大した場合は /hotspots/?bbox= で個別に取得する
+MIN_CLUSTER_ZOOM = 0
+MAX_CLUSTER_ZOOM = 12
+
+BULK_BATCH_SIZE = 1000
+LOOKUP_BATCH_SIZE = 500
+
+
+def _tile_deltas(points, sign=1):
+    # (lat, lng, numSpAllTime) の列をタイルごとの増減 [count, lat_sum, lng_sum, num_sp_sum] に集約する
+    deltas = defaultdict(lambda: [0, 0.0, 0.0, 0])
+    for lat, lng, num_sp in points:
+        if lat is None or lng is None:
+            continue
+        lat, lng = float(lat), float(lng)
+        for zoom in range(MIN_CLUSTER_ZOOM, MAX_CLUSTER_ZOOM + 1):
+            delta = deltas[(zoom, *tile_for(lat, lng, zoom))]
+            delta[0] += sign
+            delta[1] += sign * lat
+            delta[2] += sign * lng
+            delta[3] += sign * (num_sp or 0)
+    return deltas
+
+
+def _apply_deltas(deltas):
+    # 既存のタイルは加算更新し、新しいタイルは作成、空になったタイルは削除する
+    by_zoom = defaultdict(dict)
+    for (zoom, x, y), delta in deltas.items():
+        by_zoom[zoom][(x, y)] = delta
+
+    with transaction.atomic():
+        for zoom, zoom_tiles in by_zoom.items():
+            keys = list(zoom_tiles)
+            for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+                tiles = {key: zoom_tiles[key] for key in keys[start:start + LOOKUP_BATCH_SIZE]}
+                _apply_zoom_deltas(zoom, tiles)
+
+
+def _apply_zoom_deltas(zoom, tiles):
+    existing = {}
+    xs = {x for x, _ in tiles}
+    ys = {y for _, y in tiles}
+    for cluster in HotspotCluster.objects.filter(zoom=zoom, tile_x__in=xs, tile_y__in=ys):
+        if (cluster.tile_x, cluster.tile_y) in tiles:
+            existing[(cluster.tile_x, cluster.tile_y)] = cluster
+
+    to_create, to_update, to_delete = [], [], []
+    for key, (count, lat_sum, lng_sum, num_sp_sum) in tiles.items():
+        cluster = existing.get(key)
+        if cluster is None:
+            if count > 0:
+                to_create.append(HotspotCluster(
+                    zoom=zoom, tile_x=key[0], tile_y=key[1], count=count,
+                    lat_sum=lat_sum, lng_sum=lng_sum, num_sp_sum=num_sp_sum,
+                ))
+            continue
+
+        cluster.count += count
+        cluster.lat_sum += lat_sum
+        cluster.lng_sum += lng_sum
+        cluster.num_sp_sum += num_sp_sum
+        if cluster.count > 0:
+            to_update.append(cluster)
+        else:
+            to_delete.append(cluster.pk)
+
+    HotspotCluster.objects.bulk_create(to_create, batch_size=BULK_BATCH_SIZE)
+    HotspotCluster.objects.bulk_update(
+        to_update, ['count', 'lat_sum', 'lng_sum', 'num_sp_sum'], batch_size=BULK_BATCH_SIZE
+    )
+    if to_delete:
+        HotspotCluster.objects.filter(pk__in=to_delete).delete()
+
+
+def update_hotspot_clusters(added=(), removed=()):
+    # ホットスポットの追加・削除分だけタイルピラミッドを差分更新する
+    # added / removed は (lat, lng, numSpAllTime) のタプルの列
+    deltas = _tile_deltas(added)
+    for key, delta in _tile_deltas(removed, sign=-1).items():
+        current = deltas[key]
+        for i, value in enumerate(delta):
+            current[i] += value
+    _apply_deltas(deltas)
+
+
+def update_changed_hotspot_clusters(changes):
+    # changes は (変更前の点, 変更後の点) の列。点は (lat, lng, numSpAllTime) で、集計の対象外なら None
+    added, removed = [], []
+    for old, new in changes:
+        if old == new:
+            continue
+        if old is not None:
+            removed.append(old)
+        if new is not None:
+            added.append(new)
+    if added or removed:
+        update_hotspot_clusters(added=added, removed=removed)
+
+
+def rebuild_hotspot_clusters(hotspots):
+    # 集計対象のホットスポットのクエリセットからタイルピラミッドを作り直す
+    deltas = _tile_deltas(hotspots.values_list('lat', 'lng', 'numSpAllTime').iterator(chunk_size=BULK_BATCH_SIZE))
+    clusters = [
+        HotspotCluster(zoom=zoom, tile_x=x, tile_y=y, count=count,
+                       lat_sum=lat_sum, lng_sum=lng_sum, num_sp_sum=num_sp_sum)
+        for (zoom, x, y), (count, lat_sum, lng_sum, num_sp_sum) in deltas.items()
+    ]
+    with transaction.atomic():
+        HotspotCluster.objects.all().delete()
+        HotspotCluster.objects.bulk_create(clusters, batch_size=BULK_BATCH_SIZE)
+    return len(clusters)
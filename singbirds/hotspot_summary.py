@@ -0,0 +1,86 @@
+from django.db.models import Count, Q
+from .models import Bird, Hotspot
+from .hotspot_clusters import rebuild_hotspot_clusters, update_changed_hotspot_clusters
+
+# HotspotListView に表示するために必要な「録音を持つ鳥」の最小種数
+MIN_VALID_BIRDS = 10
+
+# 一度に再計算するホットスポット数（SQLのパラメータ数制限対策）
+REFRESH_BATCH_SIZE = 500
+
+
+def eligible_hotspots():
+    # HotspotListView に表示され、クラスタに集計されるホットスポット
+    return Hotspot.objects.filter(valid_bird_count__gte=MIN_VALID_BIRDS)
+
+
+def cluster_point(lat, lng, num_sp, valid_bird_count):
+    # クラスタに集計する点。表示対象でなければ None（DB の Decimal と入力の float を比較できるよう float に揃える）
+    if valid_bird_count < MIN_VALID_BIRDS or lat is None or lng is None:
+        return None
+    return (float(lat), float(lng), num_sp)
+
+
+def valid_bird_counts(hotspot_ids):
+    # {hotspot_id: valid_bird_count}
+    hotspot_ids = list(set(hotspot_ids))
+    counts = {}
+    for start in range(0, len(hotspot_ids), REFRESH_BATCH_SIZE):
+        counts.update(Hotspot.objects.filter(
+            hotspot_id__in=hotspot_ids[start:start + REFRESH_BATCH_SIZE]
+        ).values_list('hotspot_id', 'valid_bird_count'))
+    return counts
+
+
+def _count_valid_birds(hotspots):
+    # 録音（BirdDetail）を1件以上持つ鳥の種数をホットスポットごとに数える
+    return hotspots.annotate(
+        computed_count=Count('birds', filter=Q(birds__birddetail__isnull=False), distinct=True)
+    )
+
+
+def refresh_valid_bird_counts(hotspot_ids):
+    # 指定したホットスポットの valid_bird_count を再計算し、変化したものだけ更新する
+    # 表示対象になった・外れたホットスポットはクラスタにも反映する
+    hotspot_ids = list(set(hotspot_ids))
+    updated = 0
+
+    for start in range(0, len(hotspot_ids), REFRESH_BATCH_SIZE):
+        batch_ids = hotspot_ids[start:start + REFRESH_BATCH_SIZE]
+        changed, cluster_changes = [], []
+        hotspots = _count_valid_birds(Hotspot.objects.filter(hotspot_id__in=batch_ids)).only(
+            'hotspot_id', 'valid_bird_count', 'lat', 'lng', 'numSpAllTime'
+        )
+        for hotspot in hotspots:
+            if hotspot.valid_bird_count != hotspot.computed_count:
+                point = (hotspot.lat, hotspot.lng, hotspot.numSpAllTime)
+                cluster_changes.append((
+                    cluster_point(*point, hotspot.valid_bird_count), cluster_point(*point, hotspot.computed_count)
+                ))
+                hotspot.valid_bird_count = hotspot.computed_count
+                changed.append(hotspot)
+
+        if changed:
+            Hotspot.objects.bulk_update(changed, ['valid_bird_count'])
+            update_changed_hotspot_clusters(cluster_changes)
+            updated += len(changed)
+
+    return updated
+
+
+def refresh_valid_bird_counts_for_birds(bird_ids):
+    # 鳥に紐づく全ホットスポットを再計算する（録音の追加・削除時に使用）
+    through = Bird.hotspots.through
+    hotspot_ids = through.objects.filter(bird_id__in=list(bird_ids)).values_list('hotspot_id', flat=True)
+    return refresh_valid_bird_counts(hotspot_ids)
+
+
+def rebuild_valid_bird_counts():
+    # 全ホットスポットの valid_bird_count を作り直す
+    hotspot_ids = Hotspot.objects.values_list('hotspot_id', flat=True)
+    return refresh_valid_bird_counts(hotspot_ids)
+
+
+def rebuild_eligible_hotspot_clusters():
+    # 表示対象のホットスポットからクラスタを作り直す。作成したタイルの数を返す
+    return rebuild_hotspot_clusters(eligible_hotspots())
@@ -0,0 +1,196 @@
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import timedelta
+from django.db import connection
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
+from .models import Job
+
+logger = logging.getLogger("app")
+
+# 進捗をDBに書き込む最短間隔（秒）。この間隔でキャンセルの確認と heartbeat の更新も行う
+PROGRESS_FLUSH_INTERVAL = 2.0
+
+# 管理画面のジョブ一覧を自動で再読み込みする間隔（秒）
+JOB_REFRESH_SECONDS = 5
+
+# これより長く heartbeat が更新されない実行中のジョブは、ワーカーが停止したとみなす
+STALE_JOB_TIMEOUT = timedelta(minutes=10)
+
+# ジョブの実行中に heartbeat を更新する間隔（秒）。STALE_JOB_TIMEOUT より十分短くする
+# 進捗を報告しない長い処理（次元削減や索引の更新など）の間も、ワーカーが動いていればこの間隔で更新する
+HEARTBEAT_INTERVAL = 60.0
+
+# Job.errors に保存するエラーメッセージの上限
+MAX_JOB_ERRORS = 200
+
+# ジョブ名 -> 処理関数。処理関数は (progress, **params) を受け取り、JSON にできる結果を返す
+_registry = {}
+
+
+class JobCancelled(BaseException):
+    # 処理側の except Exception で握りつぶされないよう BaseException を継承する
+    pass
+
+
+def register_job(name):
+    def decorator(func):
+        _registry[name] = func
+        return func
+    return decorator
+
+
+def enqueue_job(name, **params):
+    if name not in _registry:
+        raise ValueError(f"Unknown job: {name}")
+    return Job.objects.create(name=name, params=params)
+
+
+def enqueue_admin_job(modeladmin, request, name, **params):
+    # 管理アクションからジョブを投入し、進捗を確認できるジョブ画面へのリンクを表示する
+    job = enqueue_job(name, **params)
+    url = reverse('admin:singbirds_job_change', args=[job.pk])
+    modeladmin.message_user(request, format_html('Queued job <a href="{}">#{} {}</a>. Run "manage.py run_jobs" to process it.', url, job.pk, name))
+    return job
+
+
+class Progress:
+    # 進捗の報告先。ジョブの外から処理を呼び出した場合はログに出すだけ
+    def set_total(self, total):
+        pass
+
+    def advance(self, count=1):
+        pass
+
+    def info(self, message):
+        logger.info(message)
+
+    def error(self, message):
+        logger.error(message)
+
+
+class JobProgress(Progress):
+    # 実行中のジョブの進捗を Job に書き込む（書き込みは PROGRESS_FLUSH_INTERVAL ごとにまとめる）
+    def __init__(self, job):
+        self.job = job
+        self.last_flush = time.monotonic()
+
+    def set_total(self, total):
+        self.job.progress_total = total
+        self.flush(force=True)
+
+    def advance(self, count=1):
+        self.job.progress_done += count
+        self.flush()
+
+    def info(self, message):
+        super().info(message)
+        self.job.message = message
+        self.flush()
+
+    def error(self, message):
+        super().error(message)
+        if len(self.job.errors) < MAX_JOB_ERRORS:
+            self.job.errors.append(message)
+        self.flush()
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_flush < PROGRESS_FLUSH_INTERVAL:
+            return
+        self.last_flush = now
+
+        # 管理画面でキャンセルされていれば、状態が running ではなくなっている
+        updated = Job.objects.filter(pk=self.job.pk, state=Job.RUNNING).update(
+            progress_done=self.job.progress_done,
+            progress_total=self.job.progress_total,
+            message=self.job.message,
+            errors=self.job.errors,
+            heartbeat_at=timezone.now(),
+        )
+        if not updated:
+            raise JobCancelled()
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_next_job(worker):
+    # 最も古い queued のジョブを running にして返す。複数のワーカーが同時に動いても1つだけが取得できる
+    while True:
+        job_id = Job.objects.filter(state=Job.QUEUED).order_by('created_at', 'pk').values_list('pk', flat=True).first()
+        if job_id is None:
+            return None
+
+        now = timezone.now()
+        claimed = Job.objects.filter(pk=job_id, state=Job.QUEUED).update(
+            state=Job.RUNNING, worker=worker, started_at=now, heartbeat_at=now,
+        )
+        if claimed:
+            return Job.objects.get(pk=job_id)
+
+
+def fail_stale_jobs():
+    # heartbeat が途絶えた実行中のジョブを失敗にする（処理が冪等とは限らないので自動では再実行しない）
+    now = timezone.now()
+    return Job.objects.filter(state=Job.RUNNING, heartbeat_at__lt=now - STALE_JOB_TIMEOUT).update(
+        state=Job.FAILED, finished_at=now, message="The worker stopped responding.",
+    )
+
+
+def _keep_alive(job_id, stopped):
+    # ジョブの処理とは別のスレッドで heartbeat を更新する（スレッドごとの DB 接続は終了時に閉じる）
+    try:
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                Job.objects.filter(pk=job_id, state=Job.RUNNING).update(heartbeat_at=timezone.now())
+            except Exception:
+                logger.exception(f"Failed to update heartbeat of job #{job_id}")
+    finally:
+        connection.close()
+
+
+def run_job(job):
+    progress = JobProgress(job)
+    result = None
+    stopped = threading.Event()
+    heartbeat = threading.Thread(target=_keep_alive, args=(job.pk, stopped), daemon=True)
+    heartbeat.start()
+    try:
+        func = _registry.get(job.name)
+        if func is None:
+            raise LookupError(f"Unknown job: {job.name}")
+        result = func(progress, **job.params)
+        state = Job.SUCCEEDED
+    except JobCancelled:
+        state = Job.CANCELLED
+    except Exception as e:
+        logger.exception(f"Job #{job.pk} {job.name} failed")
+        job.errors.append(f"{type(e).__name__}: {e}\n{traceback.format_exc(limit=5)}")
+        job.message = f"Failed: {e}"
+        state = Job.FAILED
+    finally:
+        stopped.set()
+        heartbeat.join()
+
+    # キャンセルされたジョブの状態は上書きしない
+    now = timezone.now()
+    Job.objects.filter(pk=job.pk, state=Job.RUNNING).update(
+        state=state,
+        result=result,
+        progress_done=job.progress_done,
+        progress_total=job.progress_total,
+        message=job.message,
+        errors=job.errors,
+        heartbeat_at=now,
+        finished_at=now,
+    )
+    Job.objects.filter(pk=job.pk, state=Job.CANCELLED, finished_at__isnull=True).update(finished_at=now)
+    job.refresh_from_db()
+    return job
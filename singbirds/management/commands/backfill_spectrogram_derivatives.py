@@ -0,0 +1,65 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from django.core.management.base import BaseCommand
+from ...api_cache import bump_data_version
+from ...collectData.createSpectrogram import save_spectrogram_images
+from ...collectData.recordingPipeline import available_cores
+from ...collectData.spectrogramImage import resize_spectrogram_image
+from ...models import BirdDetail
+
+
+class Command(BaseCommand):
+    help = (
+        "保存済みのスペクトログラム画像（spectrograms/）から、サムネイル・モバイル・フルサイズの PNG / WebP を作成します。\n"
+        "派生画像が無い BirdDetail だけを対象にし、画像の縮小は複数のプロセスで並行して行います。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=0, help="ワーカープロセス数（0 は使える CPU コア数）")
+        parser.add_argument('--batch-size', type=int, default=100, help="まとめて処理・保存する件数")
+        parser.add_argument('--force', action='store_true', help="派生画像がある BirdDetail も作り直す")
+
+    def handle(self, *args, **options):
+        details = BirdDetail.objects.exclude(spectrogram='').exclude(spectrogram__isnull=True).order_by('birddetail_id')
+        if not options['force']:
+            details = details.filter(spectrogram_derivatives={})
+        total = details.count()
+        self.stdout.write(f"{total} spectrograms to backfill.")
+
+        batch_size = options['batch_size']
+        done = failed = 0
+        with ProcessPoolExecutor(
+            max_workers=options['workers'] or available_cores(),
+            mp_context=multiprocessing.get_context('forkserver'),
+        ) as executor:
+            # 1バッチ分ずつ主キーの順に取得・投入し、保存してから次に進む（件数によらず使用メモリは一定）
+            last_id = 0
+            while True:
+                batch = list(details.filter(birddetail_id__gt=last_id).only('birddetail_id', 'spectrogram')[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].pk
+                saved, errors = self.process_batch(executor, batch)
+                done, failed = done + saved, failed + errors
+                self.stdout.write(f"{done + failed}/{total}")
+
+        if done:
+            bump_data_version()
+        self.stdout.write(self.style.SUCCESS(f"Created derivatives for {done} spectrograms ({failed} failed)."))
+
+    def process_batch(self, executor, batch):
+        # full の PNG は既存のファイルをそのまま使う
+        resize = partial(resize_spectrogram_image, full_png=False)
+        futures = [(detail, executor.submit(resize, detail.spectrogram.path)) for detail in batch]
+        updated = []
+        for detail, future in futures:
+            try:
+                images = future.result()
+            except Exception as e:
+                self.stderr.write(f"Failed to resize spectrogram for BirdDetail ID {detail.pk}: {e}")
+                continue
+            save_spectrogram_images(detail, images, save=False)
+            updated.append(detail)
+        BirdDetail.objects.bulk_update(updated, ['spectrogram_derivatives'])
+        return len(updated), len(batch) - len(updated)
@@ -0,0 +1,69 @@
+import time
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from ...audio_store import load_audio
+from ...collectData.featureEngine import extract_features, extract_features_reference
+from ...models import BirdDetail
+
+
+def synthetic_clip(sr, seconds, rng):
+    # 録音が無い環境でも比較できるよう、チャープとノイズの信号を作る
+    t = np.arange(int(sr * seconds)) / sr
+    start = rng.uniform(1000, 4000)
+    y = 0.5 * np.sin(2 * np.pi * (start + rng.uniform(500, 2000) * t) * t) + 0.05 * rng.standard_normal(len(t))
+    return y.astype(np.float32)
+
+
+class Command(BaseCommand):
+    help = (
+        "音響特徴量の抽出を、特徴量ごとに STFT を計算する以前の実装と比較し、1クリップあたりの時間を表示します。\n"
+        "--recordings を指定するとキャッシュ済み（または取得した）BirdDetail の録音を使い、指定しなければ合成音を使います。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clips', type=int, default=20, help="クリップ数")
+        parser.add_argument('--seconds', type=float, default=30, help="合成音の長さ（秒）")
+        parser.add_argument('--sr', type=int, default=16000, help="サンプリングレート")
+        parser.add_argument('--repeat', type=int, default=3, help="各クリップの繰り返し回数（最短の時間を使う）")
+        parser.add_argument('--recordings', action='store_true', help="BirdDetail の録音を使う")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        sr = options['sr']
+        if options['recordings']:
+            urls = BirdDetail.objects.exclude(recording_url='').values_list('recording_url', flat=True)[:options['clips']]
+            clips = [load_audio(url, sr=sr)[0] for url in urls]
+            if not clips:
+                raise CommandError("No recordings found.")
+        else:
+            rng = np.random.default_rng(options['seed'])
+            clips = [synthetic_clip(sr, options['seconds'], rng) for _ in range(options['clips'])]
+
+        timings = {'reference': [], 'engine': []}
+        max_diff = 0.0
+        for y in clips:
+            for name, func in (('reference', extract_features_reference), ('engine', extract_features)):
+                best = None
+                for _ in range(options['repeat']):
+                    started = time.perf_counter()
+                    features = func(y, sr)
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+                timings[name].append(best)
+                if name == 'reference':
+                    expected = features
+            # 2つの実装の結果の差（相対誤差の最大値）
+            for key, value in expected.items():
+                value, actual = np.asarray(value, dtype=np.float64), np.asarray(features[key], dtype=np.float64)
+                scale = np.maximum(np.abs(value), 1e-6)
+                max_diff = max(max_diff, float(np.max(np.abs(actual - value) / scale)))
+
+        self.stdout.write(f"{len(clips)} clips at {sr} Hz, best of {options['repeat']} runs each")
+        self.stdout.write(f"{'implementation':<16}{'mean ms':>10}{'median ms':>11}{'total s':>10}")
+        for name, values in timings.items():
+            self.stdout.write(
+                f"{name:<16}{np.mean(values) * 1000:>10.1f}{np.median(values) * 1000:>11.1f}{np.sum(values):>10.2f}"
+            )
+        speedups = np.array(timings['reference']) / np.array(timings['engine'])
+        self.stdout.write(f"Speedup per clip: mean {speedups.mean():.2f}x, min {speedups.min():.2f}x, max {speedups.max():.2f}x")
+        self.stdout.write(f"Max relative difference: {max_diff:.2e}")
@@ -0,0 +1,161 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from collections import defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+from rest_framework.renderers import JSONRenderer
+from ...api_cache import get_data_version
+from ...hotspot_summary import MIN_VALID_BIRDS
+from ...models import Bird, BirdDetail, Hotspot
+from ...serializers.hotspots_serializer import HotspotSerializer
+from ...views.bird_views import hotspot_birds_data
+from ...views.birddetail_views import bird_details_data
+
+try:
+    import brotli
+except ImportError:  # Brotli が無い環境では .br を作らない
+    brotli = None
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def _fingerprint(rows):
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update(repr(row).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _remove(path):
+    for suffix in ('', '.gz', '.br'):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+class Command(BaseCommand):
+    help = (
+        "公開APIのレスポンスを静的なJSONファイル（.gz / .br 付き）として書き出します。\n"
+        "  hotspots/index.json                 -> /api/hotspots/\n"
+        "  hotspots/<id>/birds/index.json      -> /api/hotspots/<id>/birds/\n"
+        "  birds/<id>/details/index.json       -> /api/birds/<id>/details/\n"
+        "元データが変わったファイルだけを書き直します。nginx では gzip_static / brotli_static と\n"
+        "try_files $uri $uri/index.json @django; で配信できます。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=os.path.join(settings.MEDIA_ROOT, 'api'))
+        parser.add_argument('--force', action='store_true', help="すべてのファイルを書き直す")
+
+    def handle(self, *args, **options):
+        self.output = options['output']
+        self.renderer = JSONRenderer()
+        os.makedirs(self.output, exist_ok=True)
+
+        manifest_path = os.path.join(self.output, MANIFEST_NAME)
+        manifest = {'data_version': None, 'files': {}}
+        if os.path.exists(manifest_path) and not options['force']:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        data_version = get_data_version()
+        if manifest['data_version'] == data_version:
+            self.stdout.write("Data version has not changed since the last export.")
+            return
+
+        old_files = manifest['files']
+        new_files = {}
+        written = 0
+
+        for relpath, fingerprint, build in self.iter_files():
+            new_files[relpath] = fingerprint
+            if old_files.get(relpath) == fingerprint and os.path.exists(os.path.join(self.output, relpath)):
+                continue
+            self.write(relpath, build())
+            written += 1
+
+        # 対象外になったファイルを削除
+        removed = 0
+        for relpath in set(old_files) - set(new_files):
+            _remove(os.path.join(self.output, relpath))
+            removed += 1
+
+        _write_atomic(manifest_path, json.dumps({'data_version': data_version, 'files': new_files}).encode('utf-8'))
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {written} files, removed {removed}, unchanged {len(new_files) - written}."
+        ))
+
+    def iter_files(self):
+        # (出力パス, 元データの指紋, データを作る関数) を返す。指紋は一括のクエリで求める
+        hotspots = Hotspot.objects.filter(valid_bird_count__gte=MIN_VALID_BIRDS).order_by('hotspot_id')
+        fields = [
+            'countrycode_id' if field == 'countrycode' else field
+            for field in HotspotSerializer.Meta.fields
+        ]
+        yield (
+            'hotspots/index.json',
+            _fingerprint(hotspots.values_list(*fields).iterator()),
+            lambda: HotspotSerializer(hotspots, many=True).data,
+        )
+
+        # ホットスポットごとの鳥一覧（録音のある鳥のみ）
+        names = dict(hotspots.values_list('hotspot_id', 'locName'))
+        links = defaultdict(list)
+        has_detail = Exists(BirdDetail.objects.filter(bird_id=OuterRef('bird_id')))
+        rows = (
+            Bird.hotspots.through.objects
+            .filter(has_detail, hotspot_id__in=hotspots.values('hotspot_id'))
+            .values_list('hotspot_id', 'bird_id', 'bird__speciesCode', 'bird__sciName', 'bird__comName')
+            .order_by('hotspot_id', 'bird_id')
+        )
+        for row in rows.iterator():
+            links[row[0]].append(row[1:])
+
+        for hotspot_id, loc_name in names.items():
+            yield (
+                f'hotspots/{hotspot_id}/birds/index.json',
+                _fingerprint([loc_name, *links.get(hotspot_id, [])]),
+                lambda hotspot_id=hotspot_id: hotspot_birds_data(Hotspot.objects.get(hotspot_id=hotspot_id)),
+            )
+
+        # 鳥ごとの録音一覧
+        details = defaultdict(list)
+        rows = BirdDetail.objects.values_list(
+            'bird_id', 'birddetail_id', 'recording_url', 'spectrogram', 'spectrogram_derivatives'
+        ).order_by('bird_id', 'birddetail_id')
+        for row in rows.iterator():
+            details[row[0]].append(row[1:])
+
+        for bird_id, com_name in Bird.objects.filter(birddetail__isnull=False).distinct().values_list('bird_id', 'comName'):
+            yield (
+                f'birds/{bird_id}/details/index.json',
+                _fingerprint([com_name, *details[bird_id]]),
+                lambda bird_id=bird_id: bird_details_data(Bird.objects.get(bird_id=bird_id)),
+            )
+
+    def write(self, relpath, data):
+        path = os.path.join(self.output, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        body = self.renderer.render(data)
+        _write_atomic(path, body)
+        _write_atomic(path + '.gz', gzip.compress(body, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write_atomic(path + '.br', brotli.compress(body, quality=11))
@@ -0,0 +1,95 @@
+import asyncio
+import random
+import time
+import aiohttp
+from django.core.management.base import BaseCommand, CommandError
+from ...hotspot_summary import MIN_VALID_BIRDS
+from ...models import BirdDetail, Hotspot
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Command(BaseCommand):
+    help = (
+        "公開APIに負荷をかけ、スループットと p50 / p99 レイテンシを比較します。\n"
+        "例: loadtest_api --target wsgi=http://127.0.0.1:8000/api/ --target asgi=http://127.0.0.1:8001/api/async/"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', action='append', required=True, help="name=base_url（複数指定可）")
+        parser.add_argument('--requests', type=int, default=2000, help="対象ごとのリクエスト数")
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--timeout', type=float, default=30)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        targets = []
+        for target in options['target']:
+            name, sep, base_url = target.partition('=')
+            if not sep or not base_url:
+                raise CommandError(f"Invalid target '{target}'. Use name=base_url.")
+            targets.append((name, base_url if base_url.endswith('/') else base_url + '/'))
+
+        paths = self.build_paths(options['requests'], random.Random(options['seed']))
+
+        self.stdout.write(f"{'target':<12}{'ok':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for name, base_url in targets:
+            latencies, errors, elapsed = asyncio.run(
+                self.run_target(base_url, paths, options['concurrency'], options['timeout'])
+            )
+            self.stdout.write(
+                f"{name:<12}{len(latencies):>8}{errors:>8}{len(latencies) / elapsed:>10.1f}"
+                f"{percentile(latencies, 50) * 1000:>10.1f}{percentile(latencies, 99) * 1000:>10.1f}"
+            )
+
+    def build_paths(self, count, rng):
+        # 対象となる3つのエンドポイントを、ローカルDBに存在するIDで混ぜて呼び出す
+        hotspot_ids = list(Hotspot.objects.filter(valid_bird_count__gte=MIN_VALID_BIRDS).values_list('hotspot_id', flat=True)[:5000])
+        bird_ids = list(BirdDetail.objects.values_list('bird_id', flat=True).distinct()[:5000])
+        if not hotspot_ids or not bird_ids:
+            raise CommandError("No data to test. Run seed_loadtest_data on a local database first.")
+
+        paths = []
+        for i in range(count):
+            kind = i % 3
+            if kind == 0:
+                paths.append('hotspots/')
+            elif kind == 1:
+                paths.append(f'hotspots/{rng.choice(hotspot_ids)}/birds/')
+            else:
+                paths.append(f'birds/{rng.choice(bird_ids)}/random-detail/')
+        rng.shuffle(paths)
+        return paths
+
+    async def run_target(self, base_url, paths, concurrency, timeout):
+        latencies = []
+        errors = 0
+        semaphore = asyncio.Semaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+            async def fetch(path):
+                nonlocal errors
+                async with semaphore:
+                    started = time.perf_counter()
+                    try:
+                        async with session.get(base_url + path) as response:
+                            await response.read()
+                            if response.status != 200:
+                                errors += 1
+                                return
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        errors += 1
+                        return
+                    latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(fetch(path) for path in paths))
+            elapsed = time.perf_counter() - started
+
+        return latencies, errors, max(elapsed, 1e-9)
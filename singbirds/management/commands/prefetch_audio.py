@@ -0,0 +1,61 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from django.core.management.base import BaseCommand
+from ...audio_store import get_audio_store
+from ...models import BirdDetail
+
+
+class Command(BaseCommand):
+    help = (
+        "BirdDetail の録音をローカルの音声キャッシュ（AUDIO_STORE_PATH）に事前にダウンロードします。\n"
+        "キャッシュ済みの録音はダウンロードしません。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help="同時ダウンロード数")
+        parser.add_argument('--bird', type=int, action='append', help="対象の bird_id（複数指定可）")
+        parser.add_argument('--missing-spectrograms', action='store_true', help="スペクトログラム未作成の録音だけを対象にする")
+        parser.add_argument('--missing-features', action='store_true', help="音響特徴量が未抽出の録音だけを対象にする")
+        parser.add_argument('--limit', type=int)
+
+    def handle(self, *args, **options):
+        details = BirdDetail.objects.exclude(recording_url='').order_by('birddetail_id')
+        if options['bird']:
+            details = details.filter(bird_id__in=options['bird'])
+        if options['missing_spectrograms']:
+            details = details.filter(spectrogram='')
+        if options['missing_features']:
+            details = details.filter(acousticparameters__isnull=True)
+        urls = list(dict.fromkeys(details.values_list('recording_url', flat=True)))
+        if options['limit']:
+            urls = urls[:options['limit']]
+
+        store = get_audio_store()
+        missing = [url for url in urls if not store.contains(url)]
+        self.stdout.write(f"{len(urls) - len(missing)} of {len(urls)} recordings are already cached.")
+
+        # スレッドごとに接続を使い回す
+        local = threading.local()
+
+        def fetch(url):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            store.fetch(url, session=local.session)
+
+        fetched, failed = 0, 0
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            futures = {executor.submit(fetch, url): url for url in missing}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    fetched += 1
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"Failed to fetch {futures[future]}: {e}")
+                if (fetched + failed) % 100 == 0:
+                    self.stdout.write(f"{fetched + failed} / {len(missing)}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Fetched {fetched} recordings ({failed} failed). Cache size: {store.total_bytes() / 1024 ** 2:.1f} MB"
+        ))
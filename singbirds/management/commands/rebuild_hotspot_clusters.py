@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from ...hotspot_summary import MIN_VALID_BIRDS, rebuild_eligible_hotspot_clusters
+
+
+class Command(BaseCommand):
+    help = f"HotspotListView に表示される（録音を持つ鳥が {MIN_VALID_BIRDS} 種以上の）ホットスポットからズームレベル別のクラスタ（タイルピラミッド）を再作成します"
+
+    def handle(self, *args, **options):
+        created = rebuild_eligible_hotspot_clusters()
+        self.stdout.write(self.style.SUCCESS(f"Created {created} hotspot cluster tiles."))
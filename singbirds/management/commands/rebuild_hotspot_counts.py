@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from ...api_cache import bump_data_version
+from ...hotspot_summary import rebuild_valid_bird_counts
+
+
+class Command(BaseCommand):
+    help = "全ホットスポットの valid_bird_count（録音を持つ鳥の種数）を再計算します"
+
+    def handle(self, *args, **options):
+        updated = rebuild_valid_bird_counts()
+        if updated:
+            bump_data_version()
+        self.stdout.write(self.style.SUCCESS(f"Updated valid_bird_count for {updated} hotspots."))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from ...api_cache import bump_data_version
+from ...models import Hotspot
+from ...spatial import grid_cell_for
+
+
+class Command(BaseCommand):
+    help = "全ホットスポットの grid_cell（空間検索用のセル番号）を再計算します"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        changed = []
+        updated = 0
+
+        for hotspot in Hotspot.objects.only('hotspot_id', 'lat', 'lng', 'grid_cell').iterator(chunk_size=batch_size):
+            grid_cell = grid_cell_for(hotspot.lat, hotspot.lng)
+            if hotspot.grid_cell != grid_cell:
+                hotspot.grid_cell = grid_cell
+                changed.append(hotspot)
+
+            if len(changed) >= batch_size:
+                Hotspot.objects.bulk_update(changed, ['grid_cell'])
+                updated += len(changed)
+                changed = []
+
+        if changed:
+            Hotspot.objects.bulk_update(changed, ['grid_cell'])
+            updated += len(changed)
+
+        if updated:
+            bump_data_version()
+        self.stdout.write(self.style.SUCCESS(f"Updated grid_cell for {updated} hotspots."))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from ...similarity import rebuild_similarity_index
+
+
+class Command(BaseCommand):
+    help = "AcousticParameters 全体から類似検索用の近傍索引を作成し、SIMILARITY_INDEX_PATH に保存します"
+
+    def handle(self, *args, **options):
+        count = rebuild_similarity_index()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} recordings."))
@@ -0,0 +1,77 @@
+import json
+from django.core.management.base import BaseCommand
+from ...collectData.collectParameters import build_acoustic_parameters
+from ...collectData.featureEngine import summarize
+from ...collectData.frameFeatureStore import DEFAULT_PERCENTILES, frame_statistics, load_frame_features
+from ...models import AcousticParameters
+from ...similarity import rebuild_similarity_index
+
+# 保存したフレームごとの特徴量から求め直す AcousticParameters のフィールド
+SUMMARY_FIELDS = [
+    'mfcc_features', 'chroma_features', 'spectral_bandwidth', 'spectral_contrast', 'spectral_flatness',
+    'rms_energy', 'zero_crossing_rate', 'spectral_centroid', 'spectral_rolloff',
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "保存済みのフレームごとの特徴量（frame_features/）から、録音を読み込まずに AcousticParameters の平均値を求め直します。\n"
+        "--statistics を指定すると、平均・標準偏差・パーセンタイルを録音ごとに JSON Lines で書き出します。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="まとめて読み込み・保存する件数")
+        parser.add_argument('--statistics', metavar='PATH', help="統計量を書き出すファイル（JSON Lines）")
+        parser.add_argument('--percentiles', type=float, nargs='*', default=list(DEFAULT_PERCENTILES),
+                            help="--statistics で求めるパーセンタイル")
+        parser.add_argument('--no-update', action='store_true', help="AcousticParameters を更新しない")
+
+    def handle(self, *args, **options):
+        records = AcousticParameters.objects.exclude(frame_features='').exclude(frame_features__isnull=True).order_by('parameter_id')
+        total = records.count()
+        self.stdout.write(f"{total} recordings with frame features.")
+
+        output = open(options['statistics'], 'w') if options['statistics'] else None
+        done = failed = 0
+        try:
+            # 主キーの順に1バッチずつ処理する（件数によらず使用メモリは一定）
+            last_id = 0
+            while True:
+                batch = list(records.filter(parameter_id__gt=last_id).only(
+                    'parameter_id', 'bird_id', 'birddetail_id', 'frame_features'
+                )[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1].pk
+
+                updated = []
+                for record in batch:
+                    try:
+                        frames = load_frame_features(record.frame_features.path)
+                        if output:
+                            output.write(json.dumps({
+                                'birddetail_id': record.birddetail_id_id,
+                                'bird_id': record.bird_id_id,
+                                'frames': next(iter(frames.values())).shape[1],
+                                'statistics': frame_statistics(frames, options['percentiles']),
+                            }) + "\n")
+                        if not options['no_update']:
+                            parameters = build_acoustic_parameters(record.birddetail_id_id, record.bird_id_id, summarize(frames))
+                            parameters.pk = record.pk
+                            updated.append(parameters)
+                    except Exception as e:
+                        failed += 1
+                        self.stderr.write(f"Failed to read frame features for BirdDetail ID {record.birddetail_id_id}: {e}")
+                        continue
+                    done += 1
+                if updated:
+                    AcousticParameters.objects.bulk_update(updated, SUMMARY_FIELDS)
+                self.stdout.write(f"{done + failed}/{total}")
+        finally:
+            if output:
+                output.close()
+
+        # 平均値が変わったので類似検索の索引も作り直す
+        if done and not options['no_update']:
+            rebuild_similarity_index()
+        self.stdout.write(self.style.SUCCESS(f"Processed {done} recordings ({failed} failed)."))
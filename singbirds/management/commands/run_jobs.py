@@ -0,0 +1,42 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from ...jobs import claim_next_job, fail_stale_jobs, run_job, worker_name
+from ...models import Job
+
+
+class Command(BaseCommand):
+    help = (
+        "管理画面から投入されたジョブ（Job）を順に実行するワーカーです。\n"
+        "外部のブローカーは不要で、DBをキューとして使います。複数起動しても同じジョブは1つのワーカーだけが実行します。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=2.0, help="キューが空のときの確認間隔（秒）")
+        parser.add_argument('--once', action='store_true', help="キューが空になったら終了する")
+        parser.add_argument('--max-jobs', type=int, help="指定した件数を実行したら終了する")
+
+    def handle(self, *args, **options):
+        worker = worker_name()
+        processed = 0
+        self.stdout.write(f"Worker {worker} started.")
+
+        while options['max_jobs'] is None or processed < options['max_jobs']:
+            close_old_connections()
+            stale = fail_stale_jobs()
+            if stale:
+                self.stderr.write(f"Marked {stale} stale jobs as failed.")
+
+            job = claim_next_job(worker)
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+                continue
+
+            self.stdout.write(f"Running job #{job.pk} {job.name}...")
+            job = run_job(job)
+            processed += 1
+
+            style = self.style.SUCCESS if job.state == Job.SUCCEEDED else self.style.ERROR
+            self.stdout.write(style(f"Job #{job.pk} {job.name} {job.state} ({len(job.errors)} errors)."))
@@ -0,0 +1,67 @@
+import random
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from ...api_cache import bump_data_version
+from ...hotspot_summary import rebuild_eligible_hotspot_clusters, rebuild_valid_bird_counts
+from ...models import Bird, BirdDetail, Country, Hotspot
+from ...spatial import grid_cell_for
+
+
+class Command(BaseCommand):
+    help = "負荷試験用のダミーデータ（国・ホットスポット・鳥・録音）をローカルDBに作成します"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hotspots', type=int, default=5000)
+        parser.add_argument('--birds', type=int, default=800)
+        parser.add_argument('--birds-per-hotspot', type=int, default=40)
+        parser.add_argument('--details-per-bird', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--allow-existing', action='store_true', help="既存データがあっても追加する")
+
+    def handle(self, *args, **options):
+        if Hotspot.objects.exists() and not options['allow_existing']:
+            raise CommandError("The database already has hotspots. Use a local database or pass --allow-existing.")
+
+        rng = random.Random(options['seed'])
+        batch_size = 1000
+
+        with transaction.atomic():
+            country, _ = Country.objects.get_or_create(countryCode='ZZ', defaults={'country_name': 'Load test'})
+
+            hotspots = []
+            for i in range(options['hotspots']):
+                lat, lng = round(rng.uniform(-60, 70), 6), round(rng.uniform(-180, 180), 6)
+                hotspots.append(Hotspot(
+                    locId=f'LT{i}', locName=f'Load test hotspot {i}', countrycode=country,
+                    lat=lat, lng=lng, grid_cell=grid_cell_for(lat, lng), numSpAllTime=rng.randint(10, 500),
+                ))
+            Hotspot.objects.bulk_create(hotspots, batch_size=batch_size)
+            hotspot_ids = list(Hotspot.objects.filter(locId__startswith='LT').values_list('hotspot_id', flat=True))
+
+            Bird.objects.bulk_create([
+                Bird(speciesCode=f'lt{i}', sciName=f'Avis testis {i}', comName=f'Load test bird {i}')
+                for i in range(options['birds'])
+            ], batch_size=batch_size)
+            bird_ids = list(Bird.objects.filter(speciesCode__startswith='lt').values_list('bird_id', flat=True))
+
+            through = Bird.hotspots.through
+            links = []
+            for hotspot_id in hotspot_ids:
+                for bird_id in rng.sample(bird_ids, min(options['birds_per_hotspot'], len(bird_ids))):
+                    links.append(through(hotspot_id=hotspot_id, bird_id=bird_id))
+            through.objects.bulk_create(links, batch_size=batch_size, ignore_conflicts=True)
+
+            BirdDetail.objects.bulk_create([
+                BirdDetail(bird_id_id=bird_id, recording_url=f'https://example.com/recordings/{bird_id}/{n}.mp3')
+                for bird_id in bird_ids
+                for n in range(options['details_per_bird'])
+            ], batch_size=batch_size)
+
+        # bulk_create はシグナルを送らないので集計をまとめて作り直す
+        rebuild_valid_bird_counts()
+        rebuild_eligible_hotspot_clusters()
+        bump_data_version()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {len(hotspot_ids)} hotspots, {len(bird_ids)} birds and {len(links)} links."
+        ))
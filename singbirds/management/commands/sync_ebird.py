@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from ...collectData.bulkUpsert import format_counts
+from ...collectData.collectBirds import fetch_and_save_birds_for_countries
+from ...collectData.collectHotspots import fetch_and_save_hotspots_for_countries
+from ...collectData.collectObservations import fetch_observations_for_hotspots
+from ...models import Country, Hotspot
+
+
+class Command(BaseCommand):
+    help = (
+        "eBird からホットスポット・鳥・観察データを差分同期します（夜間の定期実行用）。\n"
+        "SyncState に記録した前回の同期以降のデータだけを取得し、変化のない国やホットスポットは保存を省略します。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--countries', nargs='*', help="対象の国コード（省略時はホットスポットが登録済みの国すべて）")
+        parser.add_argument('--skip-observations', action='store_true', help="ホットスポットごとの観察データを同期しない")
+        parser.add_argument('--full', action='store_true', help="前回の同期状況を無視して全件を取得する")
+
+    def handle(self, *args, **options):
+        country_codes = options['countries'] or list(
+            Country.objects.filter(hotspot__isnull=False).distinct().values_list('countryCode', flat=True)
+        )
+        full = options['full']
+
+        # 観察データの差分取得は latestObsDate を使うため、ホットスポットを先に同期する
+        for label, sync in (
+            ('hotspots', fetch_and_save_hotspots_for_countries),
+            ('birds', fetch_and_save_birds_for_countries),
+        ):
+            counts, errors = sync(country_codes, full=full)
+            for country_code, country_counts in counts.items():
+                self.stdout.write(f"{label} {country_code}: {format_counts(country_counts)}")
+            for country_code, error in errors.items():
+                self.stderr.write(f"{label} {country_code}: {error}")
+
+        if options['skip_observations']:
+            return
+
+        hotspots = Hotspot.objects.filter(countrycode__countryCode__in=country_codes).only(
+            'hotspot_id', 'locId', 'locName', 'latestObsDate'
+        )
+        totals, errors = fetch_observations_for_hotspots(hotspots.iterator(), full=full)
+        for loc_id, error in errors.items():
+            self.stderr.write(f"observations {loc_id}: {error}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Observations: fetched {totals['fetched']} hotspots, skipped {totals['skipped']} unchanged, "
+            f"added {totals['added_links']} bird links and {totals['created_birds']} birds."
+        ))
@@ -2,6 +2,15 @@ from django.db import models
 from django.db.models import JSONField 
 
 
+class DataVersion(models.Model):
+    # 公開APIのデータ版数。取り込みや管理画面での削除のたびに加算され、レスポンスキャッシュのキーになる
+    name = models.CharField(max_length=50, primary_key=True)
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.version}"
+
+
 class Country(models.Model):
     country_id = models.AutoField(primary_key=True)
     countryCode = models.CharField(max_length=5, unique=True)
@@ -21,11 +30,34 @@ class Hotspot(models.Model):
     lng = models.DecimalField(max_digits=9, decimal_places=6)
     latestObsDate = models.DateField(null=True, blank=True)
     numSpAllTime = models.IntegerField()
+    # 録音（BirdDetail）を持つ鳥の種数。hotspot_summary で維持される集計値
+    valid_bird_count = models.IntegerField(default=0, db_index=True)
+    # 固定グリッド上のセル番号（spatial.grid_cell_for）。範囲検索用のインデックス
+    grid_cell = models.IntegerField(null=True, blank=True, db_index=True)
 
     def __str__(self):
         return self.locName
 
 
+class HotspotCluster(models.Model):
+    # ズームレベルごとのタイル単位で事前集計したホットスポットのクラスタ
+    zoom = models.PositiveSmallIntegerField()
+    tile_x = models.IntegerField()
+    tile_y = models.IntegerField()
+    count = models.IntegerField(default=0)
+    lat_sum = models.FloatField(default=0)  # 重心計算用の緯度の合計
+    lng_sum = models.FloatField(default=0)  # 重心計算用の経度の合計
+    num_sp_sum = models.BigIntegerField(default=0)  # numSpAllTime の合計
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['zoom', 'tile_x', 'tile_y'], name='unique_hotspot_cluster_tile'),
+        ]
+
+    def __str__(self):
+        return f"Cluster {self.zoom}/{self.tile_x}/{self.tile_y} ({self.count})"
+
+
 class Bird(models.Model):
     bird_id = models.AutoField(primary_key=True)
     speciesCode = models.CharField(max_length=50, unique=True)
@@ -42,10 +74,22 @@ class BirdDetail(models.Model):
     recording_url = models.URLField(max_length=500)
     bird_id = models.ForeignKey(Bird, on_delete=models.CASCADE)
     spectrogram = models.ImageField(upload_to='spectrograms/', blank=True, null=True) 
+    # サイズ・形式ごとの派生画像のパス {'thumbnail': {'png': ..., 'webp': ...}, 'mobile': ..., 'full': ...}
+    # full の PNG は spectrogram に保存する
+    spectrogram_derivatives = JSONField(default=dict, blank=True)
+    # クライアント側で描画するための量子化したスペクトログラム（collectData/spectrogramData.py の形式）
+    spectrogram_data = models.FileField(upload_to='spectrogram_data/', blank=True, null=True)
 
     def __str__(self):
         return f"Recording for {self.bird_id.comName} {self.birddetail_id}"
 
+    def spectrogram_url(self, size='full', format='png'):
+        # 指定したサイズ・形式の画像の URL。派生画像がまだ無ければ元の画像の URL を返す
+        path = self.spectrogram_derivatives.get(size, {}).get(format)
+        if path:
+            return self.spectrogram.storage.url(path)
+        return self.spectrogram.url if self.spectrogram else None
+
 
 class AcousticParameters(models.Model):
     parameter_id = models.AutoField(primary_key=True)
@@ -62,7 +106,62 @@ class AcousticParameters(models.Model):
     zero_crossing_rate = models.FloatField()  # ゼロ交差率
     spectral_centroid = models.FloatField()  # スペクトル中心
     spectral_rolloff = models.FloatField()  # スペクトルロールオフ
+    # 平均する前のフレームごとの特徴量（collectData/frameFeatureStore.py の形式の float16 の .npy）
+    frame_features = models.FileField(upload_to='frame_features/', blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)  # レコード作成日時
 
     def __str__(self):
-        return f"Acoustic Parameters for Bird ID: {self.bird_id}"
\ No newline at end of file
+        return f"Acoustic Parameters for Bird ID: {self.bird_id}"
+
+class SyncState(models.Model):
+    # 外部APIからの同期状況。(source, scope) ごとに最後に成功した同期を記録し、次回は差分だけ取得する
+    source = models.CharField(max_length=50)  # 取得元と種類（sync_state.SYNC_SOURCES）
+    scope = models.CharField(max_length=100)  # countryCode / locId / speciesCode など
+    last_synced_at = models.DateTimeField()
+    response_hash = models.CharField(max_length=64, blank=True)  # 前回のレスポンスのハッシュ
+    item_count = models.IntegerField(default=0)  # 前回のレスポンスの件数
+    changed_count = models.IntegerField(default=0)  # 前回の同期で追加・更新した件数
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'scope'], name='unique_sync_state_scope'),
+        ]
+
+    def __str__(self):
+        return f"{self.source} {self.scope} ({self.last_synced_at:%Y-%m-%d %H:%M})"
+
+
+class Job(models.Model):
+    # 管理画面から投入する時間のかかる処理（jobs.py）。run_jobs コマンドのワーカーが順に実行する
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATE_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+
+    name = models.CharField(max_length=100)  # jobs.register_job で登録した名前
+    params = JSONField(default=dict, blank=True)
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default=QUEUED, db_index=True)
+    progress_done = models.IntegerField(default=0)
+    progress_total = models.IntegerField(null=True, blank=True)
+    message = models.TextField(blank=True)  # 最新の進捗メッセージ
+    errors = JSONField(default=list, blank=True)  # 処理中に発生したエラーメッセージ
+    result = JSONField(null=True, blank=True)
+    worker = models.CharField(max_length=100, blank=True)  # 実行中のワーカー（ホスト名:PID）
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # 実行中のワーカーが定期的に更新する
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"#{self.pk} {self.name} ({self.state})"
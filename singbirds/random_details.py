@@ -0,0 +1,112 @@
+import random
+import struct
+from array import array
+from django.core.cache import caches
+from .api_cache import aget_data_version, get_data_version
+from .models import Bird, BirdDetail
+
+# 鳥ごとの録音IDリストは公開APIと同じ 'api' キャッシュに保存し、キーにデータ版数を含める
+# 取り込みは別プロセス（run_jobs）で行われるが、データ版数が上がればすべてのプロセスで新しいリストが使われる
+# 管理画面などで1件ずつ変更した場合はシグナルで削除する
+
+# キャッシュ有効期間（秒）
+DETAIL_INDEX_TIMEOUT = 60 * 60
+
+# 録音IDは 64bit 整数を並べたバイト列で保存し、選んだ位置だけを読み出す（リスト全体を復元しない）
+ID_FORMAT = '<q'
+ID_SIZE = struct.calcsize(ID_FORMAT)
+
+# ?n= で一度に返せる録音数の上限
+MAX_RANDOM_DETAILS = 50
+
+
+def _cache_key(bird_id, version):
+    return f'bird_detail_ids:v{version}:{bird_id}'
+
+
+def _make_index(name, detail_ids):
+    return {'name': name, 'ids': array('q', detail_ids).tobytes()}
+
+
+def sample_detail_ids(index, n):
+    # 録音IDのバイト列から重複なしで n 件選ぶ
+    ids = index['ids']
+    count = len(ids) // ID_SIZE
+    return [struct.unpack_from(ID_FORMAT, ids, i * ID_SIZE)[0] for i in random.sample(range(count), min(n, count))]
+
+
+def get_detail_index(bird_id):
+    # {'name': comName, 'ids': 録音IDのバイト列} を返す。鳥が存在しなければ None
+    cache = caches['api']
+    key = _cache_key(bird_id, get_data_version())
+    index = cache.get(key)
+    if index is not None:
+        return index
+
+    name = Bird.objects.filter(bird_id=bird_id).values_list('comName', flat=True).first()
+    if name is None:
+        return None
+
+    index = _make_index(name, BirdDetail.objects.filter(bird_id=bird_id).values_list('birddetail_id', flat=True))
+    cache.set(key, index, DETAIL_INDEX_TIMEOUT)
+    return index
+
+
+async def aget_detail_index(bird_id):
+    # 非同期ビュー用の get_detail_index
+    cache = caches['api']
+    key = _cache_key(bird_id, await aget_data_version())
+    index = await cache.aget(key)
+    if index is not None:
+        return index
+
+    name = await Bird.objects.filter(bird_id=bird_id).values_list('comName', flat=True).afirst()
+    if name is None:
+        return None
+
+    index = _make_index(name, [
+        detail_id async for detail_id in BirdDetail.objects.filter(bird_id=bird_id).values_list('birddetail_id', flat=True)
+    ])
+    await cache.aset(key, index, DETAIL_INDEX_TIMEOUT)
+    return index
+
+
+def invalidate_detail_index(bird_ids):
+    version = get_data_version()
+    caches['api'].delete_many([_cache_key(bird_id, version) for bird_id in bird_ids])
+
+
+def pick_random_details(bird_id, n=1):
+    # 録音IDのリストから重複なしで n 件選び、選んだ分だけDBから取得する
+    # 戻り値は (comName, [BirdDetail, ...])。鳥が存在しなければ (None, [])
+    for _ in range(2):
+        index = get_detail_index(bird_id)
+        if index is None:
+            return None, []
+
+        ids = sample_detail_ids(index, n)
+        details = BirdDetail.objects.in_bulk(ids)
+        if len(details) == len(ids):
+            return index['name'], [details[detail_id] for detail_id in ids]
+
+        # 他のプロセスで削除された録音がキャッシュに残っていたら作り直す
+        invalidate_detail_index([bird_id])
+
+    return index['name'], list(details.values())
+
+
+async def apick_random_details(bird_id, n=1):
+    # 非同期ビュー用の pick_random_details
+    for _ in range(2):
+        index = await aget_detail_index(bird_id)
+        if index is None:
+            return None, []
+
+        ids = sample_detail_ids(index, n)
+        details = {detail.birddetail_id: detail async for detail in BirdDetail.objects.filter(birddetail_id__in=ids)}
+        if len(details) == len(ids):
+            return index['name'], [details[detail_id] for detail_id in ids]
+
+        await caches['api'].adelete(_cache_key(bird_id, await aget_data_version()))
+
+    return index['name'], list(details.values())
@@ -0,0 +1,36 @@
+import datetime
+import decimal
+import msgpack
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+def _msgpack_default(obj):
+    # msgpack が扱えない型を変換する
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not msgpack serializable")
+
+
+class MsgPackRenderer(BaseRenderer):
+    # Accept: application/msgpack で列指向のバイナリを返す
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, use_bin_type=True, default=_msgpack_default)
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    # Accept: application/vnd.singbirds.columns+json で列指向の JSON を返す
+    media_type = 'application/vnd.singbirds.columns+json'
+    format = 'columns'
+
+
+# 列指向（平行配列）のデータを返すレンダラーの format
+COLUMNAR_FORMATS = {MsgPackRenderer.format, ColumnarJSONRenderer.format}
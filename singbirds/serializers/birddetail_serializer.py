@@ -1,7 +1,19 @@
 from rest_framework import serializers
 from ..models import BirdDetail
+from ..collectData.spectrogramImage import SPECTROGRAM_FORMATS, SPECTROGRAM_SIZES
 
 class BirdDetailSerializer(serializers.ModelSerializer):
+    # サイズ・形式ごとの画像の URL。クライアントは表示する大きさに合わせて選ぶ（一覧では thumbnail など）
+    spectrogram_images = serializers.SerializerMethodField()
+
     class Meta:
         model = BirdDetail
-        fields = ['recording_url', 'spectrogram', 'bird_id', 'birddetail_id']
\ No newline at end of file
+        fields = ['recording_url', 'spectrogram', 'spectrogram_images', 'bird_id', 'birddetail_id']
+
+    def get_spectrogram_images(self, obj):
+        if not obj.spectrogram:
+            return None
+        return {
+            size: {format: obj.spectrogram_url(size, format) for format in SPECTROGRAM_FORMATS}
+            for size in SPECTROGRAM_SIZES
+        }
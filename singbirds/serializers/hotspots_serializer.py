@@ -1,7 +1,24 @@
 from rest_framework import serializers
-from ..models import Hotspot
+from ..models import Hotspot, HotspotCluster
 
 class HotspotSerializer(serializers.ModelSerializer):
     class Meta:
         model = Hotspot
-        fields = ['hotspot_id', 'locId', 'locName', 'countrycode', "subnationalCode", 'lat', 'lng', 'numSpAllTime', 'latestObsDate'] 
\ No newline at end of file
+        fields = ['hotspot_id', 'locId', 'locName', 'countrycode', "subnationalCode", 'lat', 'lng', 'numSpAllTime', 'latestObsDate']
+
+
+class HotspotClusterSerializer(serializers.ModelSerializer):
+    # 重心はタイルに含まれるホットスポットの緯度経度の平均
+    lat = serializers.SerializerMethodField()
+    lng = serializers.SerializerMethodField()
+    numSpAllTime = serializers.IntegerField(source='num_sp_sum')
+
+    class Meta:
+        model = HotspotCluster
+        fields = ['zoom', 'tile_x', 'tile_y', 'lat', 'lng', 'count', 'numSpAllTime']
+
+    def get_lat(self, obj):
+        return round(obj.lat_sum / obj.count, 6)
+
+    def get_lng(self, obj):
+        return round(obj.lng_sum / obj.count, 6)
@@ -0,0 +1,111 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from .models import Bird, BirdDetail, Hotspot
+from .hotspot_clusters import update_changed_hotspot_clusters
+from .hotspot_summary import cluster_point, refresh_valid_bird_counts, refresh_valid_bird_counts_for_birds
+from .random_details import invalidate_detail_index
+from .spatial import grid_cell_for
+
+
+# 保存時に緯度経度からグリッドのセル番号を設定する
+@receiver(pre_save, sender=Hotspot)
+def set_grid_cell(sender, instance, **kwargs):
+    instance.grid_cell = grid_cell_for(instance.lat, instance.lng)
+
+
+# 管理画面などで1件ずつ保存・削除されたホットスポットをクラスタに反映する（取り込みは collectHotspots が差分を反映する）
+# valid_bird_count は bulk_update で更新されるため、インスタンスの値ではなく保存されている値を使う
+def _stored_cluster_point(hotspot_id):
+    stored = Hotspot.objects.filter(pk=hotspot_id).values_list('lat', 'lng', 'numSpAllTime', 'valid_bird_count').first()
+    return cluster_point(*stored) if stored else None
+
+
+@receiver(pre_save, sender=Hotspot)
+def remember_cluster_point_on_save(sender, instance, **kwargs):
+    instance._old_cluster_point = _stored_cluster_point(instance.pk) if instance.pk is not None else None
+
+
+@receiver(post_save, sender=Hotspot)
+def update_clusters_on_hotspot_save(sender, instance, **kwargs):
+    new = cluster_point(instance.lat, instance.lng, instance.numSpAllTime, instance.valid_bird_count)
+    update_changed_hotspot_clusters([(getattr(instance, '_old_cluster_point', None), new)])
+
+
+@receiver(pre_delete, sender=Hotspot)
+def remember_cluster_point_on_delete(sender, instance, **kwargs):
+    instance._old_cluster_point = _stored_cluster_point(instance.pk)
+
+
+@receiver(post_delete, sender=Hotspot)
+def update_clusters_on_hotspot_delete(sender, instance, **kwargs):
+    update_changed_hotspot_clusters([(getattr(instance, '_old_cluster_point', None), None)])
+
+
+# 鳥とホットスポットの紐付けが変わったら、そのホットスポットの集計を更新する
+@receiver(m2m_changed, sender=Bird.hotspots.through)
+def update_counts_on_link_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # clear 後は対象が分からなくなるので、事前に控えておく
+        if reverse:
+            instance._cleared_hotspot_ids = [instance.pk]
+        else:
+            instance._cleared_hotspot_ids = list(instance.hotspots.values_list('hotspot_id', flat=True))
+        return
+
+    if action == 'post_clear':
+        refresh_valid_bird_counts(getattr(instance, '_cleared_hotspot_ids', []))
+        return
+
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+
+    if reverse:
+        # hotspot.birds.add(...) の場合、instance はホットスポット
+        refresh_valid_bird_counts([instance.pk])
+    elif BirdDetail.objects.filter(bird_id=instance).exists():
+        # 録音のない鳥の紐付けは集計に影響しない
+        refresh_valid_bird_counts(pk_set)
+
+
+# 鳥の最初の録音が追加されたら、その鳥がいるホットスポットの集計を更新する
+@receiver(post_save, sender=BirdDetail)
+def update_counts_on_detail_save(sender, instance, created, **kwargs):
+    if created and BirdDetail.objects.filter(bird_id=instance.bird_id_id).count() == 1:
+        refresh_valid_bird_counts_for_birds([instance.bird_id_id])
+
+
+# 鳥の最後の録音が削除されたら、その鳥がいるホットスポットの集計を更新する
+@receiver(post_delete, sender=BirdDetail)
+def update_counts_on_detail_delete(sender, instance, **kwargs):
+    if not BirdDetail.objects.filter(bird_id=instance.bird_id_id).exists():
+        refresh_valid_bird_counts_for_birds([instance.bird_id_id])
+
+
+# 鳥の削除時は中間テーブルがカスケード削除され m2m_changed が飛ばないため、ここで処理する
+@receiver(pre_delete, sender=Bird)
+def remember_hotspots_on_bird_delete(sender, instance, **kwargs):
+    instance._deleted_hotspot_ids = list(instance.hotspots.values_list('hotspot_id', flat=True))
+
+
+@receiver(post_delete, sender=Bird)
+def update_counts_on_bird_delete(sender, instance, **kwargs):
+    refresh_valid_bird_counts(getattr(instance, '_deleted_hotspot_ids', []))
+
+
+# 録音の追加・削除や鳥名の変更時は、ランダム選択用の録音IDキャッシュを無効化する
+# （録音の更新では録音IDのリストは変わらないので何もしない）
+@receiver(post_save, sender=BirdDetail)
+def invalidate_detail_index_on_detail_create(sender, instance, created, **kwargs):
+    if created:
+        invalidate_detail_index([instance.bird_id_id])
+
+
+@receiver(post_delete, sender=BirdDetail)
+def invalidate_detail_index_on_detail_delete(sender, instance, **kwargs):
+    invalidate_detail_index([instance.bird_id_id])
+
+
+@receiver(post_save, sender=Bird)
+@receiver(post_delete, sender=Bird)
+def invalidate_detail_index_on_bird_change(sender, instance, **kwargs):
+    invalidate_detail_index([instance.pk])
@@ -0,0 +1,216 @@
+import fcntl
+import json
+import os
+import pickle
+import tempfile
+import threading
+from contextlib import contextmanager
+import numpy as np
+from django.conf import settings
+from .models import AcousticParameters
+
+# これ以下の件数では近似ではなく全件の距離計算で検索する（索引を作るより速い）
+BRUTE_FORCE_LIMIT = 2000
+
+# 近傍グラフの近傍数
+INDEX_N_NEIGHBORS = 30
+
+# 索引を作るのに読み込む AcousticParameters のフィールド
+INDEX_FIELDS = (
+    'bird_id', 'birddetail_id', 'mfcc_features', 'chroma_features', 'spectral_bandwidth',
+    'spectral_contrast', 'spectral_flatness', 'rms_energy', 'zero_crossing_rate',
+    'spectral_centroid', 'spectral_rolloff',
+)
+
+
+def _as_list(value):
+    # JSONField には json.dumps した文字列が入っている場合がある
+    if isinstance(value, str):
+        return json.loads(value)
+    return value or []
+
+
+def feature_vector(record):
+    # getNMDS / getUMAP と同じ順序で特徴量を結合する（次元が合わなければ None）
+    mfcc = _as_list(record.mfcc_features)
+    chroma = _as_list(record.chroma_features)
+    spectral_contrast = _as_list(record.spectral_contrast)
+    if len(mfcc) != 13 or len(chroma) != 12 or len(spectral_contrast) != 7:
+        return None
+
+    return np.array([
+        *mfcc, *chroma,
+        record.spectral_bandwidth or 0,
+        record.spectral_flatness or 0,
+        *spectral_contrast,
+        record.rms_energy or 0,
+        record.zero_crossing_rate or 0,
+        record.spectral_centroid or 0,
+        record.spectral_rolloff or 0,
+    ], dtype=np.float32)
+
+
+def _feature_rows(records):
+    detail_ids, bird_ids, vectors = [], [], []
+    for record in records:
+        vector = feature_vector(record)
+        if vector is not None:
+            detail_ids.append(record.birddetail_id_id)
+            bird_ids.append(record.bird_id_id)
+            vectors.append(vector)
+
+    if not vectors:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=np.float32)
+    return np.array(detail_ids, dtype=np.int64), np.array(bird_ids, dtype=np.int64), np.vstack(vectors)
+
+
+class SimilarityIndex:
+    # 標準化した音響特徴量に対する近傍検索。件数が多い場合は pynndescent の近似索引を使う
+    def __init__(self, detail_ids, bird_ids, vectors, mean, scale, ann=None):
+        self.detail_ids = detail_ids
+        self.bird_ids = bird_ids
+        self.vectors = vectors
+        self.mean = mean
+        self.scale = scale
+        self.ann = ann
+
+    @classmethod
+    def build(cls, records):
+        detail_ids, bird_ids, raw = _feature_rows(records)
+        if not len(detail_ids):
+            return None
+
+        mean = raw.mean(axis=0)
+        scale = raw.std(axis=0)
+        scale[scale == 0] = 1.0
+        index = cls(detail_ids, bird_ids, (raw - mean) / scale, mean, scale)
+        index._build_ann()
+        return index
+
+    def _build_ann(self):
+        if len(self.detail_ids) <= BRUTE_FORCE_LIMIT:
+            self.ann = None
+            return
+
+        from pynndescent import NNDescent
+        self.ann = NNDescent(self.vectors, n_neighbors=INDEX_N_NEIGHBORS, random_state=42, low_memory=True)
+        self.ann.prepare()
+
+    def __len__(self):
+        return len(self.detail_ids)
+
+    def transform(self, raw):
+        return ((raw - self.mean) / self.scale).astype(np.float32)
+
+    def add(self, records):
+        # 新しい録音の特徴量を追加する（既に索引にある録音は置き換えない）
+        detail_ids, bird_ids, raw = _feature_rows(records)
+        fresh = ~np.isin(detail_ids, self.detail_ids)
+        if not fresh.any():
+            return 0
+
+        vectors = self.transform(raw[fresh])
+        self.detail_ids = np.concatenate([self.detail_ids, detail_ids[fresh]])
+        self.bird_ids = np.concatenate([self.bird_ids, bird_ids[fresh]])
+        self.vectors = np.vstack([self.vectors, vectors])
+
+        if self.ann is not None:
+            self.ann.update(xs_fresh=vectors)
+            self.ann.prepare()
+        else:
+            self._build_ann()
+        return int(fresh.sum())
+
+    def query(self, raw, k):
+        # 戻り値は (位置の配列, 距離の配列)。いずれも (クエリ数, k)
+        vectors = self.transform(np.atleast_2d(raw))
+        k = min(k, len(self))
+
+        if self.ann is not None:
+            return self.ann.query(vectors, k=k)
+
+        distances = np.linalg.norm(self.vectors[None, :, :] - vectors[:, None, :], axis=2)
+        positions = np.argsort(distances, axis=1)[:, :k]
+        return positions, np.take_along_axis(distances, positions, axis=1)
+
+    def save(self, path):
+        # 読み込み中のワーカーが壊れたファイルを読まないよう、一時ファイルから置き換える
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def _index_path():
+    return settings.SIMILARITY_INDEX_PATH
+
+
+# ワーカーごとに一度だけ読み込み、ファイルが更新されたら読み直す
+_loaded = {'index': None, 'mtime': None}
+_lock = threading.Lock()
+
+
+def get_similarity_index():
+    path = _index_path()
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    if _loaded['mtime'] != mtime:
+        with _lock:
+            if _loaded['mtime'] != mtime:
+                _loaded['index'] = SimilarityIndex.load(path)
+                _loaded['mtime'] = mtime
+    return _loaded['index']
+
+
+@contextmanager
+def _index_write_lock(path):
+    # 索引の読み込み・追加・保存を複数のプロセス（run_jobs のワーカーなど）が同時に行うと互いの追加が失われるため、
+    # ファイルロックで1つずつ行う（同じプロセス内のスレッドもファイルを開くごとに別のロックになる）
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _rebuild(path):
+    records = AcousticParameters.objects.only(*INDEX_FIELDS).iterator(chunk_size=2000)
+    index = SimilarityIndex.build(records)
+    if index is None:
+        return 0
+    index.save(path)
+    return len(index)
+
+
+def rebuild_similarity_index():
+    # AcousticParameters 全体から索引を作り直して保存する
+    path = _index_path()
+    with _index_write_lock(path):
+        return _rebuild(path)
+
+
+def add_to_similarity_index(records):
+    # 特徴量抽出で追加された AcousticParameters を索引に反映する
+    # 索引全体を保存し直すので、ジョブの最後などにまとめて呼び出す
+    path = _index_path()
+    with _index_write_lock(path):
+        if not os.path.exists(path):
+            return _rebuild(path)
+
+        index = SimilarityIndex.load(path)
+        added = index.add(records)
+        if added:
+            index.save(path)
+    return added
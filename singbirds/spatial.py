@@ -0,0 +1,168 @@
+import math
+from django.db.models import Q
+
+# 固定グリッドのセルサイズ（度）。Hotspot.grid_cell はこのグリッド上のセル番号
+GRID_CELL_DEGREES = 1.0
+GRID_ROWS = int(180 / GRID_CELL_DEGREES)
+GRID_COLS = int(360 / GRID_CELL_DEGREES)
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# 半径検索で受け付ける最大半径（km）
+MAX_RADIUS_KM = 5000
+
+
+def _grid_row(lat):
+    return min(max(int(math.floor((lat + 90) / GRID_CELL_DEGREES)), 0), GRID_ROWS - 1)
+
+
+def _grid_col(lng):
+    return min(max(int(math.floor((lng + 180) / GRID_CELL_DEGREES)), 0), GRID_COLS - 1)
+
+
+def grid_cell_for(lat, lng):
+    # 緯度経度からグリッドのセル番号を求める（行優先で連番）
+    if lat is None or lng is None:
+        return None
+    return _grid_row(float(lat)) * GRID_COLS + _grid_col(float(lng))
+
+
+# Webメルカトル（XYZタイル）で表現できる緯度の上限
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def tile_for(lat, lng, zoom):
+    # 緯度経度を指定ズームレベルのタイル座標 (x, y) に変換する
+    n = 2 ** zoom
+    lat = min(max(float(lat), -MAX_MERCATOR_LAT), MAX_MERCATOR_LAT)
+    x = int((float(lng) + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class BoundingBox:
+    # west > east の場合は日付変更線をまたぐ範囲として扱う
+    def __init__(self, west, south, east, north):
+        if not (-180 <= west <= 180 and -180 <= east <= 180):
+            raise ValueError("Longitude must be between -180 and 180.")
+        if not (-90 <= south <= 90 and -90 <= north <= 90):
+            raise ValueError("Latitude must be between -90 and 90.")
+        if south > north:
+            raise ValueError("South latitude must not be greater than north latitude.")
+        self.west, self.south, self.east, self.north = west, south, east, north
+
+    def lng_intervals(self):
+        if self.west <= self.east:
+            return [(self.west, self.east)]
+        return [(self.west, 180.0), (-180.0, self.east)]
+
+    def cell_ranges(self):
+        # 各行ごとに連続するセル番号の範囲を返す
+        first_row, last_row = _grid_row(self.south), _grid_row(self.north)
+        col_intervals = [(_grid_col(west), _grid_col(east)) for west, east in self.lng_intervals()]
+
+        if col_intervals == [(0, GRID_COLS - 1)]:
+            # 経度方向が全範囲なら行をまたいで1つの範囲にまとめられる
+            return [(first_row * GRID_COLS, last_row * GRID_COLS + GRID_COLS - 1)]
+
+        return [
+            (row * GRID_COLS + first_col, row * GRID_COLS + last_col)
+            for row in range(first_row, last_row + 1)
+            for first_col, last_col in col_intervals
+        ]
+
+    def q(self, field='grid_cell'):
+        # インデックス付きの grid_cell に対する範囲条件
+        query = Q()
+        for start, end in self.cell_ranges():
+            query |= Q(**{f'{field}__range': (start, end)})
+        return query
+
+    def tile_ranges(self, zoom):
+        # 矩形にかかるタイルの (x範囲, y範囲) の組を返す（y は北が小さい）
+        _, first_y = tile_for(self.north, 0, zoom)
+        _, last_y = tile_for(self.south, 0, zoom)
+        return [
+            ((tile_for(0, west, zoom)[0], tile_for(0, east, zoom)[0]), (first_y, last_y))
+            for west, east in self.lng_intervals()
+        ]
+
+    def contains(self, lat, lng):
+        if not self.south <= lat <= self.north:
+            return False
+        return any(west <= lng <= east for west, east in self.lng_intervals())
+
+
+class RadiusArea:
+    def __init__(self, lat, lng, radius_km):
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            raise ValueError("Center must be a valid latitude/longitude.")
+        if not 0 < radius_km <= MAX_RADIUS_KM:
+            raise ValueError(f"Radius must be between 0 and {MAX_RADIUS_KM} km.")
+        self.lat, self.lng, self.radius_km = lat, lng, radius_km
+        self.bbox = self._bounding_box()
+
+    def _bounding_box(self):
+        # 円を内包する緯度経度の矩形を求める
+        dlat = self.radius_km / KM_PER_DEGREE
+        south, north = max(self.lat - dlat, -90.0), min(self.lat + dlat, 90.0)
+
+        cos_lat = min(math.cos(math.radians(south)), math.cos(math.radians(north)))
+        if south <= -90 or north >= 90 or cos_lat <= 0:
+            # 極を含む場合は全経度が対象
+            return BoundingBox(-180.0, south, 180.0, north)
+
+        dlng = dlat / cos_lat
+        if dlng >= 180:
+            return BoundingBox(-180.0, south, 180.0, north)
+
+        west = (self.lng - dlng + 540) % 360 - 180
+        east = (self.lng + dlng + 540) % 360 - 180
+        return BoundingBox(west, south, east, north)
+
+    def q(self, field='grid_cell'):
+        return self.bbox.q(field)
+
+    def contains(self, lat, lng):
+        return self.bbox.contains(lat, lng) and haversine_km(self.lat, self.lng, lat, lng) <= self.radius_km
+
+
+def _parse_floats(value, count, name):
+    try:
+        numbers = [float(part) for part in value.split(',')]
+    except ValueError:
+        raise ValueError(f"'{name}' must be comma separated numbers.")
+    if len(numbers) != count or not all(math.isfinite(number) for number in numbers):
+        raise ValueError(f"'{name}' must contain {count} numbers.")
+    return numbers
+
+
+def parse_bbox(value):
+    # "west,south,east,north" 形式の文字列を BoundingBox にする
+    return BoundingBox(*_parse_floats(value, 4, 'bbox'))
+
+
+def parse_area(params):
+    # クエリパラメータから検索範囲を作る
+    #   ?bbox=west,south,east,north
+    #   ?lat=..&lng=..&radius=..(km)
+    # 指定がなければ None、不正な値なら ValueError
+    if params.get('bbox'):
+        return parse_bbox(params['bbox'])
+
+    if any(params.get(name) for name in ('lat', 'lng', 'radius')):
+        if not all(params.get(name) for name in ('lat', 'lng', 'radius')):
+            raise ValueError("'lat', 'lng' and 'radius' must be given together.")
+        lat, = _parse_floats(params['lat'], 1, 'lat')
+        lng, = _parse_floats(params['lng'], 1, 'lng')
+        radius, = _parse_floats(params['radius'], 1, 'radius')
+        return RadiusArea(lat, lng, radius)
+
+    return None
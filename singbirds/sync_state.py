@@ -0,0 +1,74 @@
+import hashlib
+import json
+import math
+from datetime import timedelta
+from django.utils import timezone
+from .models import SyncState
+
+# SyncState.source の値
+EBIRD_COUNTRIES = 'ebird:countries'
+EBIRD_HOTSPOTS = 'ebird:hotspots'
+EBIRD_BIRDS = 'ebird:birds'
+EBIRD_OBSERVATIONS = 'ebird:observations'
+XENO_CANTO_RECORDINGS = 'xeno-canto:recordings'
+
+SYNC_SOURCES = [EBIRD_COUNTRIES, EBIRD_HOTSPOTS, EBIRD_BIRDS, EBIRD_OBSERVATIONS, XENO_CANTO_RECORDINGS]
+
+# eBird の back パラメータの上限（日）
+MAX_BACK_DAYS = 30
+
+LOOKUP_BATCH_SIZE = 500
+
+
+def response_hash(data):
+    # キーの順序によらない、レスポンス内容のハッシュ
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def load_sync_states(source, scopes):
+    # {scope: SyncState} を返す（未同期の scope は含まれない）
+    scopes = list(scopes)
+    states = {}
+    for start in range(0, len(scopes), LOOKUP_BATCH_SIZE):
+        for state in SyncState.objects.filter(source=source, scope__in=scopes[start:start + LOOKUP_BATCH_SIZE]):
+            states[state.scope] = state
+    return states
+
+
+def is_unchanged(state, data_hash):
+    return state is not None and state.response_hash == data_hash
+
+
+def back_days(state, now=None, max_days=MAX_BACK_DAYS):
+    # 前回の同期以降をカバーする日数（取りこぼしがないよう1日重ねる）
+    # 未同期の場合や、前回が max_days より前で差分では取得できない場合は None
+    if state is None:
+        return None
+    elapsed = (now or timezone.now()) - state.last_synced_at
+    days = max(math.ceil(elapsed.total_seconds() / 86400), 0) + 1
+    return days if days <= max_days else None
+
+
+def since_date(state):
+    # 前回の同期日（1日重ねる）。未同期の場合は None
+    if state is None:
+        return None
+    return (state.last_synced_at - timedelta(days=1)).date()
+
+
+def record_syncs(source, results, synced_at):
+    # results は {scope: (response_hash, item_count, changed_count)}
+    # synced_at には取得を始めた時刻を渡す（取得中に追加されたデータを次回取りこぼさないため）
+    SyncState.objects.bulk_create(
+        [
+            SyncState(
+                source=source, scope=scope, last_synced_at=synced_at,
+                response_hash=data_hash, item_count=item_count, changed_count=changed_count,
+            )
+            for scope, (data_hash, item_count, changed_count) in results.items()
+        ],
+        batch_size=LOOKUP_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['source', 'scope'],
+        update_fields=['last_synced_at', 'response_hash', 'item_count', 'changed_count'],
+    )
\ No newline at end of file
@@ -0,0 +1,68 @@
+from .jobs import register_job
+from .models import AcousticParameters, Bird, BirdDetail, Hotspot
+from .collectData.collectCountries import fetch_and_save_countries
+from .collectData.collectHotspots import fetch_and_save_hotspots_for_countries
+from .collectData.collectBirds import fetch_and_save_birds_for_countries
+from .collectData.collectObservations import fetch_observations_for_hotspots
+from .collectData.collectRecordings import harvest_recordings
+from .collectData.createSpectrogram import generate_spectrograms
+from .collectData.collectParameters import extract_acoustic_features
+from .collectData.processRecordings import process_recordings
+from .collectData.getNMDS import perform_nmds
+from .collectData.getUMAP import perform_umap
+
+# run_jobs のワーカーが実行するジョブ。管理アクションは enqueue_admin_job でこれらを投入する
+
+
+@register_job('fetch_countries')
+def fetch_countries_job(progress):
+    return fetch_and_save_countries(progress=progress)
+
+
+@register_job('fetch_hotspots')
+def fetch_hotspots_job(progress, country_codes, full=False):
+    counts, errors = fetch_and_save_hotspots_for_countries(country_codes, full=full, progress=progress)
+    return {'counts': counts, 'errors': errors}
+
+
+@register_job('fetch_birds')
+def fetch_birds_job(progress, country_codes, full=False):
+    counts, errors = fetch_and_save_birds_for_countries(country_codes, full=full, progress=progress)
+    return {'counts': counts, 'errors': errors}
+
+
+@register_job('fetch_observations')
+def fetch_observations_job(progress, hotspot_ids, full=False):
+    totals, errors = fetch_observations_for_hotspots(Hotspot.objects.filter(pk__in=hotspot_ids), full=full, progress=progress)
+    return {'totals': totals, 'errors': errors}
+
+
+@register_job('harvest_recordings')
+def harvest_recordings_job(progress, bird_ids, full=False):
+    totals, errors = harvest_recordings(Bird.objects.filter(pk__in=bird_ids), full=full, progress=progress)
+    return {'totals': totals, 'errors': errors}
+
+
+@register_job('generate_spectrograms')
+def generate_spectrograms_job(progress, detail_ids):
+    return generate_spectrograms(list(BirdDetail.objects.filter(pk__in=detail_ids)), progress=progress)
+
+
+@register_job('extract_acoustic_features')
+def extract_acoustic_features_job(progress, detail_ids):
+    return extract_acoustic_features(BirdDetail.objects.filter(pk__in=detail_ids), progress=progress)
+
+
+@register_job('process_recordings')
+def process_recordings_job(progress, detail_ids):
+    return process_recordings(BirdDetail.objects.filter(pk__in=detail_ids), progress=progress)
+
+
+@register_job('nmds')
+def nmds_job(progress, parameter_ids):
+    return {'path': perform_nmds(AcousticParameters.objects.filter(pk__in=parameter_ids).select_related('bird_id'), progress=progress)}
+
+
+@register_job('umap')
+def umap_job(progress, parameter_ids):
+    return {'path': perform_umap(AcousticParameters.objects.filter(pk__in=parameter_ids).select_related('bird_id'), progress=progress)}
@@ -1,3 +1,1905 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import functools
+import gzip
+import http.server
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from unittest import mock
+import brotli
+import librosa
+import matplotlib
+import msgpack
+import numpy as np
+import requests
+import soundfile
+from PIL import Image
+from aiohttp import web
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from .collectData import collectHotspots, collectObservations, recordingPipeline, spectrogramImage
+from .collectData.apiClient import ApiError, AsyncApiClient, TokenBucket
+from .collectData.bulkUpsert import bulk_upsert, format_counts
+from .collectData.collectBirds import save_birds
+from .collectData.collectCountries import fetch_and_save_countries
+from .collectData.collectHotspots import save_hotspots
+from .collectData.collectObservations import save_observations
+from .collectData.collectParameters import (
+    build_acoustic_parameters, extract_acoustic_features, frame_features_name, save_acoustic_parameters,
+    update_similarity_index,
+)
+from .collectData.collectRecordings import MAX_RECORDING_SECONDS, MAX_RECORDINGS_PER_SPECIES, harvest_recordings
+from .collectData.createSpectrogram import replace_file, save_spectrogram_images
+from .collectData.featureEngine import (
+    FEATURE_SAMPLE_RATE, extract_features, extract_features_reference, extract_frame_features, frame_features, frame_rms,
+    summarize, trim_silence,
+)
+from .collectData.frameFeatureStore import FRAME_FEATURE_DIMS, frame_statistics, load_frame_features
+from .collectData.processRecordings import process_recording, process_recordings
+from .collectData.recordingAnalysis import analyze_file
+from .collectData.recordingPipeline import run_recording_pipeline
+from .collectData.spectrogramData import load_spectrogram_data, quantize_spectrogram
+from .collectData.spectrogramImage import (
+    SPECTROGRAM_FORMATS, SPECTROGRAM_SIZES, VIRIDIS, render_spectrogram, render_spectrogram_set, spectrogram_db, spectrogram_set,
+)
+from . import jobs, similarity
+from .jobs import Progress
+from .audio_store import AudioStore, AudioTooLarge, decode_audio, get_audio_store, load_audio
+from .api_cache import bump_data_version, get_data_version
+from .cache_backends import StubRedisCache
+from .hotspot_clusters import MAX_CLUSTER_ZOOM
+from .hotspot_summary import MIN_VALID_BIRDS
+from .models import AcousticParameters, Bird, BirdDetail, Country, Hotspot, HotspotCluster, Job, SyncState
+from .serializers.birddetail_serializer import BirdDetailSerializer
+from .spatial import grid_cell_for, parse_bbox
+from .sync_state import EBIRD_HOTSPOTS, EBIRD_OBSERVATIONS, back_days, response_hash, since_date
+from .views.bird_views import MAX_BATCH_HOTSPOTS
+from .views.hotspot_views import HotspotListView
 
-# Create your tests here.
+
+class ApiTestCase(TestCase):
+    # キャッシュした API のレスポンスなどが前のテストから残らないようにする
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+
+    def create_hotspot(self, loc_id, lat=35.0, lng=139.0, **fields):
+        country, _ = Country.objects.get_or_create(countryCode='JP', defaults={'country_name': 'Japan'})
+        fields.setdefault('numSpAllTime', 5)
+        return Hotspot.objects.create(locId=loc_id, locName=loc_id, countrycode=country, lat=lat, lng=lng, **fields)
+
+    def create_birds(self, count, recordings=1):
+        # recordings 件ずつ録音を持つ鳥を作る
+        birds = [Bird.objects.create(speciesCode=f's{i}', sciName=f'Species {i}', comName=f'Bird {i:02d}') for i in range(count)]
+        for bird in birds:
+            for i in range(recordings):
+                BirdDetail.objects.create(bird_id=bird, recording_url=f'http://example.com/{bird.pk}/{i}')
+        return birds
+
+
+class ValidBirdCountTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hotspot = self.create_hotspot('L1')
+        self.birds = self.create_birds(12, recordings=0)
+
+    def assertValidBirdCount(self, expected):
+        self.hotspot.refresh_from_db()
+        self.assertEqual(self.hotspot.valid_bird_count, expected)
+
+    def test_counts_only_birds_with_recordings(self):
+        self.hotspot.birds.add(*self.birds)
+        self.assertValidBirdCount(0)
+        for bird in self.birds:
+            BirdDetail.objects.create(bird_id=bird, recording_url='http://example.com/1')
+            BirdDetail.objects.create(bird_id=bird, recording_url='http://example.com/2')
+        self.assertValidBirdCount(12)
+
+    def test_link_and_delete_changes_update_count(self):
+        for bird in self.birds:
+            BirdDetail.objects.create(bird_id=bird, recording_url='http://example.com/1')
+        # 鳥側からの追加・ホットスポット側からの追加の両方
+        self.birds[0].hotspots.add(self.hotspot)
+        self.hotspot.birds.add(*self.birds[1:])
+        self.assertValidBirdCount(12)
+
+        BirdDetail.objects.filter(bird_id=self.birds[0]).delete()
+        self.assertValidBirdCount(11)
+        self.birds[1].delete()
+        self.assertValidBirdCount(10)
+        self.hotspot.birds.remove(self.birds[2])
+        self.assertValidBirdCount(9)
+        self.birds[3].hotspots.clear()
+        self.assertValidBirdCount(8)
+        self.hotspot.birds.clear()
+        self.assertValidBirdCount(0)
+
+    def test_rebuild_command(self):
+        for bird in self.birds:
+            BirdDetail.objects.create(bird_id=bird, recording_url='http://example.com/1')
+        self.hotspot.birds.add(*self.birds)
+        Hotspot.objects.update(valid_bird_count=0)
+        call_command('rebuild_hotspot_counts', stdout=io.StringIO())
+        self.assertValidBirdCount(12)
+
+    def test_list_returns_hotspots_with_enough_birds(self):
+        other = self.create_hotspot('L2')
+        for bird in self.birds:
+            BirdDetail.objects.create(bird_id=bird, recording_url='http://example.com/1')
+        self.hotspot.birds.add(*self.birds)
+        other.birds.add(*self.birds[:9])
+        response = self.client.get('/api/hotspots/')
+        self.assertEqual([hotspot['locId'] for hotspot in response.json()], ['L1'])
+
+    def test_grid_cell_follows_location(self):
+        self.assertEqual(self.hotspot.grid_cell, grid_cell_for(35.0, 139.0))
+        self.hotspot.lat, self.hotspot.lng = -33.9, 151.2
+        self.hotspot.save()
+        self.hotspot.refresh_from_db()
+        self.assertEqual(self.hotspot.grid_cell, grid_cell_for(-33.9, 151.2))
+        self.assertNotEqual(self.hotspot.grid_cell, grid_cell_for(35.0, 139.0))
+
+
+
+class HotspotAreaFilterTests(ApiTestCase):
+    POINTS = [(35.68, 139.76), (34.69, 135.50), (43.06, 141.35), (-33.9, 151.2), (64.0, 179.9), (64.0, -179.9)]
+
+    def setUp(self):
+        super().setUp()
+        for i, (lat, lng) in enumerate(self.POINTS):
+            self.create_hotspot(f'L{i}', lat, lng, valid_bird_count=10)
+
+    def get_loc_ids(self, query):
+        response = self.client.get('/api/hotspots/' + query)
+        self.assertEqual(response.status_code, 200, response.content)
+        return sorted(hotspot['locId'] for hotspot in response.json())
+
+    def test_bbox(self):
+        self.assertEqual(self.get_loc_ids('?bbox=130,30,145,45'), ['L0', 'L1', 'L2'])
+        self.assertEqual(self.get_loc_ids('?bbox=-180,-90,180,90'), self.get_loc_ids(''))
+
+    def test_bbox_across_antimeridian(self):
+        self.assertEqual(self.get_loc_ids('?bbox=179,60,-179,70'), ['L4', 'L5'])
+
+    def test_radius(self):
+        # 東京から大阪までは約400km、札幌までは約830km
+        self.assertEqual(self.get_loc_ids('?lat=35.68&lng=139.76&radius=450'), ['L0', 'L1'])
+        self.assertEqual(self.get_loc_ids('?lat=64&lng=180&radius=50'), ['L4', 'L5'])
+
+    def test_invalid_area(self):
+        for query in ('?bbox=1,2', '?bbox=a,b,c,d', '?bbox=0,10,1,5', '?lat=1', '?lat=1&lng=2&radius=0'):
+            with self.subTest(query=query):
+                response = self.client.get('/api/hotspots/' + query)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('message', response.json())
+
+    def test_cell_ranges_cover_bbox(self):
+        bbox = parse_bbox('179,60,-179,70')
+        for lat, lng in [(60.0, 179.0), (70.0, -179.0), (65.5, 180.0), (65.5, -180.0)]:
+            cell = grid_cell_for(lat, lng)
+            self.assertTrue(any(start <= cell <= end for start, end in bbox.cell_ranges()), (lat, lng))
+        self.assertFalse(bbox.contains(65.0, 0.0))
+
+
+class HotspotClusterTests(ApiTestCase):
+    POINTS = [(35.68, 139.76, 100), (34.69, 135.50, 50), (-33.9, 151.2, 10)]
+
+    def setUp(self):
+        super().setUp()
+        self.birds = self.create_birds(MIN_VALID_BIRDS)
+        self.hotspots = [
+            self.create_hotspot(f'L{i}', lat, lng, numSpAllTime=num_sp) for i, (lat, lng, num_sp) in enumerate(self.POINTS)
+        ]
+        for hotspot in self.hotspots:
+            hotspot.birds.add(*self.birds)
+
+    def get_clusters(self, query):
+        response = self.client.get('/api/hotspots/clusters/' + query)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def top_cluster(self):
+        clusters = self.get_clusters('?zoom=0')['clusters']
+        return (clusters[0]['count'], clusters[0]['numSpAllTime']) if clusters else (0, 0)
+
+    def snapshot(self):
+        return sorted(HotspotCluster.objects.values_list('zoom', 'tile_x', 'tile_y', 'count', 'num_sp_sum'))
+
+    def test_clusters_per_zoom(self):
+        self.assertEqual(self.top_cluster(), (3, 160))
+        clusters = self.get_clusters('?zoom=3&bbox=120,20,150,50')['clusters']
+        self.assertEqual(sum(cluster['count'] for cluster in clusters), 2)
+        # 事前集計より細かいズームは最も細かいレベルで返す（bbox は日付変更線をまたぐ）
+        response = self.get_clusters('?zoom=30&bbox=170,-50,140,50')
+        self.assertEqual(response['zoom'], MAX_CLUSTER_ZOOM)
+        self.assertEqual(sum(cluster['count'] for cluster in response['clusters']), 2)
+
+    def test_invalid_zoom(self):
+        for query in ('', '?zoom=x', '?zoom=-1', '?zoom=3&bbox=1,2'):
+            with self.subTest(query=query):
+                self.assertEqual(self.client.get('/api/hotspots/clusters/' + query).status_code, 400)
+
+    def test_rebuild_matches_incremental_updates(self):
+        before = self.snapshot()
+        call_command('rebuild_hotspot_clusters', stdout=io.StringIO())
+        self.assertEqual(self.snapshot(), before)
+
+    def test_only_listed_hotspots_are_clustered(self):
+        # 一覧に表示されないホットスポットはクラスタにも含めない
+        extra = self.create_hotspot('L9', 35.0, 139.0, numSpAllTime=7)
+        extra.birds.add(*self.birds[:-1])
+        self.assertEqual(self.top_cluster(), (3, 160))
+        extra.birds.add(self.birds[-1])
+        self.assertEqual(self.top_cluster(), (4, 167))
+        BirdDetail.objects.filter(bird_id=self.birds[0]).delete()
+        self.assertEqual(self.top_cluster(), (0, 0))
+        self.assertFalse(HotspotCluster.objects.exists())
+
+    def test_hotspot_delete_and_move(self):
+        self.hotspots[2].delete()
+        self.assertEqual(self.top_cluster(), (2, 150))
+        self.assertEqual(HotspotCluster.objects.filter(zoom=MAX_CLUSTER_ZOOM).count(), 2)
+
+        hotspot = Hotspot.objects.get(locId='L1')
+        hotspot.lat, hotspot.lng = -33.9, 151.2
+        hotspot.save()
+        before = self.snapshot()
+        call_command('rebuild_hotspot_clusters', stdout=io.StringIO())
+        self.assertEqual(self.snapshot(), before)
+
+
+class RandomBirdDetailTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bird, = self.create_birds(1, recordings=5)
+        self.url = f'/api/birds/{self.bird.pk}/random-detail/'
+
+    def get_detail_ids(self, n=10):
+        response = self.client.get(f'{self.url}?n={n}')
+        self.assertEqual(response.status_code, 200, response.content)
+        return [detail['birddetail_id'] for detail in response.json()['bird_details']]
+
+    def test_single_detail(self):
+        response = self.client.get(self.url).json()
+        self.assertEqual(response['bird'], self.bird.comName)
+        self.assertIn(response['bird_detail']['birddetail_id'], set(BirdDetail.objects.values_list('pk', flat=True)))
+
+    def test_cached_index_query_count(self):
+        self.client.get(self.url)
+        # データ版数と、選んだ録音の取得だけ
+        with self.assertNumQueries(2):
+            self.client.get(self.url)
+
+    def test_many_details_without_duplicates(self):
+        ids = self.get_detail_ids(10)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(len(self.get_detail_ids(3)), 3)
+
+    def test_invalid_n(self):
+        for n in ('0', '51', 'x'):
+            with self.subTest(n=n):
+                self.assertEqual(self.client.get(f'{self.url}?n={n}').status_code, 400)
+
+    def test_missing_bird_or_details(self):
+        empty = Bird.objects.create(speciesCode='empty', sciName='Empty', comName='Empty')
+        self.assertEqual(self.client.get(f'/api/birds/{empty.pk}/random-detail/').status_code, 404)
+        self.assertEqual(self.client.get('/api/birds/999/random-detail/').status_code, 404)
+
+    def test_detail_changes_are_picked_up(self):
+        self.get_detail_ids()
+        BirdDetail.objects.create(bird_id=self.bird, recording_url='http://example.com/new')
+        self.assertEqual(len(self.get_detail_ids()), 6)
+        BirdDetail.objects.filter(bird_id=self.bird).first().delete()
+        self.assertEqual(len(self.get_detail_ids()), 5)
+
+    def test_changes_from_other_processes(self):
+        self.get_detail_ids()
+        # 別プロセスの取り込み（シグナルを送らない一括作成とデータ版数の更新）
+        BirdDetail.objects.bulk_create([BirdDetail(bird_id=self.bird, recording_url='http://example.com/bulk')])
+        bump_data_version()
+        self.assertEqual(len(self.get_detail_ids()), 6)
+        # キャッシュに残った削除済みの録音は選ばれない
+        BirdDetail.objects.filter(pk=BirdDetail.objects.first().pk)._raw_delete('default')
+        self.assertEqual(len(self.get_detail_ids()), 5)
+
+
+class ApiResponseCacheTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        hotspot = self.create_hotspot('L1')
+        self.bird, = self.create_birds(1)
+        self.bird.hotspots.add(hotspot)
+        self.url = f'/api/hotspots/{hotspot.pk}/birds/'
+
+    def get_names(self, **headers):
+        response = self.client.get(self.url, **headers)
+        self.assertEqual(response.status_code, 200)
+        return [bird['comName'] for bird in response.json()['birds']]
+
+    def test_etag_and_not_modified(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='application/json')
+        etag = response['ETag']
+        self.assertIn('Accept', response['Vary'])
+        # 304 はデータ版数の確認だけで返す
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=f'"other", {etag}')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_cached_until_data_version_changes(self):
+        etag = self.client.get(self.url)['ETag']
+        Bird.objects.filter(pk=self.bird.pk).update(comName='Raven')
+        self.assertEqual(self.get_names(), ['Bird 00'])
+        bump_data_version()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.get_names(), ['Raven'])
+
+    def test_errors_and_browsable_api_are_not_cached(self):
+        self.assertEqual(self.client.get('/api/hotspots/999/birds/').status_code, 404)
+        self.assertEqual(self.client.get('/api/hotspots/?bbox=1').status_code, 400)
+        response = self.client.get('/api/hotspots/', HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+    def test_backends(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, backend in [('locmem', LocMemCache), ('file', FileBasedCache), ('redis-stub', StubRedisCache)]:
+                config = dict(settings.API_CACHE_BACKENDS[name])
+                if name == 'file':
+                    config['LOCATION'] = directory
+                with self.subTest(backend=name), self.settings(CACHES={**settings.CACHES, 'api': config}):
+                    self.assertIsInstance(caches['api'], backend)
+                    etag = self.client.get(self.url)['ETag']
+                    with self.assertNumQueries(1):
+                        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+                    caches['api'].clear()
+
+
+class StubRedisCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = StubRedisCache('stub://tests', {})
+        self.cache.clear()
+
+    def test_basic_operations(self):
+        self.cache.set('a', {'x': 1})
+        self.assertEqual(self.cache.get('a'), {'x': 1})
+        self.assertFalse(self.cache.add('a', 2))
+        self.assertTrue(self.cache.add('b', 2))
+        self.assertEqual(self.cache.incr('b', 3), 5)
+        self.cache.set_many({'c': 'C', 'd': b'D'})
+        self.assertEqual(self.cache.get_many(['a', 'c', 'd', 'missing']), {'a': {'x': 1}, 'c': 'C', 'd': b'D'})
+        self.cache.delete_many(['a', 'c'])
+        self.assertFalse(self.cache.has_key('a'))
+        self.assertTrue(self.cache.has_key('d'))
+
+    def test_timeouts(self):
+        now = time.monotonic()
+        self.cache.set('a', 1, timeout=10)
+        self.cache.set('b', 1, timeout=None)
+        self.cache.set('c', 1, timeout=0)
+        self.assertFalse(self.cache.has_key('c'))
+        with mock.patch('singbirds.cache_backends.time.monotonic', return_value=now + 11):
+            self.assertIsNone(self.cache.get('a'))
+            self.assertEqual(self.cache.get('b'), 1)
+
+    def test_location_shares_store(self):
+        self.cache.set('shared', 1)
+        self.assertEqual(StubRedisCache('stub://tests', {}).get('shared'), 1)
+        self.assertIsNone(StubRedisCache('stub://other', {}).get('shared'))
+
+
+class HotspotBirdsBatchTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hotspots = [self.create_hotspot(f'L{i}', 35 + i * 0.1, 139) for i in range(3)]
+        self.birds = self.create_birds(12)
+        # 録音のない鳥は一覧に含めない
+        BirdDetail.objects.filter(bird_id=self.birds[11]).delete()
+        self.hotspots[0].birds.add(*self.birds)
+        self.hotspots[1].birds.add(*self.birds[1:])
+        self.hotspots[2].birds.add(self.birds[0])
+
+    def get_batch(self, query):
+        response = self.client.get('/api/hotspots/birds/' + query)
+        self.assertEqual(response.status_code, 200, response.content)
+        data = response.json()
+        names = {hotspot['hotspot_id']: [data['birds'][i]['comName'] for i in hotspot['birds']] for hotspot in data['hotspots']}
+        return data, names
+
+    def test_ids(self):
+        ids = ','.join(str(hotspot.pk) for hotspot in self.hotspots)
+        # データ版数・ホットスポット・紐付け・鳥の4クエリ（ホットスポット数によらない）
+        with self.assertNumQueries(4):
+            data, names = self.get_batch(f'?ids={ids},999')
+        self.assertEqual(len(data['birds']), 11)
+        self.assertEqual(len({bird['bird_id'] for bird in data['birds']}), 11)
+        self.assertEqual([len(names[hotspot.pk]) for hotspot in self.hotspots[:2]], [11, 10])
+        self.assertEqual(names[self.hotspots[2].pk], ['Bird 00'])
+        self.assertNotIn(999, names)
+
+    def test_area(self):
+        # エリア指定は一覧に表示されるホットスポットだけが対象
+        data, names = self.get_batch('?bbox=138,34,140,36')
+        self.assertEqual(list(names), [self.hotspots[0].pk, self.hotspots[1].pk])
+        data, names = self.get_batch('?bbox=138,35.05,140,36')
+        self.assertEqual(list(names), [self.hotspots[1].pk])
+        self.assertEqual(len(data['birds']), 10)
+
+    def test_invalid_parameters(self):
+        too_many = ','.join(str(i) for i in range(MAX_BATCH_HOTSPOTS + 1))
+        for query in ('', '?ids=a,b', '?ids=,', f'?ids={too_many}', '?bbox=1,2,3'):
+            with self.subTest(query=query[:20]):
+                self.assertEqual(self.client.get('/api/hotspots/birds/' + query).status_code, 400)
+
+
+def create_acoustic_parameters(detail, vector):
+    # 38次元の特徴量ベクトル（similarity.feature_vector と同じ並び）から AcousticParameters を作る
+    vector = [float(value) for value in vector]
+    return AcousticParameters.objects.create(
+        bird_id=detail.bird_id, birddetail_id=detail,
+        mfcc_features=vector[:13], chroma_features=vector[13:25],
+        spectral_bandwidth=vector[25], spectral_flatness=vector[26], spectral_contrast=vector[27:34],
+        rms_energy=vector[34], zero_crossing_rate=vector[35], spectral_centroid=vector[36], spectral_rolloff=vector[37],
+    )
+
+
+class SimilaritySearchTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'indexes', 'similarity.pkl')
+        overridden = self.settings(SIMILARITY_INDEX_PATH=self.path)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        # 読み込み済みの索引は他のテストのものなので使わない
+        patcher = mock.patch.dict(similarity._loaded, {'index': None, 'mtime': None})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # 鳥ごとに離れた位置に4件ずつ録音の特徴量を作る
+        self.rng = np.random.default_rng(0)
+        self.birds = self.create_birds(5, recordings=4)
+        self.records = [
+            create_acoustic_parameters(detail, bird_index * 10 + self.rng.normal(size=38))
+            for bird_index, bird in enumerate(self.birds)
+            for detail in BirdDetail.objects.filter(bird_id=bird).order_by('pk')
+        ]
+
+    def add_record(self, bird, center):
+        detail = BirdDetail.objects.create(bird_id=bird, recording_url='http://example.com/extra')
+        return create_acoustic_parameters(detail, center + self.rng.normal(size=38))
+
+    def test_index_not_built(self):
+        self.assertEqual(self.client.get(f'/api/birds/{self.birds[0].pk}/similar/').status_code, 503)
+        empty = Bird.objects.create(speciesCode='empty', sciName='Empty', comName='Empty')
+        self.assertEqual(self.client.get(f'/api/birds/{empty.pk}/similar/').status_code, 404)
+
+    def test_similar_recordings_and_birds(self):
+        self.assertEqual(similarity.rebuild_similarity_index(), 20)
+        record = self.records[0]
+        response = self.client.get(f'/api/birds/{self.birds[0].pk}/details/{record.birddetail_id_id}/similar/?k=3').json()
+        self.assertEqual([item['bird_id'] for item in response['similar']], [self.birds[0].pk] * 3)
+        self.assertNotIn(record.birddetail_id_id, [item['birddetail_id'] for item in response['similar']])
+
+        response = self.client.get(f'/api/birds/{self.birds[2].pk}/similar/?k=2').json()
+        self.assertEqual({item['bird_id'] for item in response['similar']}, {self.birds[1].pk, self.birds[3].pk})
+        self.assertEqual(self.client.get(f'/api/birds/{self.birds[2].pk}/similar/?k=0').status_code, 400)
+
+    def test_add_builds_then_appends(self):
+        # 索引が無ければ全件から作る
+        self.assertEqual(similarity.add_to_similarity_index(self.records[:10]), 20)
+        self.assertEqual(similarity.add_to_similarity_index(self.records[:10]), 0)
+        self.assertEqual(similarity.add_to_similarity_index([self.add_record(self.birds[4], 40)]), 1)
+        self.assertEqual(len(similarity.get_similarity_index()), 21)
+
+    def test_update_from_saved_ids(self):
+        similarity.rebuild_similarity_index()
+        added = [self.add_record(self.birds[index % 5], index * 10) for index in range(5)]
+        # 主キーから少しずつ読み込み直して追加する
+        with mock.patch('singbirds.collectData.collectParameters.INDEX_QUERY_BATCH_SIZE', 2):
+            update_similarity_index([record.pk for record in added], Progress())
+        index = similarity.get_similarity_index()
+        self.assertEqual(len(index), 25)
+        self.assertEqual(set(index.detail_ids[-5:]), {record.birddetail_id_id for record in added})
+
+    def test_concurrent_adds_are_serialized(self):
+        similarity.rebuild_similarity_index()
+        first, second = self.add_record(self.birds[0], 0), self.add_record(self.birds[1], 10)
+        added = []
+        # 別のプロセスが索引を更新している間は、読み込みから保存までを待つ
+        with similarity._index_write_lock(self.path):
+            thread = threading.Thread(target=lambda: added.append(similarity.add_to_similarity_index([first])))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            index = similarity.SimilarityIndex.load(self.path)
+            index.add([second])
+            index.save(self.path)
+        thread.join()
+        self.assertEqual(added, [1])
+        self.assertEqual(len(similarity.SimilarityIndex.load(self.path)), 22)
+
+
+class HotspotColumnarOutputTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hotspots = [
+            self.create_hotspot(f'L{i}', 35 + i, 139.5, valid_bird_count=MIN_VALID_BIRDS,
+                                latestObsDate=datetime.date(2024, 1, i + 1) if i else None)
+            for i in range(3)
+        ]
+        # 対象外のホットスポットは列にも含めない
+        self.create_hotspot('L9', valid_bird_count=MIN_VALID_BIRDS - 1)
+
+    def test_msgpack_columns(self):
+        response = self.client.get('/api/hotspots/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        data = msgpack.unpackb(response.content)
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(list(data['columns']), HotspotListView.columns)
+        self.assertEqual(data['columns']['locId'], ['L0', 'L1', 'L2'])
+        self.assertEqual(data['columns']['lat'], [35.0, 36.0, 37.0])
+        self.assertEqual(data['columns']['lng'], [139.5] * 3)
+        self.assertEqual(data['columns']['latestObsDate'], [None, '2024-01-02', '2024-01-03'])
+        self.assertEqual(data['columns']['countrycode'], [self.hotspots[0].countrycode_id] * 3)
+
+    def test_columns_match_json_rows(self):
+        rows = self.client.get('/api/hotspots/').json()
+        columns = self.client.get('/api/hotspots/', HTTP_ACCEPT='application/vnd.singbirds.columns+json').json()['columns']
+        self.assertEqual([row['hotspot_id'] for row in rows], columns['hotspot_id'])
+        self.assertEqual([float(row['lat']) for row in rows], columns['lat'])
+        self.assertEqual([row['latestObsDate'] for row in rows], columns['latestObsDate'])
+
+    def test_columns_with_area(self):
+        response = self.client.get('/api/hotspots/?bbox=139,35.5,140,40', HTTP_ACCEPT='application/vnd.singbirds.columns+json')
+        self.assertEqual(response['Content-Type'], 'application/vnd.singbirds.columns+json')
+        self.assertEqual(response.json()['count'], 2)
+        self.assertEqual(response.json()['columns']['locId'], ['L1', 'L2'])
+        response = self.client.get('/api/hotspots/?lat=35&lng=139.5&radius=10', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content)['columns']['locId'], ['L0'])
+
+    def test_etag_per_format(self):
+        response = self.client.get('/api/hotspots/', HTTP_ACCEPT='application/msgpack')
+        response304 = self.client.get('/api/hotspots/', HTTP_ACCEPT='application/msgpack', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response304.status_code, 304)
+        # 同じデータでも表現ごとに ETag が違う
+        etags = {
+            response['ETag'],
+            self.client.get('/api/hotspots/')['ETag'],
+            self.client.get('/api/hotspots/', HTTP_ACCEPT='application/vnd.singbirds.columns+json')['ETag'],
+        }
+        self.assertEqual(len(etags), 3)
+        response = self.client.get('/api/hotspots/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+
+class AsyncApiViewTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hotspot = self.create_hotspot('L1', valid_bird_count=MIN_VALID_BIRDS)
+        self.create_hotspot('L2', 43.0, 141.0, valid_bird_count=MIN_VALID_BIRDS)
+        self.bird, silent = self.create_birds(2, recordings=3)
+        BirdDetail.objects.filter(bird_id=silent).delete()
+        self.hotspot.birds.add(self.bird, silent)
+
+    def test_same_response_as_sync_views(self):
+        for path in ('hotspots/', 'hotspots/?bbox=130,30,140,40', f'hotspots/{self.hotspot.pk}/birds/'):
+            with self.subTest(path=path):
+                response = self.client.get('/api/async/' + path)
+                self.assertEqual(response.status_code, 200)
+                expected = self.client.get('/api/' + path)
+                self.assertEqual(response.content, expected.content)
+                self.assertEqual(response['ETag'], expected['ETag'])
+                response = self.client.get('/api/async/' + path, HTTP_IF_NONE_MATCH=expected['ETag'])
+                self.assertEqual(response.status_code, 304)
+
+    def test_random_detail(self):
+        response = self.client.get(f'/api/async/birds/{self.bird.pk}/random-detail/').json()
+        self.assertEqual(response['bird'], self.bird.comName)
+        self.assertEqual(response['bird_detail']['bird_id'], self.bird.pk)
+
+        response = self.client.get(f'/api/async/birds/{self.bird.pk}/random-detail/?n=5').json()
+        ids = [detail['birddetail_id'] for detail in response['bird_details']]
+        self.assertCountEqual(ids, BirdDetail.objects.filter(bird_id=self.bird).values_list('pk', flat=True))
+
+    def test_errors(self):
+        for path, status in [
+            ('hotspots/?bbox=x', 400),
+            ('hotspots/999/birds/', 404),
+            ('birds/999/random-detail/', 404),
+            (f'birds/{self.bird.pk}/random-detail/?n=0', 400),
+            (f'birds/{self.bird.pk}/random-detail/?n=x', 400),
+        ]:
+            with self.subTest(path=path):
+                self.assertEqual(self.client.get('/api/async/' + path).status_code, status)
+        silent = Bird.objects.get(speciesCode='s1')
+        self.assertEqual(self.client.get(f'/api/async/birds/{silent.pk}/random-detail/').status_code, 404)
+
+
+class ExportStaticApiTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.output = directory.name
+        self.hotspots = [self.create_hotspot('L1'), self.create_hotspot('L2', 43.0, 141.0)]
+        self.birds = self.create_birds(MIN_VALID_BIRDS)
+        for bird in self.birds:
+            bird.hotspots.add(*self.hotspots)
+
+    def export(self, *args):
+        output = io.StringIO()
+        call_command('export_static_api', *args, output=self.output, stdout=output)
+        return output.getvalue()
+
+    def read(self, relpath):
+        with open(os.path.join(self.output, relpath), 'rb') as f:
+            return f.read()
+
+    def test_files_match_api_responses(self):
+        # 一覧1つ + ホットスポットごと + 鳥ごと
+        self.assertIn(f'Wrote {3 + MIN_VALID_BIRDS} files', self.export())
+        hotspot, bird = self.hotspots[0], self.birds[0]
+        for relpath, url in [
+            ('hotspots/index.json', '/api/hotspots/'),
+            (f'hotspots/{hotspot.pk}/birds/index.json', f'/api/hotspots/{hotspot.pk}/birds/'),
+            (f'birds/{bird.pk}/details/index.json', f'/api/birds/{bird.pk}/details/'),
+        ]:
+            with self.subTest(relpath=relpath):
+                body = self.read(relpath)
+                self.assertEqual(body, self.client.get(url).content)
+                self.assertEqual(gzip.decompress(self.read(relpath + '.gz')), body)
+                self.assertEqual(brotli.decompress(self.read(relpath + '.br')), body)
+
+    def test_rewrites_only_changed_files(self):
+        self.export()
+        self.assertIn('not changed', self.export())
+
+        # 鳥の名前は2つのホットスポットの鳥一覧とその鳥の録音一覧に含まれる
+        Bird.objects.filter(pk=self.birds[0].pk).update(comName='Renamed')
+        bump_data_version()
+        self.assertIn('Wrote 3 files, removed 0', self.export())
+        self.assertEqual(
+            self.read(f'birds/{self.birds[0].pk}/details/index.json'),
+            self.client.get(f'/api/birds/{self.birds[0].pk}/details/').content,
+        )
+        self.assertIn(f'Wrote {3 + MIN_VALID_BIRDS} files', self.export('--force'))
+
+    def test_removes_files_no_longer_listed(self):
+        self.export()
+        removed = self.hotspots[1]
+        removed.delete()
+        bump_data_version()
+        self.assertIn('Wrote 1 files, removed 1', self.export())
+        for suffix in ('', '.gz', '.br'):
+            self.assertFalse(os.path.exists(os.path.join(self.output, f'hotspots/{removed.pk}/birds/index.json' + suffix)))
+        self.assertEqual(self.read('hotspots/index.json'), self.client.get('/api/hotspots/').content)
+
+class StubServer:
+    # テスト用にローカルで起動する API サーバー。handler は (request, 呼び出し回数) を受け取る
+    def __init__(self, handler):
+        self.handler = handler
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def handle(self, request):
+        self.calls += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            return await self.handler(request, self.calls)
+        finally:
+            self.active -= 1
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}/v2/'
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.runner.cleanup()
+
+
+class AsyncApiClientTests(SimpleTestCase):
+    def run_with_server(self, handler, fetch, **client_options):
+        client_options.setdefault('backoff', 0.01)
+
+        async def run():
+            async with StubServer(handler) as server:
+                async with AsyncApiClient(server.url, **client_options) as client:
+                    return server, await fetch(client)
+        return asyncio.run(run())
+
+    def test_joins_path_and_passes_params(self):
+        async def handler(request, calls):
+            return web.json_response({'path': request.path, 'back': request.query.get('back')})
+
+        _, data = self.run_with_server(handler, lambda client: client.get_json('data/obs/JP/recent', {'back': 30}))
+        self.assertEqual(data, {'path': '/v2/data/obs/JP/recent', 'back': '30'})
+
+    def test_retries_after_429(self):
+        async def handler(request, calls):
+            if calls == 1:
+                return web.Response(status=429, headers={'Retry-After': '0'})
+            return web.json_response([1, 2, 3])
+
+        server, data = self.run_with_server(handler, lambda client: client.get_json('ref/region/list'))
+        self.assertEqual(data, [1, 2, 3])
+        self.assertEqual(server.calls, 2)
+
+    def test_raises_after_exhausting_retries(self):
+        async def handler(request, calls):
+            return web.Response(status=503, text='unavailable')
+
+        async def fetch(client):
+            with self.assertRaises(ApiError) as cm:
+                await client.get_json('ref/region/list')
+            return cm.exception
+
+        server, error = self.run_with_server(handler, fetch, max_retries=2)
+        self.assertEqual(error.status, 503)
+        self.assertEqual(server.calls, 3)
+
+    def test_does_not_retry_client_errors(self):
+        async def handler(request, calls):
+            return web.Response(status=404)
+
+        server, results = self.run_with_server(handler, lambda client: client.get_many([('a', 'missing', None)]))
+        self.assertIsInstance(results['a'], ApiError)
+        self.assertEqual(results['a'].status, 404)
+        self.assertEqual(server.calls, 1)
+
+    def test_invalid_json_fails_only_that_request(self):
+        async def handler(request, calls):
+            if request.path.endswith('/broken'):
+                return web.Response(text='<html>maintenance</html>')
+            return web.json_response({'ok': True})
+
+        requests = [('a', 'ok', None), ('b', 'broken', None)]
+        server, results = self.run_with_server(handler, lambda client: client.get_many(requests))
+        self.assertEqual(results['a'], {'ok': True})
+        self.assertIsInstance(results['b'], ApiError)
+        self.assertEqual(results['b'].status, 200)
+        self.assertEqual(server.calls, 2)
+
+    def test_get_many_bounds_concurrency(self):
+        async def handler(request, calls):
+            await asyncio.sleep(0.02)
+            return web.json_response(request.path)
+
+        requests = [(i, f'item/{i}', None) for i in range(20)]
+        server, results = self.run_with_server(handler, lambda client: client.get_many(requests), concurrency=3)
+        self.assertEqual(results, {i: f'/v2/item/{i}' for i in range(20)})
+        self.assertLessEqual(server.max_active, 3)
+
+    def test_rate_limiter_spaces_requests(self):
+        async def handler(request, calls):
+            return web.json_response({})
+
+        async def fetch(client):
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            await client.get_many([(i, 'ping', None) for i in range(6)])
+            return loop.time() - started
+
+        # バースト2件の後は 50件/秒 = 20ms 間隔
+        _, elapsed = self.run_with_server(handler, fetch, rate_limiter=TokenBucket(rate=50, burst=2))
+        self.assertGreaterEqual(elapsed, 0.07)
+
+
+
+class EbirdBulkUpsertTests(ApiTestCase):
+    HOTSPOTS = [
+        {'locId': 'L1', 'locName': 'A', 'lat': 35.1234567, 'lng': 139.5, 'latestObsDt': '2024-10-01 07:30',
+         'numSpeciesAllTime': 10, 'subnational1Code': 'JP-13'},
+        {'locId': 'L2', 'locName': 'B', 'lat': 36.0, 'lng': 140.0, 'numSpeciesAllTime': 5},
+    ]
+
+    def cluster_snapshot(self):
+        return sorted(HotspotCluster.objects.values_list('zoom', 'tile_x', 'tile_y', 'count', 'num_sp_sum'))
+
+    def test_bulk_upsert_counts(self):
+        def countries(*names):
+            return [Country(countryCode=code, country_name=name) for code, name in names]
+
+        counts, changes = bulk_upsert(countries(('JP', 'Japan'), ('US', 'USA')), key='countryCode', fields=['country_name'])
+        self.assertEqual(counts, {'inserted': 2, 'updated': 0, 'unchanged': 0})
+        self.assertEqual([old for old, _ in changes], [None, None])
+
+        # 同じ key が複数ある場合は後のものを使う
+        counts, changes = bulk_upsert(
+            countries(('JP', 'Nippon'), ('US', 'USA'), ('JP', 'Japan!')), key='countryCode', fields=['country_name'],
+        )
+        self.assertEqual(counts, {'inserted': 0, 'updated': 1, 'unchanged': 1})
+        (old, country), = changes
+        japan = Country.objects.get(countryCode='JP')
+        # 以前の値には主キーも含まれる
+        self.assertEqual(old, {'country_id': japan.pk, 'countryCode': 'JP', 'country_name': 'Japan'})
+        self.assertEqual(japan.country_name, 'Japan!')
+        self.assertEqual(format_counts(counts), '0 inserted, 1 updated, 1 unchanged')
+
+    def test_save_hotspots(self):
+        self.assertEqual(save_hotspots('JP', self.HOTSPOTS), {'inserted': 2, 'updated': 0, 'unchanged': 0})
+        hotspot = Hotspot.objects.get(locId='L1')
+        self.assertEqual(hotspot.latestObsDate, datetime.date(2024, 10, 1))
+        self.assertEqual(hotspot.subnationalCode, 'JP-13')
+        self.assertEqual(hotspot.grid_cell, grid_cell_for(35.1234567, 139.5))
+        self.assertEqual(hotspot.countrycode.countryCode, 'JP')
+
+        # 保存時に丸められる緯度経度は、同じ値なら変更として扱わない
+        self.assertEqual(save_hotspots('JP', self.HOTSPOTS), {'inserted': 0, 'updated': 0, 'unchanged': 2})
+        changed = [self.HOTSPOTS[0], dict(self.HOTSPOTS[1], numSpeciesAllTime=7)]
+        self.assertEqual(save_hotspots('JP', changed), {'inserted': 0, 'updated': 1, 'unchanged': 1})
+        self.assertEqual(Hotspot.objects.get(locId='L2').numSpAllTime, 7)
+
+    def test_save_hotspots_updates_clusters(self):
+        save_hotspots('JP', self.HOTSPOTS)
+        # 新しいホットスポットは、録音のある鳥が紐づくまでクラスタに含めない
+        self.assertFalse(HotspotCluster.objects.exists())
+        Hotspot.objects.get(locId='L1').birds.add(*self.create_birds(MIN_VALID_BIRDS))
+        self.assertEqual(HotspotCluster.objects.get(zoom=0).count, 1)
+
+        moved = [dict(self.HOTSPOTS[0], lat=-33.9, lng=151.2, numSpeciesAllTime=12), dict(self.HOTSPOTS[1], lat=50.0)]
+        save_hotspots('JP', moved)
+        top = HotspotCluster.objects.get(zoom=0)
+        self.assertEqual((top.count, top.num_sp_sum), (1, 12))
+        before = self.cluster_snapshot()
+        call_command('rebuild_hotspot_clusters', stdout=io.StringIO())
+        self.assertEqual(self.cluster_snapshot(), before)
+
+    def test_save_birds(self):
+        species = [{'speciesCode': 'jacrow', 'sciName': 'Corvus macrorhynchos', 'comName': 'Crow'}]
+        stdout = io.StringIO()
+        with redirect_stdout(stdout), self.assertLogs('singbirds.collectData.collectBirds', 'INFO') as logs:
+            self.assertEqual(save_birds(species)['inserted'], 1)
+            self.assertEqual(save_birds(species)['unchanged'], 1)
+            self.assertEqual(save_birds([dict(species[0], comName='Large-billed Crow')])['updated'], 1)
+        self.assertEqual(Bird.objects.get().comName, 'Large-billed Crow')
+        # 追加・更新はワーカーの標準出力ではなくログに出す
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertEqual(
+            [record.getMessage() for record in logs.records],
+            ['Added bird: Crow (Corvus macrorhynchos)', 'Updated bird: Large-billed Crow (Corvus macrorhynchos)'],
+        )
+
+    def test_fetch_and_save_countries_reports_through_progress(self):
+        progress = mock.Mock()
+        stdout = io.StringIO()
+        with redirect_stdout(stdout), mock.patch('singbirds.collectData.collectCountries.ebird_get',
+                                                 side_effect=ApiError(503, 'unavailable')):
+            self.assertIsNone(fetch_and_save_countries(progress=progress))
+        progress.error.assert_called_once_with('Failed to fetch data: 503')
+
+        progress = mock.Mock()
+        with redirect_stdout(stdout), mock.patch('singbirds.collectData.collectCountries.ebird_get',
+                                                 return_value=[{'code': 'JP', 'name': 'Japan'}]), \
+                self.assertLogs('singbirds.collectData.collectCountries', 'INFO') as logs:
+            self.assertEqual(fetch_and_save_countries(progress=progress)['inserted'], 1)
+        self.assertEqual([record.getMessage() for record in logs.records], ['Added country: Japan'])
+        progress.info.assert_called_once_with('Countries: 1 inserted, 0 updated, 0 unchanged')
+        self.assertEqual(stdout.getvalue(), '')
+
+
+class ObservationLinkTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bird, = self.create_birds(1)
+
+    def observations(self, hotspots):
+        # 同じ種が繰り返し出てくる観察データ
+        return {
+            hotspot: [{'speciesCode': 's0'}, {'speciesCode': 'new', 'comName': 'New Bird'}, {'speciesCode': 's0'}]
+            for hotspot in hotspots
+        }
+
+    def save(self, observations):
+        with CaptureQueriesContext(connection) as queries:
+            result = save_observations(observations)
+        return result, len(queries)
+
+    def test_links_birds_in_bulk(self):
+        hotspots = [self.create_hotspot(f'L{i}') for i in range(3)]
+        self.bird.hotspots.add(hotspots[0])
+
+        (created, added), _ = self.save(self.observations(hotspots))
+        self.assertEqual(created, 1)
+        self.assertEqual(dict(added), {hotspots[0].pk: 1, hotspots[1].pk: 2, hotspots[2].pk: 2})
+        self.assertEqual(Bird.objects.get(speciesCode='new').comName, 'New Bird')
+        self.assertEqual(set(hotspots[1].birds.values_list('speciesCode', flat=True)), {'s0', 'new'})
+        # 録音を持つのは s0 だけ
+        self.assertEqual(list(Hotspot.objects.order_by('pk').values_list('valid_bird_count', flat=True)), [1, 1, 1])
+
+        (created, added), _ = self.save(self.observations(hotspots))
+        self.assertEqual((created, sum(added.values())), (0, 0))
+
+    def test_query_count_does_not_grow_with_hotspots(self):
+        _, few = self.save(self.observations([self.create_hotspot(f'A{i}') for i in range(2)]))
+        Bird.objects.filter(speciesCode='new').delete()
+        _, many = self.save(self.observations([self.create_hotspot(f'B{i}') for i in range(20)]))
+        self.assertEqual(few, many)
+
+
+class SyncCursorTests(ApiTestCase):
+    HOTSPOTS = [{'locId': 'L1', 'locName': 'A', 'lat': 35, 'lng': 139, 'latestObsDt': '2024-10-01 07:30', 'numSpeciesAllTime': 10}]
+
+    def test_back_days(self):
+        now = timezone.now()
+        state = SyncState(last_synced_at=now - datetime.timedelta(days=3, hours=1))
+        # 取りこぼしがないよう1日重ねる
+        self.assertEqual(back_days(state, now), 5)
+        self.assertEqual(back_days(SyncState(last_synced_at=now), now), 1)
+        self.assertIsNone(back_days(SyncState(last_synced_at=now - datetime.timedelta(days=40)), now))
+        self.assertIsNone(back_days(None, now))
+        self.assertEqual(since_date(state), (state.last_synced_at - datetime.timedelta(days=1)).date())
+
+    def test_hotspots_sync_incrementally(self):
+        with mock.patch.object(collectHotspots, 'ebird_get_many', return_value={'JP': self.HOTSPOTS}) as get_many:
+            collectHotspots.fetch_and_save_hotspots_by_country('JP')
+            self.assertNotIn('back', get_many.call_args.args[0][0][2])
+            version = get_data_version()
+
+            # 2回目は前回以降の分だけを取得し、同じレスポンスなら保存もキャッシュの無効化もしない
+            counts, errors = collectHotspots.fetch_and_save_hotspots_by_country('JP')
+            # 前回から1日未満なので、重ねる1日を足して2日分
+            self.assertEqual(get_many.call_args.args[0][0][2]['back'], 2)
+            self.assertEqual((counts, errors), ({'JP': {'inserted': 0, 'updated': 0, 'unchanged': 1}}, {}))
+            self.assertEqual(get_data_version(), version)
+
+            collectHotspots.fetch_and_save_hotspots_by_country('JP', full=True)
+            self.assertNotIn('back', get_many.call_args.args[0][0][2])
+
+        state = SyncState.objects.get(source=EBIRD_HOTSPOTS, scope='JP')
+        self.assertEqual((state.item_count, state.changed_count), (1, 0))
+        self.assertEqual(state.response_hash, response_hash(self.HOTSPOTS))
+
+    def test_failed_fetch_keeps_cursor(self):
+        with mock.patch.object(collectHotspots, 'ebird_get_many', return_value={'JP': ApiError(503, 'unavailable')}):
+            counts, errors = collectHotspots.fetch_and_save_hotspots_by_country('JP')
+        self.assertEqual((counts, list(errors)), ({}, ['JP']))
+        self.assertFalse(SyncState.objects.exists())
+
+    def test_observations_skip_hotspots_without_new_observations(self):
+        hotspot = self.create_hotspot('L1', latestObsDate=datetime.date(2024, 10, 1))
+        observations = {'L1': [{'speciesCode': 'a'}]}
+        with mock.patch.object(collectObservations, 'ebird_get_many', return_value=observations) as get_many:
+            totals, _ = collectObservations.fetch_observations_for_hotspots([hotspot])
+            self.assertEqual((totals['fetched'], totals['added_links']), (1, 1))
+            self.assertEqual(SyncState.objects.get(source=EBIRD_OBSERVATIONS).changed_count, 1)
+
+            # 最終観察日が前回の同期より前なら取得しない
+            totals, _ = collectObservations.fetch_observations_for_hotspots([hotspot])
+            self.assertEqual((totals['fetched'], totals['skipped']), (0, 1))
+            self.assertEqual(get_many.call_count, 1)
+
+            hotspot.latestObsDate = timezone.now().date()
+            totals, _ = collectObservations.fetch_observations_for_hotspots([hotspot])
+            self.assertEqual((totals['fetched'], totals['added_links']), (1, 0))
+            self.assertEqual(get_many.call_args.args[0][0][2]['back'], 2)
+
+            # UTC より遅れたタイムゾーンでは、同期の後の観察でも現地の日付は同期の前日になる
+            hotspot.latestObsDate = timezone.now().date() - datetime.timedelta(days=1)
+            totals, _ = collectObservations.fetch_observations_for_hotspots([hotspot])
+            self.assertEqual((totals['fetched'], totals['skipped']), (1, 0))
+
+
+@contextmanager
+def stub_server_thread(handler):
+    # 同期的な処理（内部で asyncio.run を呼ぶもの）から使えるよう、StubServer を別スレッドのイベントループで動かす
+    started, stopping = threading.Event(), threading.Event()
+    result = {}
+
+    async def serve():
+        async with StubServer(handler) as server:
+            result['server'] = server
+            started.set()
+            while not stopping.is_set():
+                await asyncio.sleep(0.01)
+
+    thread = threading.Thread(target=asyncio.run, args=(serve(),))
+    thread.start()
+    started.wait()
+    try:
+        yield result['server']
+    finally:
+        stopping.set()
+        thread.join()
+
+
+class XenoCantoHarvestTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hotspot = self.create_hotspot('L1')
+        self.bird = Bird.objects.create(speciesCode='a', sciName='Aa bb', comName='A')
+        self.missing = Bird.objects.create(speciesCode='b', sciName='Bb cc', comName='B')
+        self.bird.hotspots.add(self.hotspot)
+        BirdDetail.objects.create(bird_id=self.bird, recording_url='http://example.com/0')
+        self.queries = []
+
+    async def handle_search(self, request, calls):
+        query, page = request.query['query'], int(request.query['page'])
+        self.queries.append((query, page))
+        if query.startswith('Bb'):
+            return web.Response(status=404)
+        # 偶数番目だけが品質 A で、4番目は長すぎる。1ページ目の先頭は保存済みの録音
+        recordings = [
+            {'file': f'http://example.com/{page * 10 + i}', 'q': 'A' if i % 2 == 0 else 'B', 'length': '1:10' if i == 4 else '0:25'}
+            for i in range(10)
+        ]
+        if page == 1:
+            recordings[0]['file'] = 'http://example.com/0'
+        return web.json_response({'numPages': 3, 'page': page, 'recordings': recordings})
+
+    def harvest(self, birds, **options):
+        with stub_server_thread(self.handle_search) as server, \
+                mock.patch.dict(os.environ, {'XENO_CANTO_API_URL': server.url}), \
+                mock.patch('singbirds.collectData.apiClient.xeno_canto_rate_limiter', TokenBucket(rate=1000, burst=10)):
+            return harvest_recordings(birds, **options)
+
+    def test_harvest_until_limit(self):
+        totals, errors = self.harvest(Bird.objects.all())
+        self.assertEqual(list(errors), ['b'])
+        self.assertEqual(totals, {'searched': 1, 'skipped': 0, 'added': 9})
+        urls = set(BirdDetail.objects.filter(bird_id=self.bird).values_list('recording_url', flat=True))
+        self.assertEqual(len(urls), MAX_RECORDINGS_PER_SPECIES)
+        self.assertNotIn('http://example.com/4', urls)
+        self.assertTrue(all(f'len:0-{MAX_RECORDING_SECONDS} q:A' in query for query, _ in self.queries))
+        self.assertEqual(sorted(page for query, page in self.queries if query.startswith('Aa')), [1, 2, 3])
+
+        self.assertEqual(Hotspot.objects.get().valid_bird_count, 1)
+        self.assertEqual(SyncState.objects.get(scope='a').changed_count, 9)
+        self.assertFalse(SyncState.objects.filter(scope='b').exists())
+
+        # 上限まで録音のある鳥は検索しない
+        self.queries.clear()
+        totals, _ = self.harvest(Bird.objects.filter(pk=self.bird.pk))
+        self.assertEqual(totals['skipped'], 1)
+        self.assertEqual(self.queries, [])
+
+    def test_searches_since_last_sync(self):
+        self.harvest(Bird.objects.filter(pk=self.bird.pk), per_species=3)
+        self.queries.clear()
+        totals, _ = self.harvest(Bird.objects.filter(pk=self.bird.pk), per_species=5)
+        self.assertEqual(totals['added'], 2)
+        since = (SyncState.objects.get(scope='a').last_synced_at - datetime.timedelta(days=1)).date()
+        self.assertIn(f'since:{since.isoformat()}', self.queries[0][0])
+        self.queries.clear()
+        self.harvest(Bird.objects.filter(pk=self.bird.pk), full=True, per_species=6)
+        self.assertNotIn('since:', self.queries[0][0])
+
+
+class BackgroundJobTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        registry = mock.patch.dict(jobs._registry)
+        registry.start()
+        self.addCleanup(registry.stop)
+        self.continued = []
+
+        @jobs.register_job('count')
+        def count(progress, n):
+            progress.set_total(n)
+            for i in range(n):
+                progress.advance()
+                progress.info(f'step {i}')
+            progress.error('skipped one')
+            return {'n': n}
+
+        @jobs.register_job('fail')
+        def fail(progress):
+            raise RuntimeError('boom')
+
+        @jobs.register_job('cancel')
+        def cancel(progress):
+            # 管理画面でキャンセルされると、次の進捗の書き込みで処理が止まる（except Exception では捕まらない）
+            Job.objects.filter(state=Job.RUNNING).update(state=Job.CANCELLED)
+            try:
+                progress.set_total(3)
+            except Exception:
+                self.continued.append('swallowed')
+            self.continued.append('continued')
+
+    def run_jobs(self):
+        with self.assertLogs('app', 'INFO'):
+            call_command('run_jobs', '--once', stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_run_jobs(self):
+        done, failed, cancelled = jobs.enqueue_job('count', n=3), jobs.enqueue_job('fail'), jobs.enqueue_job('cancel')
+        self.run_jobs()
+        for job in (done, failed, cancelled):
+            job.refresh_from_db()
+            self.assertIsNotNone(job.finished_at)
+
+        self.assertEqual(done.state, Job.SUCCEEDED)
+        self.assertEqual((done.progress_done, done.progress_total, done.message), (3, 3, 'step 2'))
+        self.assertEqual((done.result, done.errors), ({'n': 3}, ['skipped one']))
+        self.assertEqual(failed.state, Job.FAILED)
+        self.assertIn('boom', failed.errors[0])
+        self.assertEqual(cancelled.state, Job.CANCELLED)
+        self.assertEqual(self.continued, [])
+
+    def test_unknown_job(self):
+        with self.assertRaises(ValueError):
+            jobs.enqueue_job('missing')
+
+    def test_claim_and_stale_jobs(self):
+        first, second = jobs.enqueue_job('count', n=1), jobs.enqueue_job('count', n=1)
+        self.assertEqual(jobs.claim_next_job('w1'), first)
+        self.assertEqual(jobs.claim_next_job('w2'), second)
+        self.assertIsNone(jobs.claim_next_job('w3'))
+
+        Job.objects.filter(pk=first.pk).update(heartbeat_at=timezone.now() - jobs.STALE_JOB_TIMEOUT * 2)
+        self.assertEqual(jobs.fail_stale_jobs(), 1)
+        self.assertEqual(Job.objects.get(pk=first.pk).state, Job.FAILED)
+        self.assertEqual(Job.objects.get(pk=second.pk).state, Job.RUNNING)
+
+    def test_admin_actions_enqueue_jobs(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        country = Country.objects.create(countryCode='JP', country_name='Japan')
+        response = self.client.post('/admin/singbirds/country/', {
+            'action': 'fetch_hotspots_for_selected_countries', '_selected_action': [country.pk],
+        }, follow=True)
+        self.assertContains(response, 'Queued job')
+        job = Job.objects.get(name='fetch_hotspots')
+        self.assertEqual((job.state, job.params), (Job.QUEUED, {'country_codes': ['JP']}))
+
+        # 未完了のジョブがある間は進捗を再読み込みする
+        response = self.client.get('/admin/singbirds/job/')
+        self.assertEqual(response['Refresh'], str(jobs.JOB_REFRESH_SECONDS))
+        self.assertEqual(self.client.get(f'/admin/singbirds/job/{job.pk}/change/').status_code, 200)
+
+        self.client.post('/admin/singbirds/job/', {'action': 'cancel_jobs', '_selected_action': [job.pk]})
+        self.assertEqual(Job.objects.get(pk=job.pk).state, Job.CANCELLED)
+        self.assertNotIn('Refresh', self.client.get('/admin/singbirds/job/'))
+        self.client.post('/admin/singbirds/job/', {'action': 'retry_jobs', '_selected_action': [job.pk]})
+        self.assertEqual(Job.objects.filter(name='fetch_hotspots', state=Job.QUEUED).count(), 1)
+
+
+class JobHeartbeatTests(TransactionTestCase):
+    # heartbeat は別のスレッドの DB 接続から書き込むので、トランザクションで囲まないテストにする
+    def setUp(self):
+        registry = mock.patch.dict(jobs._registry)
+        registry.start()
+        self.addCleanup(registry.stop)
+        for name, value in (('HEARTBEAT_INTERVAL', 0.05), ('STALE_JOB_TIMEOUT', datetime.timedelta(seconds=0.5))):
+            patcher = mock.patch.object(jobs, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.stale = []
+
+        @jobs.register_job('slow')
+        def slow(progress):
+            # 進捗を報告しないまま STALE_JOB_TIMEOUT より長くかかる処理の途中で、別のワーカーが停止したジョブを探す
+            progress.set_total(1)
+            time.sleep(1.0)
+            self.stale.append(jobs.fail_stale_jobs())
+            progress.advance()
+            return {'done': True}
+
+    def test_slow_step_keeps_heartbeat(self):
+        jobs.enqueue_job('slow')
+        job = jobs.run_job(jobs.claim_next_job('w1'))
+        self.assertEqual(self.stale, [0])
+        self.assertEqual((job.state, job.result), (Job.SUCCEEDED, {'done': True}))
+
+
+
+class FakeAudioResponse:
+    # requests のストリーミングのレスポンスの代わり
+    def __init__(self, body, headers=None):
+        self.body = body
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), 100):
+            yield self.body[start:start + 100]
+
+
+class FakeAudioSession:
+    # URL ごとの内容を返し、ダウンロードした URL を記録する requests.Session の代わり
+    def __init__(self, bodies, headers=None):
+        self.bodies = bodies
+        self.headers = headers or {}
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append(url)
+        return FakeAudioResponse(self.bodies[url], self.headers)
+
+
+class AudioStoreTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.session = FakeAudioSession({'u1': b'a' * 400, 'u2': b'b' * 400, 'u3': b'a' * 400, 'u4': b'c' * 400})
+        self.store = AudioStore(self.root, max_bytes=1000)
+
+    def age(self, url, seconds=10000):
+        old = time.time() - seconds
+        os.utime(self.store._object_path(self.store.content_hash(url)), (old, old))
+
+    def test_downloads_once(self):
+        for _ in range(2):
+            with self.store.open('u1', session=self.session) as f:
+                self.assertEqual(f.read(), b'a' * 400)
+        self.assertEqual(self.session.calls, ['u1'])
+        self.assertTrue(self.store.contains('u1'))
+        self.assertFalse(self.store.contains('u2'))
+
+    def test_same_content_is_stored_once(self):
+        self.assertEqual(self.store.fetch('u1', session=self.session), self.store.fetch('u3', session=self.session))
+        self.assertEqual(self.store.total_bytes(), 400)
+        self.assertEqual(self.store.path('u3', session=self.session), self.store.path('u1', session=self.session))
+        self.assertEqual(os.listdir(os.path.join(self.root, 'tmp')), [])
+
+    def test_evicts_least_recently_used(self):
+        self.store.fetch('u1', session=self.session)
+        self.store.fetch('u2', session=self.session)
+        self.age('u1', 5000)
+        self.age('u2', 10000)
+        # 読み込むと最終アクセス時刻が更新され、u1 の方が古くなる
+        opened = self.store.open('u2', session=self.session)
+        self.store.fetch('u4', session=self.session)
+
+        self.assertFalse(self.store.contains('u1'))
+        self.assertTrue(self.store.contains('u2'))
+        self.assertTrue(self.store.contains('u4'))
+        self.assertLessEqual(self.store.total_bytes(), 1000)
+        # 開いているファイルは削除されても読み続けられる
+        self.assertEqual(opened.read(), b'b' * 400)
+        opened.close()
+
+        # 削除された録音は次に開くときにダウンロードし直す
+        with self.store.open('u1', session=self.session) as f:
+            self.assertEqual(f.read(), b'a' * 400)
+        self.assertEqual(self.session.calls.count('u1'), 2)
+
+    def test_get_audio_store_uses_settings(self):
+        with self.settings(AUDIO_STORE_PATH=self.root, AUDIO_STORE_MAX_BYTES=123):
+            store = get_audio_store()
+            self.assertIs(get_audio_store(), store)
+        self.assertEqual((store.root, store.max_bytes), (self.root, 123))
+
+
+class PrefetchAudioTests(ApiTestCase):
+    def test_prefetch(self):
+        bird, = self.create_birds(1, recordings=3)
+        urls = list(BirdDetail.objects.values_list('recording_url', flat=True))
+        session = FakeAudioSession({url: url.encode() for url in urls})
+        with tempfile.TemporaryDirectory() as root, self.settings(AUDIO_STORE_PATH=root), \
+                mock.patch('requests.Session', return_value=session):
+            output = io.StringIO()
+            call_command('prefetch_audio', stdout=output)
+            self.assertIn('Fetched 3 recordings (0 failed)', output.getvalue())
+            self.assertTrue(all(get_audio_store().contains(url) for url in urls))
+
+            output = io.StringIO()
+            call_command('prefetch_audio', stdout=output)
+            self.assertIn('3 of 3 recordings are already cached', output.getvalue())
+        self.assertCountEqual(session.calls, urls)
+
+
+class AudioDownloadLimitTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.store = AudioStore(self.root, max_bytes=10 ** 6, max_download_bytes=300)
+
+    def test_rejects_large_downloads(self):
+        # Content-Length を返さない場合は受信した量で判定する
+        for headers in ({'Content-Length': '400'}, {}):
+            with self.subTest(headers=headers):
+                session = FakeAudioSession({'large': b'z' * 400}, headers)
+                with self.assertRaises(AudioTooLarge):
+                    self.store.fetch('large', session=session)
+                self.assertFalse(self.store.contains('large'))
+                self.assertEqual(os.listdir(os.path.join(self.root, 'tmp')), [])
+        self.store.fetch('small', session=FakeAudioSession({'small': b'z' * 300}))
+        self.assertTrue(self.store.contains('small'))
+
+    def test_load_audio_estimates_decode_memory(self):
+        path = os.path.join(self.root, 'stereo.wav')
+        soundfile.write(path, np.zeros((8000, 2), dtype='float32'), 8000)
+        with open(path, 'rb') as f:
+            session = FakeAudioSession({'stereo': f.read()})
+
+        store = AudioStore(os.path.join(self.root, 'store'))
+        with mock.patch('singbirds.audio_store.get_audio_store', return_value=store):
+            y, sr, memory = load_audio('stereo', sr=None, session=session)
+        self.assertEqual((len(y), sr), (8000, 8000))
+        # 元の2チャンネルの float32 と、返すモノラルの波形の合計
+        self.assertEqual(memory, 8000 * 2 * 4 + y.nbytes)
+
+        y, sr, memory = decode_audio(path, sr=4000)
+        self.assertEqual((len(y), sr), (4000, 4000))
+        self.assertEqual(memory, 8000 * 2 * 4 + y.nbytes)
+
+def synthetic_song(sr, seconds=3.0, seed=0):
+    # 鳥の声に似せた、無音区間を挟んだチャープとノイズの信号
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(sr * seconds)) / sr
+    y = 0.5 * np.sin(2 * np.pi * (2000 + 1500 * t) * t) + 0.05 * rng.standard_normal(len(t))
+    y[int(sr * 1.0):int(sr * 1.5)] = 0.0
+    return y.astype(np.float32)
+
+
+class FeatureEngineTests(SimpleTestCase):
+    def assertFeaturesClose(self, actual, expected):
+        self.assertEqual(set(actual), set(expected))
+        for name, value in expected.items():
+            with self.subTest(feature=name):
+                np.testing.assert_allclose(actual[name], value, rtol=1e-4, atol=1e-3)
+
+    def test_matches_reference_implementation(self):
+        for sr in (16000, 22050, 44100):
+            with self.subTest(sr=sr):
+                y = synthetic_song(sr, seed=sr)
+                self.assertFeaturesClose(extract_features(y, sr), extract_features_reference(y, sr))
+
+    def test_short_clip(self):
+        # n_fft より短い録音でも同じ結果になる
+        y = synthetic_song(16000, seconds=0.1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            self.assertFeaturesClose(extract_features(y, 16000), extract_features_reference(y, 16000))
+
+    def test_frame_rms_matches_librosa(self):
+        y = synthetic_song(22050)
+        np.testing.assert_allclose(frame_rms(y), librosa.feature.rms(y=y), rtol=1e-5, atol=1e-7)
+
+    def test_trim_silence_matches_librosa_split(self):
+        y = synthetic_song(16000)
+        expected = np.concatenate([y[start:end] for start, end in librosa.effects.split(y, top_db=30)])
+        np.testing.assert_array_equal(trim_silence(y), expected)
+        self.assertLess(len(expected), len(y))
+
+    def test_frame_features_share_frames(self):
+        frames = frame_features(synthetic_song(16000), 16000)
+        self.assertEqual(frames['mfcc'].shape[0], 13)
+        self.assertEqual(frames['chroma'].shape[0], 12)
+        self.assertEqual(len({value.shape[1] for value in frames.values()}), 1)
+
+    def test_frame_feature_store_round_trip(self):
+        y = synthetic_song(16000)
+        features, data = extract_frame_features(y, 16000)
+        self.assertEqual(features, extract_features(y, 16000))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'frame_features.npy')
+            with open(path, 'wb') as f:
+                f.write(data)
+            frames = load_frame_features(path)
+            self.assertIsInstance(frames['mfcc'].base, np.memmap)
+            self.assertEqual(frames['mfcc'].shape[0], 13)
+            self.assertEqual(frames['chroma'].dtype, np.float16)
+
+            # 保存したフレームから求めた平均は、録音から求めた値と float16 の精度で一致する
+            recomputed = summarize(frames)
+            for name, value in features.items():
+                with self.subTest(feature=name):
+                    np.testing.assert_allclose(recomputed[name], value, rtol=2e-3, atol=1e-3)
+            del frames
+
+    def test_frame_statistics(self):
+        frames = load_frame_features(io.BytesIO(extract_frame_features(synthetic_song(16000), 16000)[1]))
+        self.assertEqual(sum(values.shape[0] for values in frames.values()), FRAME_FEATURE_DIMS)
+        statistics = frame_statistics(frames, percentiles=(10, 50, 90))
+        mfcc = statistics['mfcc']
+        self.assertEqual(set(mfcc), {'mean', 'std', 'p10', 'p50', 'p90'})
+        self.assertEqual(len(mfcc['std']), 13)
+        self.assertTrue(all(low <= high for low, high in zip(mfcc['p10'], mfcc['p90'])))
+
+
+class RecordingPipelineTests(SimpleTestCase):
+    # 計算には Django に依存しない関数が必要なので、ファイルサイズを返す os.path.getsize を使う
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.downloads = []
+
+    def fake_download(self, url):
+        # url は「ファイル名:作成するまでのダウンロード回数」
+        self.downloads.append(url)
+        name, _, created_after = url.partition(':')
+        path = os.path.join(self.directory, name)
+        if self.downloads.count(url) > int(created_after or 0):
+            with open(path, 'wb') as f:
+                f.write(b'x' * len(name))
+        return path
+
+    def run_pipeline(self, rows, **options):
+        results, errors = {}, {}
+        with mock.patch.object(recordingPipeline, '_download', self.fake_download):
+            run_recording_pipeline(rows, os.path.getsize, results.__setitem__, errors.__setitem__, workers=1, **options)
+        return results, errors
+
+    def test_bounds_recordings_in_flight(self):
+        results, errors = {}, {}
+        pulled, max_pending = [], []
+
+        def rows():
+            for i in range(30):
+                pulled.append(i)
+                max_pending.append(len(pulled) - len(results) - len(errors))
+                yield i, f'{"a" * (i + 1)}'
+
+        def on_result(key, size):
+            results[key] = size
+
+        with mock.patch.object(recordingPipeline, '_download', self.fake_download):
+            run_recording_pipeline(rows(), os.path.getsize, on_result, errors.__setitem__,
+                                   workers=1, download_workers=2, queue_size=3)
+        self.assertEqual(results, {i: i + 1 for i in range(30)})
+        self.assertEqual(errors, {})
+        # ダウンロード中・待ち行列・計算中の合計を超えて読み進めない
+        self.assertLessEqual(max(max_pending), 2 + 3 + recordingPipeline.COMPUTE_PREFETCH)
+
+    def test_downloads_evicted_recordings_again(self):
+        # 1回目のパスは計算の前に削除されている（他のプロセスによる削除）
+        results, errors = self.run_pipeline([('evicted', 'evicted:1'), ('gone', 'gone:99')], download_workers=1, queue_size=1)
+        self.assertEqual(results, {'evicted': len('evicted')})
+        self.assertEqual(self.downloads.count('evicted:1'), 2)
+        self.assertEqual(list(errors), ['gone'])
+        self.assertEqual(self.downloads.count('gone:99'), 1 + recordingPipeline.EVICTED_RETRIES)
+
+    def test_download_errors(self):
+        def fail(url):
+            raise requests.ConnectionError('refused')
+
+        errors = {}
+        with mock.patch.object(recordingPipeline, '_download', fail):
+            run_recording_pipeline([('a', 'a')], os.path.getsize, self.fail, errors.__setitem__, workers=1)
+        self.assertIn('Failed to download audio: refused', errors['a'])
+
+    def test_path_marks_recording_as_recently_used(self):
+        store = AudioStore(self.directory)
+        session = FakeAudioSession({'u': b'audio'})
+        path = store.path('u', session=session)
+        os.utime(path, (time.time() - 600, time.time() - 600))
+        self.assertEqual(store.path('u', session=session), path)
+        self.assertGreater(os.path.getmtime(path), time.time() - 60)
+        self.assertEqual(session.calls, ['u'])
+
+
+@contextmanager
+def static_file_server(directory):
+    # directory のファイルを HTTP で配信する
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}/'
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+class RecordingTestCase(ApiTestCase):
+    # 配信する録音（SAMPLE_RATE の wav）と、音声キャッシュ・メディアの一時ディレクトリを用意する
+    SAMPLE_RATE = 22050
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.www = os.path.join(self.directory, 'www')
+        os.makedirs(self.www)
+        for i in range(4):
+            soundfile.write(os.path.join(self.www, f'{i}.wav'), synthetic_song(self.SAMPLE_RATE, seconds=2.0, seed=i), self.SAMPLE_RATE)
+
+        overridden = self.settings(
+            AUDIO_STORE_PATH=os.path.join(self.directory, 'audio'), MEDIA_ROOT=os.path.join(self.directory, 'media'),
+            FEATURE_EXTRACTION_WORKERS=1, AUDIO_DOWNLOAD_WORKERS=2, FEATURE_PIPELINE_QUEUE_SIZE=1,
+        )
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        self.bird = Bird.objects.create(speciesCode='a', sciName='A a', comName='A')
+
+    def create_details(self, base_url):
+        details = [BirdDetail.objects.create(bird_id=self.bird, recording_url=f'{base_url}{i}.wav') for i in range(4)]
+        BirdDetail.objects.create(bird_id=self.bird, recording_url=f'{base_url}missing.wav')
+        return details
+
+
+class FeatureExtractionPipelineTests(RecordingTestCase):
+    def test_extract_acoustic_features(self):
+        with static_file_server(self.www) as base_url:
+            self.create_details(base_url)
+            with mock.patch('singbirds.collectData.collectParameters.add_to_similarity_index') as add_to_index, \
+                    self.assertLogs('app', 'INFO'):
+                counts = extract_acoustic_features(BirdDetail.objects.all())
+
+        self.assertEqual((counts['saved'], counts['failed']), (4, 1))
+        self.assertGreater(counts['peak_worker_rss_mb'], 0)
+        self.assertGreater(counts['max_recording_mb'], 0)
+        # 類似検索の索引はジョブの最後に1回だけ、保存した行を読み込み直して更新する
+        add_to_index.assert_called_once()
+        records = list(add_to_index.call_args.args[0])
+        self.assertEqual(
+            sorted(record.birddetail_id_id for record in records),
+            sorted(AcousticParameters.objects.values_list('birddetail_id', flat=True)),
+        )
+        self.assertFalse(any(hasattr(record, 'frame_data') for record in records))
+
+        parameters = AcousticParameters.objects.get(birddetail_id__recording_url__endswith='/2.wav')
+        y, sr = librosa.load(os.path.join(self.www, '2.wav'), sr=FEATURE_SAMPLE_RATE)
+        self.assertAlmostEqual(parameters.rms_energy, extract_features(y, sr)['rms_energy'], places=5)
+
+
+class RecordingProcessingTests(RecordingTestCase):
+    def test_analyze_file_matches_separate_steps(self):
+        path = os.path.join(self.www, '0.wav')
+        result = analyze_file(path)
+        y, sr = librosa.load(path, sr=FEATURE_SAMPLE_RATE)
+        # 元のサンプリングレートの1回のデコードから、個別に読み込んだ場合と同じ特徴量を求める
+        self.assertEqual(result['features'], extract_features(y, sr))
+        self.assertEqual(result['frame_features'], extract_frame_features(y, sr)[1])
+        self.assertTrue(result['spectrogram']['full']['png'].startswith(b'\x89PNG'))
+        self.assertEqual(load_spectrogram_data(result['spectrogram_data'])[0]['sample_rate'], self.SAMPLE_RATE)
+
+        result = analyze_file(path, spectrogram=False)
+        self.assertIsNone(result['spectrogram'])
+        self.assertIsNone(result['spectrogram_data'])
+        result = analyze_file(path, features=False)
+        self.assertIsNone(result['features'])
+
+    def test_process_recordings(self):
+        with static_file_server(self.www) as base_url:
+            details = self.create_details(base_url)
+            BirdDetail.objects.create(bird_id=self.bird, recording_url='')
+            with mock.patch('singbirds.collectData.collectParameters.add_to_similarity_index') as add_to_index, \
+                    self.assertLogs('app', 'INFO'):
+                self.assertEqual(process_recording(details[0], features=False), {'spectrogram': True, 'features': False})
+                counts = process_recordings(BirdDetail.objects.all())
+                self.assertEqual(add_to_index.call_count, 1)
+                self.assertEqual(len(list(add_to_index.call_args.args[0])), 4)
+
+                # 作成済みのものは処理しない
+                second = process_recordings(BirdDetail.objects.all())
+
+        self.assertEqual(
+            [counts[name] for name in ('spectrograms', 'features', 'skipped', 'failed')], [3, 4, 0, 2],
+        )
+        self.assertEqual([second[name] for name in ('spectrograms', 'features', 'skipped', 'failed')], [0, 0, 4, 2])
+        self.assertEqual(AcousticParameters.objects.count(), 4)
+        for detail in details:
+            detail.refresh_from_db()
+            self.assertEqual(detail.spectrogram.name, f'spectrograms/spectrogram_{detail.pk}.png')
+            self.assertTrue(os.path.exists(detail.spectrogram.path))
+            self.assertTrue(detail.spectrogram_data)
+            self.assertIn('thumbnail', detail.spectrogram_derivatives)
+
+
+def tone(sr, frequency, seconds=2.0):
+    t = np.arange(int(sr * seconds)) / sr
+    return (0.5 * np.sin(2 * np.pi * frequency * t) + 0.001 * np.random.default_rng(0).standard_normal(len(t))).astype(np.float32)
+
+
+class SpectrogramImageTests(SimpleTestCase):
+    def open_image(self, data):
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return image
+
+    def test_viridis_matches_matplotlib(self):
+        expected = np.round(matplotlib.colormaps['viridis'](np.arange(256))[:, :3] * 255)
+        np.testing.assert_array_equal(spectrogramImage.VIRIDIS, expected)
+        np.testing.assert_array_equal(spectrogramImage.colorize(np.array([[-100.0, -80.0, 0.0]])),
+                                      [[VIRIDIS[0], VIRIDIS[0], VIRIDIS[255]]])
+
+    def test_resample_rows(self):
+        values = np.zeros((100, 1))
+        values[37] = 1.0
+        # 縮小しても1行だけの値は消えない
+        self.assertEqual(spectrogramImage.resample_rows(values, np.linspace(0, 100, 11)).ravel().tolist(), [0, 0, 0, 1] + [0] * 6)
+        # 拡大は中心での線形補間
+        np.testing.assert_allclose(spectrogramImage.resample_rows(np.array([[0.0], [1.0]]), np.linspace(0, 2, 5)).ravel(),
+                                   [0, 0.25, 0.75, 1])
+
+    def test_render_tone(self):
+        sr, frequency = 22050, 2000
+        D = spectrogram_db(tone(sr, frequency))
+        for log_frequency in (True, False):
+            with self.subTest(log_frequency=log_frequency):
+                image = self.open_image(render_spectrogram(D, sr, width=300, height=200, axes=False, log_frequency=log_frequency))
+                self.assertEqual((image.size, image.format), ((300, 200), 'PNG'))
+                # 最も明るい行（上が高い周波数）が音の周波数
+                brightness = np.asarray(image, dtype=float).sum(axis=2).mean(axis=1)
+                edges = spectrogramImage.frequency_edges(sr, 200, log_frequency)[::-1]
+                row = brightness.argmax()
+                self.assertLessEqual(edges[row + 1], frequency * 1.05)
+                self.assertGreaterEqual(edges[row], frequency * 0.95)
+
+    def test_render_with_axes(self):
+        D = spectrogram_db(tone(16000, 1000, seconds=3.0))
+        image = self.open_image(render_spectrogram(D, 16000, width=500, height=200, format='webp'))
+        self.assertEqual((image.size, image.format), ((500, 200), 'WEBP'))
+        # 左と下の余白は白地に目盛り
+        margin = np.asarray(image.convert('RGB'))[:, :spectrogramImage.AXIS_LEFT - 10]
+        self.assertGreater((margin > 240).all(axis=2).mean(), 0.8)
+        self.assertTrue((margin < 100).all(axis=2).any())
+
+    def test_render_spectrogram_set(self):
+        images = spectrogram_set(tone(22050, 3000), 22050)
+        for size, (width, height, _) in SPECTROGRAM_SIZES.items():
+            for format in SPECTROGRAM_FORMATS:
+                image = self.open_image(images[size][format])
+                self.assertEqual((image.size, image.format), ((width, height), format.upper()))
+
+    def test_render_in_threads(self):
+        # グローバルな状態を持たないので、同時に描いても同じ画像になる
+        D = spectrogram_db(tone(22050, 3000))
+        expected = render_spectrogram(D, 22050)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: render_spectrogram(D, 22050), range(8)))
+        self.assertTrue(all(result == expected for result in results))
+
+
+class SpectrogramDerivativeTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.media_root = directory.name
+        overridden = self.settings(MEDIA_ROOT=self.media_root)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        self.bird, = self.create_birds(1, recordings=3)
+        self.details = list(BirdDetail.objects.order_by('pk'))
+
+    def save_legacy_spectrogram(self, detail):
+        # 以前の matplotlib の画像と同じ大きさの、派生画像の無いスペクトログラム
+        buffer = io.BytesIO()
+        Image.new('RGB', (1000, 400), (10, 20, 30)).save(buffer, 'PNG')
+        detail.spectrogram.save('legacy.png', ContentFile(buffer.getvalue()))
+
+    def test_save_spectrogram_images(self):
+        detail = self.details[0]
+        images = spectrogram_set(tone(22050, 3000), 22050)
+        for _ in range(2):
+            # 作り直しても同じ名前になる
+            save_spectrogram_images(detail, images)
+        detail.refresh_from_db()
+        self.assertEqual(detail.spectrogram.name, f'spectrograms/spectrogram_{detail.pk}.png')
+        self.assertEqual(detail.spectrogram_derivatives['thumbnail']['webp'], f'spectrograms/thumbnail/spectrogram_{detail.pk}.webp')
+        self.assertNotIn('png', detail.spectrogram_derivatives['full'])
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'spectrograms', 'thumbnail'))), 2)
+
+        images = BirdDetailSerializer(detail).data['spectrogram_images']
+        self.assertEqual(images['thumbnail']['png'], f'/media/spectrograms/thumbnail/spectrogram_{detail.pk}.png')
+        self.assertEqual(images['full']['png'], BirdDetailSerializer(detail).data['spectrogram'])
+        self.assertEqual(set(images), set(SPECTROGRAM_SIZES))
+
+    def test_legacy_spectrogram_urls(self):
+        legacy, missing = self.details[0], self.details[1]
+        self.save_legacy_spectrogram(legacy)
+        # 派生画像が無ければ元の画像を返す
+        self.assertEqual(BirdDetailSerializer(legacy).data['spectrogram_images']['thumbnail']['webp'], legacy.spectrogram.url)
+        self.assertIsNone(BirdDetailSerializer(missing).data['spectrogram_images'])
+
+    def test_backfill_derivatives(self):
+        legacy = self.details[0]
+        self.save_legacy_spectrogram(legacy)
+        self.save_legacy_spectrogram(self.details[1])
+        original = legacy.spectrogram.name
+        version = get_data_version()
+
+        output = io.StringIO()
+        call_command('backfill_spectrogram_derivatives', '--workers', '1', '--batch-size', '1', stdout=output)
+        self.assertIn('Created derivatives for 2 spectrograms (0 failed)', output.getvalue())
+        self.assertNotEqual(get_data_version(), version)
+
+        legacy.refresh_from_db()
+        self.assertEqual(legacy.spectrogram.name, original)
+        for size, (width, height, _) in SPECTROGRAM_SIZES.items():
+            for format, name in legacy.spectrogram_derivatives[size].items():
+                with Image.open(os.path.join(self.media_root, name)) as image:
+                    self.assertEqual((image.size, image.format), ((width, height), format.upper()))
+
+        output = io.StringIO()
+        call_command('backfill_spectrogram_derivatives', '--workers', '1', stdout=output)
+        self.assertIn('0 spectrograms to backfill', output.getvalue())
+
+
+class SpectrogramDataTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.media_root = directory.name
+        overridden = self.settings(MEDIA_ROOT=self.media_root)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        self.bird, = self.create_birds(1)
+        self.detail = BirdDetail.objects.get()
+        self.url = f'/api/birds/{self.bird.pk}/details/{self.detail.pk}/spectrogram-data/'
+
+    def test_quantized_spectrogram(self):
+        sr = 22050
+        D = spectrogram_db(tone(sr, 3000, seconds=3.0))
+        data = quantize_spectrogram(D, sr)
+        meta, levels = load_spectrogram_data(data)
+        self.assertEqual(levels.shape, (meta['frames'], meta['bins']))
+        self.assertEqual(levels.shape, (150, 128))
+        frequencies = np.array(meta['frequencies'])
+        self.assertTrue(2800 < frequencies[levels[len(levels) // 2].argmax()] < 3200)
+        # ナイキスト周波数より上は無音
+        self.assertTrue((levels[:, frequencies > sr / 2] == 0).all())
+        self.assertLess(len(data), len(render_spectrogram_set(D, sr)['full']['png']) / 3)
+
+    def test_spectrogram_data_endpoint(self):
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        D = spectrogram_db(tone(22050, 3000))
+        data = quantize_spectrogram(D, 22050)
+        save_spectrogram_images(self.detail, render_spectrogram_set(D, 22050), data)
+        self.detail.refresh_from_db()
+        self.assertEqual(self.detail.spectrogram_data.name, f'spectrogram_data/spectrogram_{self.detail.pk}.msgpack')
+
+        response = self.client.get(self.url)
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'application/msgpack'))
+        self.assertEqual(response.content, data)
+        self.assertIn('max-age', response['Cache-Control'])
+
+        # 304 の場合はファイルを読まない
+        with mock.patch('django.db.models.fields.files.FieldFile.open', side_effect=AssertionError('read the file')):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        # 作り直すと ETag が変わる
+        save_spectrogram_images(self.detail, {}, quantize_spectrogram(spectrogram_db(tone(22050, 1000)), 22050))
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+
+        self.assertEqual(self.client.get(f'/api/birds/{self.bird.pk + 1}/details/{self.detail.pk}/spectrogram-data/').status_code, 404)
+        os.remove(self.detail.spectrogram_data.path)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_replace_file_keeps_old_file_until_swapped(self):
+        replace_file(self.detail.spectrogram_data, 'data.msgpack', b'old')
+        path = self.detail.spectrogram_data.path
+        original_replace = os.replace
+
+        def check_replace(source, destination):
+            # 新しい内容を書き終えるまで古いファイルが読める
+            with open(destination, 'rb') as f:
+                self.assertEqual(f.read(), b'old')
+            with open(source, 'rb') as f:
+                self.assertEqual(f.read(), b'new')
+            original_replace(source, destination)
+
+        with mock.patch('singbirds.collectData.createSpectrogram.os.replace', side_effect=check_replace) as replace:
+            replace_file(self.detail.spectrogram_data, 'data.msgpack', b'new')
+        replace.assert_called_once()
+        self.assertEqual(self.detail.spectrogram_data.path, path)
+        with self.detail.spectrogram_data.open('rb') as f:
+            self.assertEqual(f.read(), b'new')
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['data.msgpack'])
+
+
+class FrameFeatureStorageTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.media_root = directory.name
+        overridden = self.settings(MEDIA_ROOT=self.media_root)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        self.bird, = self.create_birds(1, recordings=3)
+        self.details = list(BirdDetail.objects.order_by('pk'))
+        self.features, self.frame_data = extract_frame_features(synthetic_song(16000), 16000)
+
+    def build(self, detail, frame_data=None):
+        return build_acoustic_parameters(detail.pk, self.bird.pk, self.features, frame_data or self.frame_data)
+
+    def frame_files(self):
+        directory = os.path.join(self.media_root, 'frame_features')
+        return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+    def test_files_are_written_after_insert(self):
+        progress = Progress()
+        # 作成しただけではファイルを書き込まない
+        parameters = [self.build(detail) for detail in self.details[:2]]
+        self.assertEqual(self.frame_files(), [])
+
+        self.assertEqual(save_acoustic_parameters(parameters, progress), 2)
+        self.assertEqual(self.frame_files(), [frame_features_name(detail.pk) for detail in self.details[:2]])
+        # 書き込んだバイト列は手放す
+        self.assertEqual([record.frame_data for record in parameters], [None, None])
+        record = AcousticParameters.objects.get(birddetail_id=self.details[0])
+        self.assertEqual(record.frame_features.name, f'frame_features/frame_features_{self.details[0].pk}.npy')
+        self.assertEqual(set(load_frame_features(record.frame_features.path)), set(frame_features(synthetic_song(16000), 16000)))
+
+    def test_failed_insert_keeps_existing_files(self):
+        save_acoustic_parameters([self.build(self.details[0])], Progress())
+        path = AcousticParameters.objects.get().frame_features.path
+        with open(path, 'rb') as f:
+            original = f.read()
+
+        # 抽出済みの録音を含むバッチは保存できない。既存の行のファイルも、新しい録音のファイルも書き込まない
+        other = extract_frame_features(synthetic_song(16000, seed=1), 16000)[1]
+        with self.assertLogs('app', 'ERROR'):
+            saved = save_acoustic_parameters([self.build(self.details[0], other), self.build(self.details[1], other)], Progress())
+        self.assertEqual(saved, 0)
+        self.assertEqual(self.frame_files(), [frame_features_name(self.details[0].pk)])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), original)
+
+    def test_failed_write_leaves_row_without_file(self):
+        with mock.patch('singbirds.collectData.collectParameters.replace_file', side_effect=OSError('disk full')), \
+                self.assertLogs('app', 'ERROR') as logs:
+            parameters = self.build(self.details[0])
+            self.assertEqual(save_acoustic_parameters([parameters], Progress()), 1)
+        self.assertIn('disk full', logs.output[0])
+        self.assertIsNone(parameters.frame_data)
+        self.assertFalse(AcousticParameters.objects.get().frame_features)
+
+    def test_extraction_skips_recordings_with_parameters(self):
+        save_acoustic_parameters([self.build(self.details[0])], Progress())
+        rows = []
+        with mock.patch('singbirds.collectData.collectParameters.run_recording_pipeline',
+                        side_effect=lambda rows_, *args, **kwargs: rows.extend(rows_)):
+            counts = extract_acoustic_features(BirdDetail.objects.all())
+        self.assertEqual([key[0] for key, _ in rows], [detail.pk for detail in self.details[1:]])
+        self.assertEqual((counts['saved'], counts['skipped'], counts['failed']), (0, 1, 0))
+
+    def test_recompute_acoustic_parameters(self):
+        save_acoustic_parameters([self.build(detail) for detail in self.details], Progress())
+        AcousticParameters.objects.update(rms_energy=0)
+        statistics = os.path.join(self.media_root, 'statistics.jsonl')
+        with mock.patch('singbirds.management.commands.recompute_acoustic_parameters.rebuild_similarity_index') as rebuild:
+            call_command('recompute_acoustic_parameters', statistics=statistics, stdout=io.StringIO())
+        rebuild.assert_called_once()
+
+        # float16 で保存したフレームから、録音から求めた値を精度の範囲で復元する
+        for record in AcousticParameters.objects.all():
+            self.assertAlmostEqual(record.rms_energy, self.features['rms_energy'], delta=abs(self.features['rms_energy']) * 2e-3)
+        with open(statistics) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(sorted(line['birddetail_id'] for line in lines), [detail.pk for detail in self.details])
+        self.assertEqual(set(lines[0]['statistics']['mfcc']), {'mean', 'std', 'p10', 'p50', 'p90'})
@@ -1,10 +1,23 @@
 from django.urls import path
-from .views.hotspot_views import HotspotListView 
-from .views.bird_views import birds_by_hotspot
-from .views.birddetail_views import random_bird_detail
+from .views.hotspot_views import HotspotListView, HotspotClusterView
+from .views.bird_views import birds_by_hotspot, birds_by_hotspots
+from .views.birddetail_views import random_bird_detail, bird_details, spectrogram_data
+from .views.similarity_views import similar_birds, similar_recordings
+from .views.async_views import hotspot_list_async, birds_by_hotspot_async, random_bird_detail_async
 
 urlpatterns = [
     path('hotspots/', HotspotListView.as_view(), name='hotspot-list'),
+    path('hotspots/clusters/', HotspotClusterView.as_view(), name='hotspot-clusters'),
+    path('hotspots/birds/', birds_by_hotspots, name='birds-by-hotspots'),
     path('hotspots/<int:hotspot_id>/birds/', birds_by_hotspot, name='birds-by-hotspot'),
     path('birds/<int:bird_id>/random-detail/', random_bird_detail, name='random-bird-detail'),
+    path('birds/<int:bird_id>/details/', bird_details, name='bird-details'),
+    path('birds/<int:bird_id>/similar/', similar_birds, name='similar-birds'),
+    path('birds/<int:bird_id>/details/<int:birddetail_id>/similar/', similar_recordings, name='similar-recordings'),
+    path('birds/<int:bird_id>/details/<int:birddetail_id>/spectrogram-data/', spectrogram_data, name='spectrogram-data'),
+
+    # ASGI（uvicorn ワーカー）用の非同期版
+    path('async/hotspots/', hotspot_list_async, name='hotspot-list-async'),
+    path('async/hotspots/<int:hotspot_id>/birds/', birds_by_hotspot_async, name='birds-by-hotspot-async'),
+    path('async/birds/<int:bird_id>/random-detail/', random_bird_detail_async, name='random-bird-detail-async'),
 ]
\ No newline at end of file
@@ -0,0 +1,71 @@
+from django.db.models import Count
+from django.http import JsonResponse
+from ..api_cache import acached_json_response
+from ..hotspot_summary import MIN_VALID_BIRDS
+from ..models import Hotspot
+from ..random_details import MAX_RANDOM_DETAILS, apick_random_details
+from ..serializers.birddetail_serializer import BirdDetailSerializer
+from ..serializers.birds_serializer import BirdSerializer
+from ..serializers.hotspots_serializer import HotspotSerializer
+from ..spatial import parse_area
+
+# ASGI（uvicorn ワーカー）用の非同期ビュー。DRF は非同期ビューに対応していないため Django のビューで実装する
+# レスポンスの形式は同期版（hotspot_views / bird_views / birddetail_views）と同じ
+
+
+async def hotspot_list_async(request):
+    try:
+        area = parse_area(request.GET)
+    except ValueError as e:
+        return JsonResponse({'message': str(e)}, status=400)
+
+    async def build():
+        hotspots = Hotspot.objects.filter(valid_bird_count__gte=MIN_VALID_BIRDS)
+        if area is not None:
+            hotspots = hotspots.filter(area.q())
+
+        hotspots = [
+            hotspot async for hotspot in hotspots
+            if area is None or area.contains(float(hotspot.lat), float(hotspot.lng))
+        ]
+        # 取得済みのオブジェクトのシリアライズはDBにアクセスしない
+        return HotspotSerializer(hotspots, many=True).data
+
+    return await acached_json_response(request, 'hotspot-list', build)
+
+
+async def birds_by_hotspot_async(request, hotspot_id):
+    async def build():
+        hotspot = await Hotspot.objects.filter(hotspot_id=hotspot_id).afirst()
+        if hotspot is None:
+            return JsonResponse({'detail': 'No Hotspot matches the given query.'}, status=404)
+
+        birds = [
+            bird async for bird in hotspot.birds.annotate(detail_count=Count('birddetail')).filter(detail_count__gt=0)
+        ]
+        return {'hotspot': hotspot.locName, 'birds': BirdSerializer(birds, many=True).data}
+
+    return await acached_json_response(request, f'birds-by-hotspot:{hotspot_id}', build)
+
+
+async def random_bird_detail_async(request, bird_id):
+    n = request.GET.get('n')
+    if n is not None:
+        try:
+            n = int(n)
+        except ValueError:
+            return JsonResponse({'message': "'n' must be an integer."}, status=400)
+        if not 1 <= n <= MAX_RANDOM_DETAILS:
+            return JsonResponse({'message': f"'n' must be between 1 and {MAX_RANDOM_DETAILS}."}, status=400)
+
+    bird_name, bird_details = await apick_random_details(bird_id, n or 1)
+    if bird_name is None:
+        return JsonResponse({'detail': 'No Bird matches the given query.'}, status=404)
+
+    if not bird_details:
+        return JsonResponse({'message': 'No bird details found for this bird.'}, status=404)
+
+    if n is None:
+        return JsonResponse({'bird': bird_name, 'bird_detail': BirdDetailSerializer(bird_details[0]).data})
+
+    return JsonResponse({'bird': bird_name, 'bird_details': BirdDetailSerializer(bird_details, many=True).data})
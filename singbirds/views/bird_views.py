@@ -1,20 +1,110 @@
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from ..models import Hotspot
+from ..api_cache import cached_response
+from ..hotspot_summary import MIN_VALID_BIRDS
+from ..models import Bird, BirdDetail, Hotspot
 from ..serializers.birds_serializer import BirdSerializer
-from django.db.models import Count
+from ..spatial import parse_area
+from django.db.models import Count, Exists, OuterRef
 from django.shortcuts import get_object_or_404
 
-@api_view(['GET'])
-def birds_by_hotspot(request, hotspot_id):
-    # Hotspotを取得
-    hotspot = get_object_or_404(Hotspot, hotspot_id=hotspot_id)
-    
+# ?ids= で一度に指定できるホットスポット数の上限
+MAX_BATCH_HOTSPOTS = 500
+
+def hotspot_birds_data(hotspot):
     # birdDetailの数をカウントし、カウントが0でないものだけを取得
     birds = hotspot.birds.annotate(detail_count=Count('birddetail')).filter(detail_count__gt=0)
-    
+
     # シリアライズ
     serializer = BirdSerializer(birds, many=True)
-    
-    # JSONレスポンスを返す
-    return Response({'hotspot': hotspot.locName, 'birds': serializer.data})
\ No newline at end of file
+    return {'hotspot': hotspot.locName, 'birds': serializer.data}
+
+
+@api_view(['GET'])
+def birds_by_hotspot(request, hotspot_id):
+    def build():
+        # Hotspotを取得
+        hotspot = get_object_or_404(Hotspot, hotspot_id=hotspot_id)
+        return hotspot_birds_data(hotspot)
+
+    # データが変わるまではシリアライズ済みのJSONを返す
+    return cached_response(request, f'birds-by-hotspot:{hotspot_id}', build)
+
+
+def _parse_hotspot_ids(value):
+    try:
+        hotspot_ids = {int(part) for part in value.split(',') if part.strip()}
+    except ValueError:
+        raise ValueError("'ids' must be comma separated integers.")
+    if not hotspot_ids:
+        raise ValueError("'ids' must not be empty.")
+    if len(hotspot_ids) > MAX_BATCH_HOTSPOTS:
+        raise ValueError(f"'ids' must contain at most {MAX_BATCH_HOTSPOTS} hotspots.")
+    return hotspot_ids
+
+
+@api_view(['GET'])
+def birds_by_hotspots(request):
+    # 複数のホットスポットの鳥をまとめて返す
+    #   ?ids=1,2,3 またはエリア指定（?bbox= / ?lat=&lng=&radius=、表示対象のホットスポットのみ）
+    # 鳥は重複なしの一覧で返し、各ホットスポットには鳥一覧のインデックスを持たせる
+    try:
+        area = parse_area(request.query_params)
+        if request.query_params.get('ids'):
+            hotspot_ids = _parse_hotspot_ids(request.query_params['ids'])
+        elif area is None:
+            raise ValueError("Either 'ids' or an area ('bbox' or 'lat'/'lng'/'radius') is required.")
+    except ValueError as e:
+        return Response({'message': str(e)}, status=400)
+
+    def build():
+        # 1. 対象ホットスポット
+        if area is None:
+            hotspots = Hotspot.objects.filter(hotspot_id__in=hotspot_ids)
+        else:
+            hotspots = Hotspot.objects.filter(area.q(), valid_bird_count__gte=MIN_VALID_BIRDS)
+
+        selected = [
+            (pk, loc_name) for pk, loc_name, lat, lng in hotspots.values_list('hotspot_id', 'locName', 'lat', 'lng')
+            if area is None or area.contains(float(lat), float(lng))
+        ]
+        selected_ids = {pk for pk, _ in selected}
+
+        # エリア指定ではID一覧の代わりにサブクエリで絞り込む（グリッドセル単位の候補を含むため後で除外する）
+        hotspot_filter = hotspots.values('hotspot_id')
+        has_detail = Exists(BirdDetail.objects.filter(bird_id=OuterRef('bird_id')))
+
+        # 2. ホットスポットと録音のある鳥の対応
+        links = (
+            Bird.hotspots.through.objects
+            .filter(has_detail, hotspot_id__in=hotspot_filter)
+            .values_list('hotspot_id', 'bird_id')
+        )
+        bird_ids_by_hotspot = {pk: [] for pk in selected_ids}
+        for pk, bird_id in links:
+            if pk in bird_ids_by_hotspot:
+                bird_ids_by_hotspot[pk].append(bird_id)
+
+        # 3. 鳥の一覧（重複なし）
+        linked_bird_ids = {bird_id for bird_ids in bird_ids_by_hotspot.values() for bird_id in bird_ids}
+        birds = [
+            bird for bird in Bird.objects.filter(hotspots__in=hotspot_filter).filter(
+                Exists(BirdDetail.objects.filter(bird_id=OuterRef('pk')))
+            ).distinct().order_by('comName')
+            if bird.bird_id in linked_bird_ids
+        ]
+        bird_index = {bird.bird_id: index for index, bird in enumerate(birds)}
+
+        return {
+            'birds': BirdSerializer(birds, many=True).data,
+            'hotspots': [
+                {
+                    'hotspot_id': pk,
+                    'locName': loc_name,
+                    'birds': sorted(bird_index[bird_id] for bird_id in bird_ids_by_hotspot[pk]),
+                }
+                for pk, loc_name in sorted(selected)
+            ],
+        }
+
+    return cached_response(request, 'birds-by-hotspots', build)
@@ -1,18 +1,80 @@
-import random
+import hashlib
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.shortcuts import get_object_or_404
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from django.shortcuts import get_object_or_404
+from ..api_cache import cached_response
 from ..models import Bird, BirdDetail
+from ..random_details import MAX_RANDOM_DETAILS, pick_random_details
+from ..renderers import MsgPackRenderer
 from ..serializers.birddetail_serializer import BirdDetailSerializer
 
+# 量子化したスペクトログラムは作り直さない限り変わらないので、ブラウザにキャッシュさせる（以降は ETag で確認する）
+SPECTROGRAM_DATA_MAX_AGE = 60 * 60
+
 @api_view(['GET'])
 def random_bird_detail(request, bird_id):
-    bird = get_object_or_404(Bird, bird_id=bird_id)
-    bird_details = BirdDetail.objects.filter(bird_id=bird)
-    
-    if bird_details.exists():
-        bird_detail = random.choice(bird_details)
-        serializer = BirdDetailSerializer(bird_detail)
-        return Response({'bird': bird.comName, 'bird_detail': serializer.data})
-    else:
-        return Response({'message': 'No bird details found for this bird.'}, status=404)
\ No newline at end of file
+    # ?n= を指定すると重複なしで複数件返す（クイズ・プレイリスト用）
+    n = request.query_params.get('n')
+    if n is not None:
+        try:
+            n = int(n)
+        except ValueError:
+            return Response({'message': "'n' must be an integer."}, status=400)
+        if not 1 <= n <= MAX_RANDOM_DETAILS:
+            return Response({'message': f"'n' must be between 1 and {MAX_RANDOM_DETAILS}."}, status=400)
+
+    bird_name, bird_details = pick_random_details(bird_id, n or 1)
+    if bird_name is None:
+        raise Http404("No Bird matches the given query.")
+
+    if not bird_details:
+        return Response({'message': 'No bird details found for this bird.'}, status=404)
+
+    if n is None:
+        serializer = BirdDetailSerializer(bird_details[0])
+        return Response({'bird': bird_name, 'bird_detail': serializer.data})
+
+    serializer = BirdDetailSerializer(bird_details, many=True)
+    return Response({'bird': bird_name, 'bird_details': serializer.data})
+
+
+def bird_details_data(bird):
+    bird_details = BirdDetail.objects.filter(bird_id=bird).order_by('birddetail_id')
+    serializer = BirdDetailSerializer(bird_details, many=True)
+    return {'bird': bird.comName, 'bird_details': serializer.data}
+
+
+@api_view(['GET'])
+def bird_details(request, bird_id):
+    # 鳥の録音をすべて返す
+    def build():
+        bird = get_object_or_404(Bird, bird_id=bird_id)
+        return bird_details_data(bird)
+
+    return cached_response(request, f'bird-details:{bird_id}', build)
+
+@api_view(['GET'])
+def spectrogram_data(request, bird_id, birddetail_id):
+    # クライアント側で描画するための量子化したスペクトログラムを msgpack で返す
+    # 形式は collectData/spectrogramData.py を参照。保存済みのバイト列をそのまま返す
+    detail = get_object_or_404(BirdDetail, bird_id=bird_id, birddetail_id=birddetail_id)
+    if not detail.spectrogram_data:
+        return Response({'message': 'Spectrogram data has not been generated for this recording.'}, status=404)
+
+    # ファイルは作り直すと置き換わるので、内容を読まずに名前・サイズ・更新時刻から ETag を作る
+    storage, name = detail.spectrogram_data.storage, detail.spectrogram_data.name
+    try:
+        version = f"{name}:{storage.size(name)}:{storage.get_modified_time(name).timestamp()}"
+    except FileNotFoundError:
+        return Response({'message': 'Spectrogram data file is missing.'}, status=404)
+    etag = quote_etag(hashlib.sha1(version.encode('utf-8')).hexdigest())
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        with detail.spectrogram_data.open('rb') as f:
+            response = HttpResponse(f.read(), content_type=MsgPackRenderer.media_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = f'public, max-age={SPECTROGRAM_DATA_MAX_AGE}'
+    return response
@@ -1,17 +1,100 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from django.db.models import Count, Q
-from ..models import Hotspot
-from ..serializers.hotspots_serializer import HotspotSerializer
+from rest_framework.settings import api_settings
+from django.db.models import Q
+from ..api_cache import cached_response
+from ..models import Hotspot, HotspotCluster
+from ..hotspot_clusters import MIN_CLUSTER_ZOOM, MAX_CLUSTER_ZOOM
+from ..hotspot_summary import MIN_VALID_BIRDS
+from ..renderers import COLUMNAR_FORMATS, ColumnarJSONRenderer, MsgPackRenderer
+from ..serializers.hotspots_serializer import HotspotSerializer, HotspotClusterSerializer
+from ..spatial import parse_area, parse_bbox
 
 
 class HotspotListView(APIView):
+    # 通常の JSON に加えて、Accept で列指向の msgpack / JSON を選べる
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, ColumnarJSONRenderer, MsgPackRenderer]
+
+    # 列指向で返すフィールド（HotspotSerializer と同じ並び）
+    columns = ['hotspot_id', 'locId', 'locName', 'countrycode', 'subnationalCode', 'lat', 'lng', 'numSpAllTime', 'latestObsDate']
+
+    def get(self, request, *args, **kwargs):
+        # 表示範囲（?bbox= または ?lat=&lng=&radius=）
+        try:
+            area = parse_area(request.query_params)
+        except ValueError as e:
+            return Response({'message': str(e)}, status=400)
+
+        columnar = request.accepted_renderer.format in COLUMNAR_FORMATS
+
+        def build():
+            # 10種類以上の鳥がいて、かつその鳥が少なくとも1つ以上のBirdDetailを持っているホットスポットのみを取得
+            # （valid_bird_count は hotspot_summary で事前集計済み）
+            hotspots = Hotspot.objects.filter(valid_bird_count__gte=MIN_VALID_BIRDS)
+            if area is not None:
+                hotspots = hotspots.filter(area.q())
+
+            if columnar:
+                return self.build_columns(hotspots, area)
+
+            if area is not None:
+                # grid_cell のインデックスで候補を絞り込み、境界付近のセルだけ正確に判定する
+                hotspots = [hotspot for hotspot in hotspots if area.contains(float(hotspot.lat), float(hotspot.lng))]
+
+            # シリアライズ
+            serializer = HotspotSerializer(hotspots, many=True)
+            return serializer.data
+
+        # データが変わるまではシリアライズ済みの本文を返す
+        return cached_response(request, 'hotspot-list', build)
+
+    def build_columns(self, hotspots, area):
+        # シリアライザを通さず values_list から平行配列を作る
+        rows = hotspots.values_list(*[
+            'countrycode_id' if column == 'countrycode' else column for column in self.columns
+        ])
+        lat_index, lng_index = self.columns.index('lat'), self.columns.index('lng')
+        date_index = self.columns.index('latestObsDate')
+
+        values = [[] for _ in self.columns]
+        for row in rows:
+            lat, lng = float(row[lat_index]), float(row[lng_index])
+            if area is not None and not area.contains(lat, lng):
+                continue
+            for index, value in enumerate(row):
+                values[index].append(value)
+            values[lat_index][-1] = lat
+            values[lng_index][-1] = lng
+            if row[date_index] is not None:
+                values[date_index][-1] = row[date_index].isoformat()
+
+        return {'count': len(values[0]), 'columns': dict(zip(self.columns, values))}
+
+
+class HotspotClusterView(APIView):
     def get(self, request, *args, **kwargs):
-        # 10種類以上の鳥がいて、かつその鳥が少なくとも1つ以上のBirdDetailを持っているホットスポットのみを取得
-        hotspots = Hotspot.objects.annotate(
-            valid_bird_count=Count('birds', filter=Q(birds__birddetail__isnull=False), distinct=True)
-        ).filter(valid_bird_count__gte=10)
-
-        # シリアライズしてレスポンスを返す
-        serializer = HotspotSerializer(hotspots, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        # ?zoom= は必須、?bbox=west,south,east,north は任意
+        try:
+            zoom = int(request.query_params.get('zoom', ''))
+        except ValueError:
+            return Response({'message': "'zoom' must be an integer."}, status=400)
+        if zoom < MIN_CLUSTER_ZOOM:
+            return Response({'message': f"'zoom' must be at least {MIN_CLUSTER_ZOOM}."}, status=400)
+
+        # 事前集計していないズームレベルは最も細かいレベルで返す
+        zoom = min(zoom, MAX_CLUSTER_ZOOM)
+        clusters = HotspotCluster.objects.filter(zoom=zoom)
+
+        if request.query_params.get('bbox'):
+            try:
+                bbox = parse_bbox(request.query_params['bbox'])
+            except ValueError as e:
+                return Response({'message': str(e)}, status=400)
+
+            tiles = Q()
+            for x_range, y_range in bbox.tile_ranges(zoom):
+                tiles |= Q(tile_x__range=x_range, tile_y__range=y_range)
+            clusters = clusters.filter(tiles)
+
+        serializer = HotspotClusterSerializer(clusters, many=True)
+        return Response({'zoom': zoom, 'clusters': serializer.data})
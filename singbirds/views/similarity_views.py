@@ -0,0 +1,111 @@
+from collections import defaultdict
+import numpy as np
+from django.shortcuts import get_object_or_404
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+from ..models import AcousticParameters, Bird, BirdDetail
+from ..similarity import feature_vector, get_similarity_index
+
+DEFAULT_SIMILAR_COUNT = 10
+MAX_SIMILAR_COUNT = 100
+
+# 種ごとに集約するため、近傍の録音を k より多めに取得する倍率
+SPECIES_OVERFETCH = 10
+
+
+def _parse_k(request):
+    try:
+        k = int(request.query_params.get('k', DEFAULT_SIMILAR_COUNT))
+    except ValueError:
+        raise ValueError("'k' must be an integer.")
+    if not 1 <= k <= MAX_SIMILAR_COUNT:
+        raise ValueError(f"'k' must be between 1 and {MAX_SIMILAR_COUNT}.")
+    return k
+
+
+def _index_or_error():
+    index = get_similarity_index()
+    if index is None:
+        return None, Response({'message': 'Similarity index has not been built yet.'}, status=503)
+    return index, None
+
+
+@api_view(['GET'])
+def similar_recordings(request, bird_id, birddetail_id):
+    # 指定した録音に音響的に近い録音を返す
+    try:
+        k = _parse_k(request)
+    except ValueError as e:
+        return Response({'message': str(e)}, status=400)
+
+    record = get_object_or_404(AcousticParameters, bird_id=bird_id, birddetail_id=birddetail_id)
+    vector = feature_vector(record)
+    if vector is None:
+        return Response({'message': 'Acoustic parameters of this recording are incomplete.'}, status=404)
+
+    index, error = _index_or_error()
+    if error:
+        return error
+
+    # 自分自身が含まれるので1件多く取得する
+    positions, distances = index.query(vector, k + 1)
+    neighbours = [
+        (int(index.detail_ids[position]), float(distance))
+        for position, distance in zip(positions[0], distances[0])
+        if index.detail_ids[position] != birddetail_id
+    ][:k]
+
+    details = BirdDetail.objects.select_related('bird_id').in_bulk([detail_id for detail_id, _ in neighbours])
+    similar = [
+        {
+            'birddetail_id': detail_id,
+            'bird_id': details[detail_id].bird_id.bird_id,
+            'comName': details[detail_id].bird_id.comName,
+            'recording_url': details[detail_id].recording_url,
+            'distance': round(distance, 6),
+        }
+        for detail_id, distance in neighbours
+        if detail_id in details  # 索引作成後に削除された録音は除外
+    ]
+    return Response({'birddetail_id': birddetail_id, 'similar': similar})
+
+
+@api_view(['GET'])
+def similar_birds(request, bird_id):
+    # 指定した鳥の録音に音響的に近い鳥（種）を返す
+    try:
+        k = _parse_k(request)
+    except ValueError as e:
+        return Response({'message': str(e)}, status=400)
+
+    bird = get_object_or_404(Bird, bird_id=bird_id)
+    vectors = [vector for vector in map(feature_vector, AcousticParameters.objects.filter(bird_id=bird)) if vector is not None]
+    if not vectors:
+        return Response({'message': 'No acoustic parameters found for this bird.'}, status=404)
+
+    index, error = _index_or_error()
+    if error:
+        return error
+
+    # 各録音の近傍を集め、種ごとに最も近い距離で並べる
+    positions, distances = index.query(np.vstack(vectors), k * SPECIES_OVERFETCH)
+    best = defaultdict(lambda: float('inf'))
+    for position, distance in zip(positions.ravel(), distances.ravel()):
+        other_bird_id = int(index.bird_ids[position])
+        if other_bird_id != bird.bird_id:
+            best[other_bird_id] = min(best[other_bird_id], float(distance))
+
+    ranked = sorted(best.items(), key=lambda item: item[1])[:k]
+    birds = Bird.objects.in_bulk([other_bird_id for other_bird_id, _ in ranked])
+    similar = [
+        {
+            'bird_id': other_bird_id,
+            'speciesCode': birds[other_bird_id].speciesCode,
+            'comName': birds[other_bird_id].comName,
+            'sciName': birds[other_bird_id].sciName,
+            'distance': round(distance, 6),
+        }
+        for other_bird_id, distance in ranked
+        if other_bird_id in birds
+    ]
+    return Response({'bird': bird.comName, 'similar': similar})
@@ -0,0 +1,38 @@
+"""
+Gunicorn config for serving singbirds_project over ASGI with uvicorn workers.
+
+    gunicorn -c singbirds_project/gunicorn_asgi.py singbirds_project.asgi:application
+
+Single process without gunicorn (development / profiling):
+
+    uvicorn singbirds_project.asgi:application --host 127.0.0.1 --port 8001 --workers 2
+
+The async API is mounted under /api/async/ (see singbirds/urls.py). The sync
+DRF views stay available on the same server and are run in a thread by Django,
+so the existing WSGI setup (gunicorn singbirds_project.wsgi:application) can
+keep serving /api/ while the async stack is compared with the loadtest_api
+management command.
+
+Note: Django runs async ORM queries on a single thread per process, so with
+SQLite the gain comes from not blocking the event loop on cached responses and
+slow clients. Scale with more workers, not more threads.
+"""
+
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", "127.0.0.1:8001")
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+
+# 非同期ワーカーは1プロセスで多数の接続を扱うため、タイムアウトは長時間リクエストの保険
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
+
+# メモリ増加対策として一定数のリクエストごとにワーカーを入れ替える
+max_requests = 10000
+max_requests_jitter = 1000
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")
+errorlog = os.getenv("GUNICORN_ERROR_LOG", "-")
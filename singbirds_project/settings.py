@@ -134,11 +134,64 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 #   os.path.join(BASE_DIR, 'staticfiles/'),
 # )
 
+# 類似検索用の近傍索引（rebuild_similarity_index で作成）
+SIMILARITY_INDEX_PATH = os.getenv("SIMILARITY_INDEX_PATH", os.path.join(BASE_DIR, 'indexes', 'similarity.pkl'))
+
+# 録音ファイルのローカルキャッシュ（singbirds/audio_store.py）。上限を超えると最終アクセスの古いものから削除する
+AUDIO_STORE_PATH = os.getenv("AUDIO_STORE_PATH", os.path.join(BASE_DIR, 'audio_cache'))
+AUDIO_STORE_MAX_BYTES = int(os.getenv("AUDIO_STORE_MAX_BYTES", str(20 * 1024 ** 3)))
+# 1録音あたりのダウンロードの上限サイズとタイムアウト（秒）
+AUDIO_DOWNLOAD_MAX_BYTES = int(os.getenv("AUDIO_DOWNLOAD_MAX_BYTES", str(50 * 1024 ** 2)))
+AUDIO_DOWNLOAD_TIMEOUT = float(os.getenv("AUDIO_DOWNLOAD_TIMEOUT", "60"))
+# 音響特徴量の抽出のワーカープロセス数（0 は使える CPU コア数）。デコード後の配列がメモリの大半を占める
+FEATURE_EXTRACTION_WORKERS = int(os.getenv("FEATURE_EXTRACTION_WORKERS", "0"))
+# 録音の同時ダウンロード数と、ダウンロード済みで計算を待つ録音数の上限
+AUDIO_DOWNLOAD_WORKERS = int(os.getenv("AUDIO_DOWNLOAD_WORKERS", "16"))
+FEATURE_PIPELINE_QUEUE_SIZE = int(os.getenv("FEATURE_PIPELINE_QUEUE_SIZE", "32"))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Cache
+# 'api' は公開APIのレスポンスキャッシュ（データ版数ごとにキーが変わる）
+# API_CACHE_BACKEND: locmem（プロセス内） / file（単一ノードで共有） / redis（Redis互換サーバー、redis-py が必要）
+#                    redis-stub（redis と同じクライアントをメモリ上の Redis の代わりで動かす。開発・テスト用でプロセス内のみ）
+
+API_CACHE_BACKEND = os.getenv("API_CACHE_BACKEND", "locmem")
+
+API_CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'singbirds-api',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv("API_CACHE_LOCATION", os.path.join(BASE_DIR, 'cache', 'api')),
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+    'redis': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv("API_CACHE_LOCATION", 'redis://127.0.0.1:6379/1'),
+    },
+    'redis-stub': {
+        'BACKEND': 'singbirds.cache_backends.StubRedisCache',
+        'LOCATION': os.getenv("API_CACHE_LOCATION", 'stub://singbirds-api'),
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'api': {
+        **API_CACHE_BACKENDS[API_CACHE_BACKEND],
+        'TIMEOUT': 60 * 60 * 24,
+    },
+}
+
 DATA_UPLOAD_MAX_NUMBER_FIELDS = 1000000
 
 CORS_ALLOWED_ORIGINS = [